@@ -1,15 +1,21 @@
 import os
+import json
+import hashlib
 import argparse
 from argparse import Namespace
+import numpy as np
 import pandas as pd
 
-from typing import List
+from typing import Dict, List, Tuple
 
 def argument_parsing() -> Namespace:
     parser = argparse.ArgumentParser()
 
     parser.add_argument("-df", "--data_folder", type=str, help="Specify the directory from which we want to take the data", required=True)
     parser.add_argument("-hu", "--human", action="store_true", help="Specify that the game to be analyzed are from humans")
+    parser.add_argument("-v", "--vectorized", action="store_true", help="Analyze all the games at once, saving the results as Parquet files in the data folder")
+    parser.add_argument("--excel", action="store_true", help="With --vectorized, also export a summarize.xlsx file for each folder")
+    parser.add_argument("--force", action="store_true", help="Specify to analyze again the games already listed in the manifest")
 
     return parser.parse_args()
 
@@ -66,7 +72,8 @@ def calculate_votes_when_not_narrator(votes_df: pd.DataFrame) -> pd.DataFrame:
 def calculate_correct_votes_for_narrator(votes_df: pd.DataFrame) -> pd.DataFrame:
     correct_vote_stats = {}
     for player in votes_df['Player'].unique():
-        player_votes = votes_df[votes_df['Voted By'].str.contains(player, na=False)]
+        # Exact names: a substring match would count the votes of "GPT Bot 1" for "Bot 1"
+        player_votes = votes_df[votes_df['Voted By'].str.split(", ").apply(lambda voters: isinstance(voters, list) and player in voters)]
         total_votes = player_votes.shape[0]
         correct_votes = player_votes[player_votes["Player"] == player_votes["Narrator"]].shape[0]
         
@@ -78,7 +85,7 @@ def calculate_correct_votes_for_narrator(votes_df: pd.DataFrame) -> pd.DataFrame
     
     return pd.DataFrame.from_dict(correct_vote_stats, orient='index')
 
-def create_analysis(path_to_excel: str, path_to_save: str) -> None:
+def create_analysis(path_to_excel: str, path_to_save: str) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
     narrations_df = pd.read_excel(path_to_excel, sheet_name='Narrations')
     votes_df = pd.read_excel(path_to_excel, sheet_name='Votes')
 
@@ -93,14 +100,21 @@ def create_analysis(path_to_excel: str, path_to_save: str) -> None:
         votes_when_not_narrator_stats.to_excel(writer, sheet_name='Votes When Not Narrator', index=True)
         correct_votes_stats.to_excel(writer, sheet_name='Correct Votes Stats', index=True)
 
+    return narrator_vote_stats, votes_when_not_narrator_stats, correct_votes_stats
+
 def compute_combined_averages(file_list: List[str], sheet_name: str, value_cols: List[str], human_game: bool) -> pd.DataFrame:
     combined_data = pd.DataFrame()
 
     for file_path in file_list:
         df = pd.read_excel(file_path, sheet_name=sheet_name)
-        player_type_col = df.columns[0] 
         combined_data = pd.concat([combined_data, df], ignore_index=True)
-    
+
+    return combine_averages(combined_data, value_cols, human_game)
+
+# The first column holds the player names
+def combine_averages(combined_data: pd.DataFrame, value_cols: List[str], human_game: bool) -> pd.DataFrame:
+    player_type_col = combined_data.columns[0]
+
     if not human_game:
         gpt_players = combined_data[combined_data[player_type_col].str.match(r'^GPT Bot', case=False, na=False)]
         bot_players = combined_data[combined_data[player_type_col].str.match(r'^Bot(?!.*GPT)', case=False, na=False)]
@@ -121,26 +135,28 @@ def compute_combined_averages(file_list: List[str], sheet_name: str, value_cols:
     return combined_averages
 
 def compute_winners_stats(original_files: List[str], human_game: bool) -> pd.DataFrame:
+    return winners_stats([pd.read_excel(file_path, sheet_name="Winners") for file_path in original_files], human_game)
+
+# One Winners sheet (Player, Winner) per game
+def winners_stats(winner_frames: List[pd.DataFrame], human_game: bool) -> pd.DataFrame:
     tot_gpt_winners = 0
     tot_bot_winners = 0
 
     if not human_game:
-        for file_path in original_files:
-            df = pd.read_excel(file_path, sheet_name = "Winners")
+        for df in winner_frames:
             gpt_players = df[df["Player"].str.match(r'^GPT Bot', case=False, na=False)]
             bot_players = df[df["Player"].str.match(r'^Bot(?!.*GPT)', case=False, na=False)]
 
             tot_gpt_winners += gpt_players["Winner"].sum()
             tot_bot_winners += bot_players["Winner"].sum()
 
-        win_stats = {"GPT": (tot_gpt_winners/len(original_files)) * 100, "Bot": (tot_bot_winners/len(original_files)) * 100}
+        win_stats = {"GPT": (tot_gpt_winners/len(winner_frames)) * 100, "Bot": (tot_bot_winners/len(winner_frames)) * 100}
 
     else:
         tot_artificial_winners = 0
         tot_human_winners = 0
 
-        for file_path in original_files:
-            df = pd.read_excel(file_path, sheet_name="Winners")
+        for df in winner_frames:
             artificial_players = df[df["Player"] == "Artificial Player"]
             human_players = df[df["Player"] != "Artificial Player"]
 
@@ -148,48 +164,300 @@ def compute_winners_stats(original_files: List[str], human_game: bool) -> pd.Dat
             tot_human_winners += human_players["Winner"].sum()
 
         win_stats = {
-            "Artificial Player": (tot_artificial_winners / len(original_files)) * 100,
-            "Human": (tot_human_winners / len(original_files)) * 100
+            "Artificial Player": (tot_artificial_winners / len(winner_frames)) * 100,
+            "Human": (tot_human_winners / len(winner_frames)) * 100
         }
 
     return  pd.DataFrame(win_stats.items(), columns=['Player', 'Winner Percent'])
 
 
+SUMMARY_SHEETS = {
+    'Narrator Votes Stats': ('Narrator Votes Averages', ['percent_voted_by_all', 'percent_voted_by_none', 'percent_voted_by_someone']),
+    'Votes When Not Narrator': ('Votes Not Narrator Averages', ['percent_voted_when_not_narrator']),
+    'Correct Votes Stats': ('Correct Votes Averages', ['percent_correct_votes_for_narrator'])
+}
+
 def summarize(path_to_save: str, file_list: List[str], original_files: List[str], human_game: bool) -> None:
     with pd.ExcelWriter(os.path.join(path_to_save, "summarize.xlsx")) as writer:
-        narrator_votes_averages = compute_combined_averages(file_list, 'Narrator Votes Stats', 
-                                                            ['percent_voted_by_all', 'percent_voted_by_none', 'percent_voted_by_someone'], human_game)
-        narrator_votes_averages.to_excel(writer, sheet_name='Narrator Votes Averages')
-
-        votes_not_narrator_averages = compute_combined_averages(file_list, 'Votes When Not Narrator',
-                                                                ['percent_voted_when_not_narrator'], human_game)
-        votes_not_narrator_averages.to_excel(writer, sheet_name='Votes Not Narrator Averages')
-
-        correct_votes_averages = compute_combined_averages(file_list, 'Correct Votes Stats',
-                                                        ['percent_correct_votes_for_narrator'], human_game)
-        correct_votes_averages.to_excel(writer, sheet_name='Correct Votes Averages')
+        for sheet_name, (summary_sheet, value_cols) in SUMMARY_SHEETS.items():
+            compute_combined_averages(file_list, sheet_name, value_cols, human_game).to_excel(writer, sheet_name=summary_sheet)
 
         win_stats = compute_winners_stats(original_files, human_game)
         win_stats.to_excel(writer, sheet_name='Winners Statistics', index=False)
 
-if __name__ == "__main__":
+# ---------------------------------------------------------------------------
+# Incremental analysis: analysis_manifest.json (in the data folder) keeps, for every game, the hash of its content
+# and the counts behind its statistics. Only new or changed games are analyzed, the summaries are rebuilt from the counts.
+# ---------------------------------------------------------------------------
+
+ANALYSIS_MANIFEST = "analysis_manifest.json"
+# Bumped when the statistics change, so the counts saved by an older version are computed again
+ANALYSIS_VERSION = 2
+
+# Counts of each sheet of the analysis, the percentages are computed again from them
+PARTIAL_COUNTS = {
+    'Narrator Votes Stats': ['voted_by_all', 'voted_by_none', 'voted_by_someone', 'total_rounds'],
+    'Votes When Not Narrator': ['total_rounds', 'voted_rounds'],
+    'Correct Votes Stats': ['total_votes', 'correct_votes']
+}
+
+def content_hash(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def load_analysis_manifest(data_folder: str) -> Dict[str, Dict]:
+    path = os.path.join(data_folder, ANALYSIS_MANIFEST)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+def save_analysis_manifest(data_folder: str, manifest: Dict[str, Dict]) -> None:
+    path = os.path.join(data_folder, ANALYSIS_MANIFEST)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+def game_partials(path_to_game: str, stats: Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]) -> Dict:
+    partials = {}
+    for (sheet_name, count_cols), df in zip(PARTIAL_COUNTS.items(), stats):
+        partials[sheet_name] = {str(player): [int(x) for x in row] for player, row in zip(df.index, df[count_cols].values)}
+
+    winners = pd.read_excel(path_to_game, sheet_name="Winners")
+    partials["Winners"] = {str(player): int(winner) for player, winner in zip(winners["Player"], winners["Winner"])}
+    return partials
+
+# Same values of the analysis sheets (the percentages as computed by the calculate_* functions)
+def partials_to_stats(partials: Dict) -> Dict[str, pd.DataFrame]:
+    stats = {}
+    for sheet_name, count_cols in PARTIAL_COUNTS.items():
+        df = pd.DataFrame.from_dict(partials[sheet_name], orient="index", columns=count_cols)
+        total = df["total_rounds"] if sheet_name != 'Correct Votes Stats' else df["total_votes"]
+        if sheet_name == 'Narrator Votes Stats':
+            for col in ['voted_by_all', 'voted_by_none', 'voted_by_someone']:
+                df[f"percent_{col}"] = (df[col] / total) * 100
+        elif sheet_name == 'Votes When Not Narrator':
+            df["percent_voted_when_not_narrator"] = [(v / t) * 100 if t > 0 else 0 for v, t in zip(df["voted_rounds"], total)]
+        else:
+            df["percent_correct_votes_for_narrator"] = [(c / t) * 100 if t > 0 else 0 for c, t in zip(df["correct_votes"], total)]
+        stats[sheet_name] = df.rename_axis("Player").reset_index()
+    return stats
 
-    args = argument_parsing()
-    data_folder = args.data_folder
-    human_game = args.human
+def summarize_partials(path_to_save: str, games: List[Dict], human_game: bool) -> None:
+    stats = [partials_to_stats(partials) for partials in games]
+
+    with pd.ExcelWriter(os.path.join(path_to_save, "summarize.xlsx")) as writer:
+        for sheet_name, (summary_sheet, value_cols) in SUMMARY_SHEETS.items():
+            combined_data = pd.concat([game_stats[sheet_name] for game_stats in stats], ignore_index=True)
+            combine_averages(combined_data, value_cols, human_game).to_excel(writer, sheet_name=summary_sheet)
+
+        winner_frames = [pd.DataFrame(list(partials["Winners"].items()), columns=["Player", "Winner"]) for partials in games]
+        winners_stats(winner_frames, human_game).to_excel(writer, sheet_name='Winners Statistics', index=False)
+
+def incremental_analysis(data_folder: str, human_game: bool, force: bool) -> None:
+    manifest = {} if force else load_analysis_manifest(data_folder)
+    # Folders are keyed by their path relative to the data folder ("." for the data folder itself)
+    games: Dict[str, List[str]] = {}
+    changed_folders = set()
 
     for dir_path, _, filenames in os.walk(data_folder):
-        analysis_files = []
-        original_files = []
-        for file_name in filenames:
+        folder = os.path.normpath(os.path.relpath(dir_path, data_folder))
+        for file_name in sorted(filenames):
+            if not (file_name.endswith(".xlsx") and is_game_file(file_name)):
+                continue
             path_to_file = os.path.join(dir_path, file_name)
             path_to_save = os.path.join(dir_path, file_name[:-5] + "_analysis.xlsx")
+            key = os.path.relpath(path_to_file, data_folder)
+            games.setdefault(folder, []).append(key)
+
+            digest = content_hash(path_to_file)
+            if key in manifest and manifest[key]["hash"] == digest and manifest[key].get("version") == ANALYSIS_VERSION and os.path.exists(path_to_save):
+                continue
+
+            stats = create_analysis(path_to_file, path_to_save)
+            manifest[key] = {"hash": digest, "version": ANALYSIS_VERSION, "partials": game_partials(path_to_file, stats)}
+            changed_folders.add(folder)
+
+    # Games deleted since the last run, together with their analysis
+    found = set(key for keys in games.values() for key in keys)
+    for key in [key for key in manifest if key not in found]:
+        del manifest[key]
+        changed_folders.add(os.path.normpath(os.path.dirname(key)))
+        path_to_analysis = os.path.join(data_folder, key[:-5] + "_analysis.xlsx")
+        if os.path.exists(path_to_analysis):
+            os.remove(path_to_analysis)
+
+    for folder, keys in games.items():
+        dir_path = os.path.join(data_folder, folder)
+        if folder in changed_folders or not os.path.exists(os.path.join(dir_path, "summarize.xlsx")):
+            summarize_partials(dir_path, [manifest[key]["partials"] for key in keys], human_game)
+
+    # Folders whose games have all been deleted: their summary would still report them
+    for folder in changed_folders - set(games):
+        path_to_summary = os.path.join(data_folder, folder, "summarize.xlsx")
+        if os.path.exists(path_to_summary):
+            os.remove(path_to_summary)
+
+    save_analysis_manifest(data_folder, manifest)
+    print(f"{len(found)} games, {len(changed_folders)} folders updated")
+
+# ---------------------------------------------------------------------------
+# Vectorized analysis: all the games are normalized once in three long tables
+#   table:   one row per card on the table (Folder, Game, Round, Player, Narrator)
+#   votes:   one row per vote (Folder, Game, Round, Voter, Voted Player, Narrator)
+#   winners: one row per player (Folder, Game, Player, Winner)
+# and every statistic is a grouped operation over them.
+# ---------------------------------------------------------------------------
+
+VECTORIZED_OUTPUTS = ["player_stats.parquet", "summary_averages.parquet", "summary_winners.parquet"]
+
+def is_game_file(file_name: str) -> bool:
+    if file_name in VECTORIZED_OUTPUTS:
+        return False
+    if file_name.endswith((".jsonl", ".parquet")):
+        return True
+    return file_name.endswith(".xlsx") and not file_name.endswith("_analysis.xlsx") and file_name != "summarize.xlsx"
+
+# Game saved by create_data.py: only the needed sheets are read, with a single open of the file
+def read_excel_game(path_to_game: str) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    sheets = pd.read_excel(path_to_game, sheet_name=["Narrations", "Votes", "Winners"])
+    table = sheets["Votes"].merge(sheets["Narrations"][["Round", "Narrator"]], on="Round", how="left")[["Round", "Player", "Narrator", "Voted By"]]
+
+    voters = table[table["Voted By"] != "no one"].assign(Voter=lambda df: df["Voted By"].str.split(", ")).explode("Voter")
+    votes = pd.DataFrame({"Round": voters["Round"], "Voter": voters["Voter"].str.strip(), "Voted Player": voters["Player"], "Narrator": voters["Narrator"]})
+
+    return table.drop(columns="Voted By"), votes, sheets["Winners"][["Player", "Winner"]]
+
+# Event log written by the game (see game/events.py): the votes are already one per row
+def read_events_game(path_to_game: str) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    if path_to_game.endswith(".parquet"):
+        events = pd.read_parquet(path_to_game, columns=["round", "event", "player", "voted_player"])
+    else:
+        events = pd.read_json(path_to_game, lines=True)[["round", "event", "player", "voted_player"]]
+
+    narrators = events[events["event"] == "narration"].set_index("round")["player"]
+    cards = events[events["event"].isin(["selection", "narration"])]
+    table = pd.DataFrame({"Round": cards["round"], "Player": cards["player"], "Narrator": cards["round"].map(narrators)})
+
+    vote_events = events[events["event"] == "vote"]
+    votes = pd.DataFrame({"Round": vote_events["round"], "Voter": vote_events["player"], "Voted Player": vote_events["voted_player"], "Narrator": vote_events["round"].map(narrators)})
+
+    game_winners = set(events[events["event"] == "winner"]["player"])
+    players = table["Player"].unique()
+    winners = pd.DataFrame({"Player": players, "Winner": [int(player in game_winners) for player in players]})
+
+    return table, votes, winners
+
+def load_games(data_folder: str) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    tables, votes, winners = [], [], []
+    for dir_path, _, filenames in os.walk(data_folder):
+        for file_name in sorted(filenames):
+            if not is_game_file(file_name):
+                continue
+            path_to_game = os.path.join(dir_path, file_name)
+            read_game = read_excel_game if file_name.endswith(".xlsx") else read_events_game
+            game_table, game_votes, game_winners = read_game(path_to_game)
+
+            keys = {"Folder": os.path.relpath(dir_path, data_folder), "Game": os.path.relpath(path_to_game, data_folder)}
+            tables.append(game_table.assign(**keys))
+            votes.append(game_votes.assign(**keys))
+            winners.append(game_winners.assign(**keys))
+
+    return pd.concat(tables, ignore_index=True), pd.concat(votes, ignore_index=True), pd.concat(winners, ignore_index=True)
+
+def player_types(players: pd.Series, human_game: bool) -> pd.Series:
+    if human_game:
+        return pd.Series(np.where(players == "Artificial Player", "Artificial Player", "Human"), index=players.index)
+
+    is_gpt = players.str.match(r'^GPT Bot', case=False, na=False)
+    is_bot = players.str.match(r'^Bot(?!.*GPT)', case=False, na=False)
+    return pd.Series(np.select([is_gpt, is_bot], ["GPT", "Bot"], default=None), index=players.index)
+
+# Same statistics as create_analysis, for every (Folder, Game, Player) at once.
+# Players are matched by exact name, as in create_analysis.
+def compute_player_stats(table: pd.DataFrame, votes: pd.DataFrame) -> pd.DataFrame:
+    keys = ["Folder", "Game", "Player"]
+
+    received = votes.groupby(["Folder", "Game", "Round", "Voted Player"]).size().rename("votes")
+    table = table.join(received, on=["Folder", "Game", "Round", "Player"]).fillna({"votes": 0})
+    table["other_players"] = table.groupby(["Folder", "Game", "Round"])["Player"].transform("size") - 1
+    is_narrator = table["Player"] == table["Narrator"]
+
+    narrators = table[is_narrator]
+    narrator_stats = narrators.assign(
+        voted_by_all=narrators["votes"] == narrators["other_players"],
+        voted_by_none=narrators["votes"] == 0,
+        voted_by_someone=(narrators["votes"] != narrators["other_players"]) & (narrators["votes"] != 0)
+    ).groupby(keys).agg(voted_by_all=("voted_by_all", "sum"), voted_by_none=("voted_by_none", "sum"),
+                        voted_by_someone=("voted_by_someone", "sum"), total_rounds=("Round", "size"))
+    for col in ["voted_by_all", "voted_by_none", "voted_by_someone"]:
+        narrator_stats[f"percent_{col}"] = narrator_stats[col] / narrator_stats["total_rounds"] * 100
+
+    not_narrators = table[~is_narrator]
+    not_narrator_stats = not_narrators.assign(voted=not_narrators["votes"] > 0).groupby(keys).agg(
+        rounds_not_narrator=("Round", "size"), voted_rounds=("voted", "sum"))
+    not_narrator_stats["percent_voted_when_not_narrator"] = not_narrator_stats["voted_rounds"] / not_narrator_stats["rounds_not_narrator"] * 100
+
+    correct_stats = votes.assign(correct=votes["Voted Player"] == votes["Narrator"]).rename(columns={"Voter": "Player"}).groupby(keys).agg(
+        total_votes=("Round", "size"), correct_votes=("correct", "sum"))
+    correct_stats["percent_correct_votes_for_narrator"] = correct_stats["correct_votes"] / correct_stats["total_votes"] * 100
+
+    return narrator_stats.join([not_narrator_stats, correct_stats], how="outer").reset_index()
+
+# Average of the per game statistics of each player type (as compute_combined_averages) and percentage of games won (as compute_winners_stats)
+def compute_summary(player_stats: pd.DataFrame, winners: pd.DataFrame, human_game: bool) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    value_cols = ["percent_voted_by_all", "percent_voted_by_none", "percent_voted_by_someone", "percent_voted_when_not_narrator", "percent_correct_votes_for_narrator"]
+
+    averages = player_stats.assign(Type=player_types(player_stats["Player"], human_game)).dropna(subset=["Type"])
+    averages = averages.groupby(["Folder", "Type"])[value_cols].mean().reset_index()
+
+    winners = winners.assign(Type=player_types(winners["Player"], human_game)).dropna(subset=["Type"])
+    n_games = winners.groupby("Folder")["Game"].nunique()
+    win_stats = winners.groupby(["Folder", "Type"])["Winner"].sum().reset_index()
+    win_stats["Winner Percent"] = win_stats["Winner"] / win_stats["Folder"].map(n_games) * 100
+
+    return averages, win_stats.drop(columns="Winner")
+
+# Same layout of the summarize.xlsx produced by summarize
+def export_summary_excel(path_to_save: str, averages: pd.DataFrame, win_stats: pd.DataFrame, human_game: bool) -> None:
+    sheets = {
+        'Narrator Votes Averages': ['percent_voted_by_all', 'percent_voted_by_none', 'percent_voted_by_someone'],
+        'Votes Not Narrator Averages': ['percent_voted_when_not_narrator'],
+        'Correct Votes Averages': ['percent_correct_votes_for_narrator']
+    }
+    names = {"Artificial Player": "Artificial Player Average", "Human": "Human Average"} if human_game else {"GPT": "GPT Average", "Bot": "Bot Average"}
+
+    with pd.ExcelWriter(os.path.join(path_to_save, "summarize.xlsx")) as writer:
+        for sheet_name, value_cols in sheets.items():
+            sheet = averages.set_index("Type")[value_cols].T.rename(columns=names)
+            sheet.reindex(columns=list(names.values())).to_excel(writer, sheet_name=sheet_name)
+        win_stats = win_stats.set_index("Type").reindex(list(names)).fillna({"Winner Percent": 0}).rename_axis("Player").reset_index()
+        win_stats[["Player", "Winner Percent"]].to_excel(writer, sheet_name='Winners Statistics', index=False)
 
-            create_analysis(path_to_file, path_to_save)
-            analysis_files.append(path_to_save)
-            original_files.append(path_to_file)
+def vectorized_analysis(data_folder: str, human_game: bool, excel: bool) -> None:
+    table, votes, winners = load_games(data_folder)
 
-        if len(analysis_files) != 0:
-            summarize(dir_path, analysis_files, original_files, human_game)
+    player_stats = compute_player_stats(table, votes)
+    averages, win_stats = compute_summary(player_stats, winners, human_game)
 
-        
\ No newline at end of file
+    for df, file_name in zip([player_stats, averages, win_stats], VECTORIZED_OUTPUTS):
+        df.to_parquet(os.path.join(data_folder, file_name), index=False)
+
+    if excel:
+        for folder in averages["Folder"].unique():
+            export_summary_excel(os.path.join(data_folder, folder), averages[averages["Folder"] == folder],
+                                 win_stats[win_stats["Folder"] == folder], human_game)
+
+if __name__ == "__main__":
+
+    args = argument_parsing()
+    data_folder = args.data_folder
+    human_game = args.human
+
+    if args.vectorized:
+        vectorized_analysis(data_folder, human_game, args.excel)
+    else:
+        incremental_analysis(data_folder, human_game, args.force)
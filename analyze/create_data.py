@@ -1,8 +1,11 @@
 import os
+import json
 import argparse
+import multiprocessing
 from argparse import Namespace
-from typing import List, Tuple
+from typing import Dict, Iterator, List, Tuple
 import pandas as pd
+from openpyxl import Workbook
 import re
 
 def argument_parsing() -> Namespace:
@@ -10,6 +13,8 @@ def argument_parsing() -> Namespace:
 
     parser.add_argument("-src", "--src_folder", type=str, help="Specify the directory from which we want to take the data", required=True)
     parser.add_argument("-dst", "--dst_folder", type=str, help="Specify the directory to which we want to save the data", required=True)
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count(), help="Specify the number of worker processes")
+    parser.add_argument("--force", action="store_true", help="Specify to convert again the files already listed in the manifest")
 
     return parser.parse_args()
 
@@ -24,89 +29,182 @@ def create_directories(src_folder: str, dst_folder: str) -> List[Tuple[str, str]
         os.makedirs(dest_path, exist_ok=True)
 
         for filename in filenames:
-            if filename.endswith('.txt'):
+            if filename.endswith(('.txt', '.jsonl', '.parquet')):
                 source_file_path = os.path.join(dir_path, filename)
                 destination_file_path = os.path.join(dest_path, filename)
                 files.append((source_file_path, destination_file_path))
 
     return files
 
-def parse_data(path_to_game: str, path_to_save: str) -> None:
+PLAYER_LINE = re.compile(r'^[A-Za-z\s0-9]+ has the following cards:')
+VOTE_LINE = re.compile(r'^[A-Za-z\s0-9]+ with card \d+ has been voted by')
+POINTS_LINE = re.compile(r'^[A-Za-z\s0-9]+: \d+')
+CAPTION_LINE = re.compile(r'selected a card with caption: "(.*)"')
 
-    with open(path_to_game, "r") as f:
-        lines = f.readlines()
+# Single pass over the log, one line at a time (the file is never read whole).
+# Every record is yielded as soon as it is complete: ("card", round, player, card), ("narration", round, player, caption),
+# ("vote", round, player, card, voted_by), ("points", round, player, points) and, at the end, ("winner", player)
+def iter_records(lines: Iterator[str]) -> Iterator[Tuple]:
+    round_num = 0
+    state = "default"
+    narrator = None
+    last_block = [] # Lines after the last separator, the winners are announced there
 
-    players_cards = {}
-    narrations = []
-    votes = []
-    points = []
+    for line in lines:
+        if line.startswith("==================================="):
+            last_block = []
+            continue
+        if line.strip().endswith(" has won!"):
+            last_block.append(line.strip())
+
+        if state == "caption":
+            state = "default"
+            yield ("narration", round_num, narrator, CAPTION_LINE.search(line).group(1))
+            continue
+
+        if state == "points_header":
+            state = "points"
+            continue
+
+        if state == "points":
+            if POINTS_LINE.match(line):
+                player, score = line.split(": ")
+                yield ("points", round_num, player.strip(), int(score))
+                continue
+            state = "default"
 
-    round_num = 0
-    i = 0
-    while i < len(lines):
-        line = lines[i]
-            
         if "PLAYERS CARDS:" in line:
             round_num += 1
-            players_cards[round_num] = {}
-            i += 1
-            continue
-            
-        if re.match(r'^[A-Za-z\s0-9]+ has the following cards:', line):
-            player, cards = line.split(" has the following cards: ")
-            cards = cards.strip().strip('[]').split(", ")
-            players_cards[round_num][player.strip()] = cards
+
+        elif "POINTS" in line:
+            state = "points_header"
 
         elif "is giving a caption..." in line:
-            player = line.split(" is giving a caption...")[0].strip()
-            caption_line = lines[i + 1]
-            caption = re.search(r'selected a card with caption: "(.*)"', caption_line).group(1)
-            narrations.append((round_num, player, caption))
-            i += 1
+            narrator = line.split(" is giving a caption...")[0].strip()
+            state = "caption"
+
+        elif " has the following cards: " in line and PLAYER_LINE.match(line):
+            player, cards = line.split(" has the following cards: ")
+            for card in cards.strip().strip('[]').split(", "):
+                yield ("card", round_num, player.strip(), card)
 
-        elif re.match(r'^[A-Za-z\s0-9]+ with card \d+ has been voted by', line):
+        elif " has been voted by " in line and VOTE_LINE.match(line):
             details = line.split(' with card ')
-            player = details[0].strip()
             card_info, votes_info = details[1].split(' has been voted by ')
-            card_number = int(card_info.strip())
-            voted_by = votes_info.strip()
-            votes.append((round_num, player, card_number, voted_by))
+            yield ("vote", round_num, details[0].strip(), int(card_info.strip()), votes_info.strip())
+
+    for line in last_block:
+        yield ("winner", line.split(" has won!")[0])
+
+# Columns of the sheets of a game, in the order they are saved
+GAME_SHEETS = {
+    "Cards": ["Round", "Player", "Card"],
+    "Narrations": ["Round", "Narrator", "Caption"],
+    "Votes": ["Round", "Player", "Card", "Voted By"],
+    "Points": ["Round", "Player", "Points"],
+    "Winners": ["Player", "Winner"]
+}
+RECORD_SHEETS = {"card": "Cards", "narration": "Narrations", "vote": "Votes", "points": "Points"}
+
+# The records are written to the sheets as they are parsed (a write-only workbook keeps its rows in temporary files),
+# so the memory used does not grow with the length of the log: only the names of the players are kept, for the Winners sheet
+def parse_data(path_to_game: str, path_to_save: str) -> None:
+    workbook = Workbook(write_only=True)
+    sheets = {name: workbook.create_sheet(name) for name in GAME_SHEETS}
+    for name, columns in GAME_SHEETS.items():
+        sheets[name].append(columns)
 
-        elif "POINTS" in line:
-            i += 2  # Move to the next line after "POINTS"
-            while i < len(lines) and re.match(r'^[A-Za-z\s0-9]+: \d+', lines[i]):
-                player, score = lines[i].split(": ")
-                points.append((round_num, player.strip(), int(score)))
-                i += 1
-            continue  
+    players, winners = {}, set()
+    with open(path_to_game, "r") as f:
+        for record in iter_records(f):
+            if record[0] == "winner":
+                winners.add(record[1])
+                continue
+            sheets[RECORD_SHEETS[record[0]]].append(list(record[1:]))
+            if record[0] == "vote":
+                players[record[2]] = None
 
-        i += 1 
+    for player in players:
+        sheets["Winners"].append([player, 1 if player in winners else 0])
 
-    winners = ("").join(lines).split("===================================")[-1].strip()
-    winners = winners.split("\n")
-    winners = [line.split(" has won!")[0] for line in winners]
-    players = set([x[1] for x in votes])
+    workbook.save(os.path.splitext(path_to_save)[0] + ".xlsx")
 
-    win_stats = []
-    for player in players:
-        if player in winners:
-            win_stats.append((player, 1))
-        else:
-            win_stats.append((player, 0))
-
-    cards_df = pd.DataFrame([(rnd, ply, card) for rnd, ply_cards in players_cards.items() for ply, cards in ply_cards.items() for card in cards], columns=['Round', 'Player', 'Card'])
-    narrations_df = pd.DataFrame(narrations, columns=['Round', 'Narrator', 'Caption'])
-    votes_df = pd.DataFrame(votes, columns=['Round', 'Player', 'Card', 'Voted By'])
-    points_df = pd.DataFrame(points, columns=['Round', 'Player', 'Points'])
-    win_df = pd.DataFrame(win_stats, columns=['Player', 'Winner'])
-
-    with pd.ExcelWriter(path_to_save[:-4] + ".xlsx") as writer:
+def save_game(path_to_save: str, cards_df: pd.DataFrame, narrations_df: pd.DataFrame, votes_df: pd.DataFrame, points_df: pd.DataFrame, win_df: pd.DataFrame) -> None:
+    with pd.ExcelWriter(path_to_save) as writer:
         cards_df.to_excel(writer, sheet_name='Cards', index=False)
         narrations_df.to_excel(writer, sheet_name='Narrations', index=False)
         votes_df.to_excel(writer, sheet_name='Votes', index=False)
         points_df.to_excel(writer, sheet_name='Points', index=False)
         win_df.to_excel(writer, sheet_name='Winners', index=False)
 
+# Event logs written by the game (see game/events.py), no text parsing needed.
+# A file with more than one game produces one .xlsx per game
+def parse_events(path_to_events: str, path_to_save: str) -> None:
+    if path_to_events.endswith(".parquet"):
+        events_df = pd.read_parquet(path_to_events)
+    else:
+        events_df = pd.read_json(path_to_events, lines=True, dtype={"game": str})
+
+    games = events_df["game"].unique()
+    for game in games:
+        game_df = events_df[events_df["game"] == game]
+        by_event = {event: df for event, df in game_df.groupby("event", sort=False)}
+        empty = pd.DataFrame(columns=game_df.columns)
+
+        hands_df = by_event.get("hand", empty).explode("cards")
+        cards_df = pd.DataFrame({"Round": hands_df["round"], "Player": hands_df["player"], "Card": hands_df["cards"]})
+
+        narrations = by_event.get("narration", empty)
+        narrations_df = pd.DataFrame({"Round": narrations["round"], "Narrator": narrations["player"], "Caption": narrations["caption"]})
+
+        # Cards on the table: the ones selected plus the narrator one, in the same order used by the game
+        table_df = pd.concat([by_event.get("selection", empty), narrations])[["round", "player", "card"]]
+        votes = by_event.get("vote", empty)
+        voted_by = votes.groupby(["round", "voted_player"], sort=False)["player"].agg(", ".join)
+        seats = {player: seat for seat, player in enumerate(hands_df["player"].unique())}
+        votes_df = pd.DataFrame({
+            "Round": table_df["round"],
+            "Player": table_df["player"],
+            "Card": table_df["card"].astype(int),
+            "Voted By": [voted_by.get((rnd, player), "no one") for rnd, player in zip(table_df["round"], table_df["player"])],
+            "Seat": table_df["player"].map(seats)
+        }).sort_values(["Round", "Seat"]).drop(columns="Seat")
+
+        scores = by_event.get("score", empty)
+        points_df = pd.DataFrame({"Round": scores["round"], "Player": scores["player"], "Points": scores["points"].astype(int)})
+
+        winners = set(by_event.get("winner", empty)["player"])
+        win_df = pd.DataFrame([(player, int(player in winners)) for player in votes_df["Player"].unique()], columns=['Player', 'Winner'])
+
+        stem = os.path.splitext(path_to_save)[0]
+        save_game(stem + ".xlsx" if len(games) == 1 else f"{stem}_{game}.xlsx", cards_df, narrations_df, votes_df, points_df, win_df)
+
+MANIFEST = "manifest.json"
+
+# Files already converted, saved in the destination folder: a source is skipped while its size and modification time do not change
+def load_manifest(dst_folder: str) -> Dict[str, List[int]]:
+    path = os.path.join(dst_folder, MANIFEST)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+def save_manifest(dst_folder: str, manifest: Dict[str, List[int]]) -> None:
+    path = os.path.join(dst_folder, MANIFEST)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+def file_stamp(path: str) -> List[int]:
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def convert_file(file: Tuple[str, str]) -> Tuple[str, str]:
+    if file[0].endswith('.txt'):
+        parse_data(file[0], file[1])
+    else:
+        parse_events(file[0], file[1])
+    return file
 
 if __name__ == "__main__":
 
@@ -116,6 +214,14 @@ if __name__ == "__main__":
     dst_folder = args.dst_folder
 
     files = create_directories(src_folder, dst_folder)
-    
-    for file in files:
-        parse_data(file[0], file[1])
\ No newline at end of file
+
+    manifest = {} if args.force else load_manifest(dst_folder)
+    stamps = {file[0]: file_stamp(file[0]) for file in files}
+    todo = [file for file in files if manifest.get(os.path.relpath(file[0], src_folder)) != stamps[file[0]]]
+    print(f"{len(files) - len(todo)} files already converted, {len(todo)} to convert")
+
+    # The manifest is updated after every file, so an interrupted run resumes where it stopped
+    with multiprocessing.Pool(max(1, min(args.workers, len(todo)))) as pool:
+        for source, _ in pool.imap_unordered(convert_file, todo):
+            manifest[os.path.relpath(source, src_folder)] = stamps[source]
+            save_manifest(dst_folder, manifest)
@@ -0,0 +1,153 @@
+import os
+import sys
+import json
+import time
+import random
+import platform
+import argparse
+from argparse import Namespace
+from typing import Callable, Dict, List, Optional, Tuple
+
+from card import Card
+from game import Game
+from player import Player
+from instrumentation import current_rss_bytes, enable_profiling, peak_rss_bytes
+
+# Startup, per phase latency, games/hour and memory of whole games, with the stub players below (cost of the engine alone)
+# and with the real BLIP/CLIP bots. The results are saved as JSON, to be compared between versions.
+
+def argument_parsing() -> Namespace:
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--players", type=str, nargs="+", choices=["stub", "real"], default=["stub"], help="Specify the kind of players to benchmark")
+    parser.add_argument("-np", "--n_players", type=int, nargs="+", default=[3, 5, 6], help="Specify the numbers of players")
+    parser.add_argument("--decks", type=str, nargs="+", default=["../cards/odissey_cards"], help="Specify the directories of the decks")
+    parser.add_argument("-g", "--games", type=int, default=5, help="Specify the number of games played for each configuration")
+    parser.add_argument("--points_to_win", type=int, default=30, help="Specify the number of points to win")
+    parser.add_argument("--seed", type=int, default=0, help="Specify the seed of the first game of each configuration")
+    parser.add_argument("--blip_weights", type=str, default="../weights/rephrased_blip(2nd)/epoch50.pt", help="Specify the fine tuned BLIP weights")
+    parser.add_argument("--clip_weights", type=str, default="../weights/rephrased_coco_clip(2nd)/epoch13.pt", help="Specify the fine tuned CLIP weights")
+    parser.add_argument("--profile", type=str, default=None, help="Specify a path prefix to enable the instrumentation, saved as <prefix>.prom (Prometheus) and <prefix>.json")
+    parser.add_argument("--label", type=str, default=None, help="Specify a label saved with the results (e.g. the version benchmarked)")
+    parser.add_argument("-o", "--output", type=str, default="benchmark.json", help="Specify the JSON file where the results are saved")
+
+    return parser.parse_args()
+
+# Plays random cards with a fixed caption and votes at random: no model, only the cost of the game itself
+class StubPlayer(Player):
+
+    def get_card_and_caption(self) -> Tuple[Card, str]:
+        card = random.choice(self.cards_in_hand)
+        self.cards_in_hand.remove(card)
+        return card, "a stub caption"
+
+    def select_card_from_caption(self, caption: str) -> Card:
+        card = random.choice(self.cards_in_hand)
+        self.cards_in_hand.remove(card)
+        return card
+
+    def get_most_likely_card(self, cards_on_table: List[Tuple[Player, Card]], caption: str) -> Player:
+        return random.choice(cards_on_table)[0]
+
+def benchmark_games(make_game: Callable[[], Game], games: int, seed: int) -> Dict:
+    startup, durations, rounds = [], [], []
+    phases: Dict[str, float] = {}
+
+    for k in range(games):
+        random.seed(seed + k)
+
+        start = time.perf_counter()
+        game = make_game()
+        startup.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        game.simulate()
+        durations.append(time.perf_counter() - start)
+        rounds.append(game.rounds_played)
+
+        for phase, seconds in game.phase_seconds.items():
+            phases[phase] = phases.get(phase, 0.0) + seconds
+
+    total_rounds = sum(rounds)
+    return {
+        "games": games,
+        "startup_seconds": sum(startup) / games,
+        "game_seconds": sum(durations) / games,
+        "games_per_hour": 3600 * games / sum(durations),
+        "rounds_per_game": total_rounds / games,
+        "round_ms": 1000 * sum(durations) / total_rounds,
+        "phase_ms_per_round": {phase: 1000 * seconds / total_rounds for phase, seconds in phases.items()},
+        # The peak is the high-water mark of the whole process, so it includes the configurations run before this one
+        "rss_mb": current_rss_bytes() / 2**20 if current_rss_bytes() is not None else None,
+        "cumulative_peak_rss_mb": peak_rss_bytes() / 2**20
+    }
+
+def run_benchmarks(args: Namespace) -> List[Dict]:
+    results = []
+    models = None
+
+    for kind in args.players:
+        model_load_seconds = None
+        if kind == "real" and models is None:
+            from models import device_name, load_models
+            from card_index import CardIndex
+            from clip_features import clear_text_caches, text_cache_stats
+
+            start = time.perf_counter()
+            models = load_models(args.blip_weights, args.clip_weights, device_name())
+            model_load_seconds = time.perf_counter() - start
+
+        for deck in args.decks:
+            # Built once per deck, as the tournament and the server do, so that the games do not hash the whole deck again
+            card_index = None
+            card_index_seconds = None
+            if kind == "real":
+                start = time.perf_counter()
+                card_index = CardIndex.load_or_build(deck, models.clip_weights, models.clip_model, models.clip_processor, device_name())
+                card_index_seconds = time.perf_counter() - start
+
+            for n_players in args.n_players:
+                # Each configuration starts with empty caption caches
+                if kind == "real":
+                    clear_text_caches()
+
+                def make_game() -> Game:
+                    if kind == "stub":
+                        return Game(n_players, 0, deck, False, args.points_to_win, False, verbose=False, player_factory=StubPlayer)
+                    return Game(n_players, 0, deck, False, args.points_to_win, False, models=models, card_index=card_index, verbose=False)
+
+                result = {"players": kind, "deck": deck, "n_players": n_players, **benchmark_games(make_game, args.games, args.seed)}
+                if model_load_seconds is not None:
+                    result["model_load_seconds"] = model_load_seconds
+                if card_index_seconds is not None:
+                    result["card_index_seconds"] = card_index_seconds
+                if kind == "real":
+                    result["text_cache"] = text_cache_stats()
+                results.append(result)
+
+                print(f"{kind} {os.path.basename(os.path.normpath(deck))} {n_players} players: {result['games_per_hour']:.0f} games/hour, "
+                      f"{result['round_ms']:.2f} ms/round ({', '.join(f'{phase} {ms:.2f}' for phase, ms in result['phase_ms_per_round'].items())}), "
+                      f"startup {result['startup_seconds'] * 1000:.1f} ms, peak RSS so far {result['cumulative_peak_rss_mb']:.0f} MiB")
+
+    return results
+
+def environment(label: Optional[str]) -> Dict:
+    info = {"label": label, "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()}
+    if "torch" in sys.modules:
+        info["torch"] = sys.modules["torch"].__version__
+    return info
+
+if __name__ == "__main__":
+
+    args = argument_parsing()
+    profiler = enable_profiling() if args.profile is not None else None
+
+    results = run_benchmarks(args)
+
+    with open(args.output, "w") as f:
+        json.dump({"environment": environment(args.label), "results": results}, f, indent=1)
+    print(f"Results saved in {args.output}")
+
+    if profiler is not None:
+        profiler.save(args.profile)
+        print(f"Instrumentation saved in {args.profile}.prom and {args.profile}.json")
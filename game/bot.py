@@ -1,15 +1,23 @@
-from typing import List, Tuple
+from typing import TYPE_CHECKING, List, Optional, Tuple
 import random
 import torch
 
-from transformers import BlipModel, BlipProcessor, CLIPModel, CLIPProcessor
-
 from player import Player
 from card import Card
+from card_index import CardIndex
+from caption_bank import CaptionBank
+from captioning import NarratorOptions, caption_images
+from clip_features import cache_text_embeddings, caption_logits, encode_images, encode_text_cached
+from inference_server import InferenceServer
+from instrumentation import profiled
+
+if TYPE_CHECKING:
+    from transformers import BlipModel, BlipProcessor, CLIPModel, CLIPProcessor
 
 class Bot(Player):
-    
-    def __init__(self, player_name: str, points_to_win: int, blip_model: BlipModel, blip_processor: BlipProcessor, clip_model: CLIPModel, clip_processor: CLIPProcessor):
+    model_backed = True
+
+    def __init__(self, player_name: str, points_to_win: int, blip_model: "BlipModel", blip_processor: "BlipProcessor", clip_model: "CLIPModel", clip_processor: "CLIPProcessor", card_index: Optional[CardIndex] = None, inference: Optional[InferenceServer] = None, narrator: NarratorOptions = NarratorOptions(), caption_bank: Optional[CaptionBank] = None):
         super().__init__(player_name, points_to_win)
 
         self.blip_model = blip_model
@@ -17,58 +25,119 @@ class Bot(Player):
 
         self.clip_model = clip_model
         self.clip_processor = clip_processor
+        self.card_index = card_index
+
+        # When set, the forward passes are batched together with the ones of the other bots using the same server
+        self.inference = inference
+        self.narrator = narrator
+        self.caption_bank = caption_bank
 
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
 
+    @profiled
     def get_card_and_caption(self) -> Tuple[Card, str]:
-        print(f"{self.player_name} is giving a caption...")
-        card_to_play = random.choice(self.cards_in_hand)
-        inputs = self.blip_processor(card_to_play.image, return_tensors="pt").to(self.device)
-
-        with torch.no_grad():
-            caption_ids = self.blip_model.generate(
-                **inputs,
-                max_length=50, 
-                num_return_sequences=1,
-                do_sample=True,
-                top_k=50,      
-                top_p=0.95,    
-                temperature=0.7,
-                repetition_penalty=1.2, 
-                no_repeat_ngram_size=3 
-            )
-
-        caption = self.blip_processor.decode(caption_ids[0], skip_special_tokens=True)
-        print(f"{self.player_name} selected a card with caption: \"{caption}\"")
+        self.log(f"{self.player_name} is giving a caption...")
+        if self.narrator.candidates > 1:
+            card_to_play, caption = self.choose_card_and_caption()
+        else:
+            card_to_play = random.choice(self.cards_in_hand)
+            caption = self.caption_card(card_to_play)
+        self.log(f"{self.player_name} selected a card with caption: \"{caption}\"")
 
         self.cards_in_hand.remove(card_to_play)
         return card_to_play, caption
 
+    # Sampled from the caption bank when the card is in it, generated live otherwise
+    def caption_card(self, card: Card) -> str:
+        if self.caption_bank is not None and card in self.caption_bank:
+            # The stored embedding is shared with the other bots, which score the caption without running the text tower
+            caption, text_embeds = self.caption_bank.sample(card)
+            cache_text_embeddings(self.clip_model, [caption], text_embeds)
+            return caption
+        if self.inference is not None:
+            return self.inference.caption(card.pixels, self.narrator.max_time)
+        return caption_images(self.blip_model, self.blip_processor, [card.pixels], self.device, max_time=self.narrator.max_time)[0]
+
+    # All the candidate captions of the hand come from a single generate call (or from the caption bank, with their text embeddings)
+    # and are scored against the whole hand in one matrix product.
+    # The hand stands in for the table: the pair chosen is the one whose card gets the probability closest to narrator.target,
+    # so that it is likely to be found by some players but not by all of them
+    @profiled
+    def choose_card_and_caption(self) -> Tuple[Card, str]:
+        cards = list(self.cards_in_hand)
+        if self.caption_bank is not None and all(card in self.caption_bank for card in cards):
+            captions, text_embeds = self.caption_bank.candidates(cards)
+            owners = [k for k, card in enumerate(cards) for _ in self.caption_bank.captions[card.image_number]]
+        else:
+            captions = caption_images(self.blip_model, self.blip_processor, [card.pixels for card in cards], self.device, self.narrator.candidates, self.narrator.max_time)
+            # The chosen caption stays in the cache, so the other bots do not encode it again
+            text_embeds = encode_text_cached(self.clip_model, self.clip_processor, captions, self.device)
+            owners = [k for k in range(len(cards)) for _ in range(self.narrator.candidates)]
+
+        if self.card_index is not None:
+            image_embeds = self.card_index.embeddings_for(cards)
+        else:
+            image_embeds = encode_images(self.clip_model, self.clip_processor, [card.pixels for card in cards], self.device)
+
+        # (cards, captions): for each caption, the probability of every card of the hand
+        probs = caption_logits(self.clip_model, text_embeds, image_embeds).softmax(dim=0)
+        columns = torch.arange(len(captions), device=probs.device)
+        owners = torch.tensor(owners, device=probs.device)
+        distance = (probs[owners, columns] - self.narrator.target).abs()
+
+        # Captions cut to nothing by the time budget are never chosen
+        empty = torch.tensor([len(caption.strip()) == 0 for caption in captions], device=probs.device)
+        best = distance.masked_fill(empty, float("inf")).argmin().item()
+
+        # The chosen caption is scored by the other bots with its embedding (already cached when the captions were generated live)
+        cache_text_embeddings(self.clip_model, [captions[best]], text_embeds[best:best + 1])
+        return cards[owners[best].item()], captions[best]
+
+    @profiled
     def select_card_from_caption(self, caption: str) -> Card:
-        print(f"{self.player_name} is selecting a card...")
-        inputs = self.clip_processor(text=caption, images=[card.image for card in self.cards_in_hand], return_tensors="pt", padding="max_length", truncation=True).to(self.device)
-
-        with torch.no_grad():
-            outputs = self.clip_model(**inputs)
-        
-        logits_per_image = outputs.logits_per_image
+        return self.select_card_from_scores(self.score_cards(caption, self.cards_in_hand))
 
+    # Same selection as select_card_from_caption, starting from the scores of the hand (computed together with the hands of the other bots)
+    @profiled
+    def select_card_from_scores(self, logits_per_image: torch.Tensor) -> Card:
+        self.log(f"{self.player_name} is selecting a card...")
         probs_per_image = logits_per_image.softmax(dim=0).squeeze()
         max_score_idx = torch.argmax(probs_per_image).item()
         card = self.cards_in_hand[max_score_idx]
         self.cards_in_hand.remove(card)
         return card
 
+    @profiled
     def get_most_likely_card(self, cards_on_table: List[Tuple[Player, Card]], caption: str) -> Player:
-        print(f"{self.player_name} is voting...")
-        inputs = self.clip_processor(text=caption, images=[player_card[1].image for player_card in cards_on_table], return_tensors="pt", padding="max_length", truncation=True).to(self.device)
+        self.log(f"{self.player_name} is voting...")
+        logits_per_image = self.score_cards(caption, [player_card[1] for player_card in cards_on_table])
+
+        probs_per_image = logits_per_image.softmax(dim=0).squeeze()
+        max_score_idx = torch.argmax(probs_per_image).item()
+        return cards_on_table[max_score_idx][0]
 
-        with torch.no_grad():
-            outputs = self.clip_model(**inputs)
-        
-        logits_per_image = outputs.logits_per_image
+    # Same vote as get_most_likely_card, but starting from the scores of the whole table (own card included, computed once for all the voters)
+    @profiled
+    def get_most_likely_card_from_scores(self, cards_on_table: List[Tuple[Player, Card]], logits_per_image: torch.Tensor) -> Player:
+        self.log(f"{self.player_name} is voting...")
+        own_card = torch.tensor([[player == self] for player, _ in cards_on_table], device=logits_per_image.device)
+        logits_per_image = logits_per_image.masked_fill(own_card, float("-inf"))
 
         probs_per_image = logits_per_image.softmax(dim=0).squeeze()
         max_score_idx = torch.argmax(probs_per_image).item()
         return cards_on_table[max_score_idx][0]
 
+    # Only the text tower runs here when the card index is available, the images were encoded when building it
+    def score_cards(self, caption: str, cards: List[Card]) -> torch.Tensor:
+        if self.inference is not None:
+            return self.inference.score(caption, cards)
+
+        # Shared with the other bots: the caption is encoded once per round, not once per bot
+        text_embeds = encode_text_cached(self.clip_model, self.clip_processor, [caption], self.device)
+
+        if self.card_index is not None:
+            image_embeds = self.card_index.embeddings_for(cards)
+        else:
+            image_embeds = encode_images(self.clip_model, self.clip_processor, [card.pixels for card in cards], self.device)
+
+        return caption_logits(self.clip_model, text_embeds, image_embeds)
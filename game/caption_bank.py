@@ -0,0 +1,123 @@
+import os
+import random
+import hashlib
+import argparse
+from argparse import Namespace
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+import torch
+
+from card import Card
+from card_index import deck_hashes, weights_hash
+from card_store import load_deck
+from captioning import caption_images
+from clip_features import encode_text
+
+if TYPE_CHECKING:
+    from models import Models
+
+def argument_parsing() -> Namespace:
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-d", "--decks", type=str, nargs="+", default=None, help="Specify the directories of the decks (default: every deck inside ../cards)")
+    parser.add_argument("-k", "--captions_per_card", type=int, default=10, help="Specify the number of captions generated for each card")
+    parser.add_argument("--batch_size", type=int, default=16, help="Specify the number of cards captioned at the same time")
+    parser.add_argument("--blip_weights", type=str, default="../weights/rephrased_blip(2nd)/epoch50.pt", help="Specify the fine tuned BLIP weights")
+    parser.add_argument("--clip_weights", type=str, default="../weights/rephrased_coco_clip(2nd)/epoch13.pt", help="Specify the fine tuned CLIP weights")
+
+    return parser.parse_args()
+
+# Captions sampled offline by BLIP for every card of a deck, with their CLIP text embeddings (stored as float16).
+# The bank is saved next to the deck directory (e.g. cards/odissey_cards.<weights hash>.caption_bank.pt), the hash covers both
+# the BLIP and the CLIP weights, and it is only used if the hashes of the cards and of the weights match the stored ones.
+class CaptionBank():
+
+    def __init__(self, captions: Dict[int, List[str]], text_embeddings: Dict[int, torch.Tensor], card_hashes: Dict[int, str], weights_hash: str):
+        self.captions = captions
+        self.text_embeddings = text_embeddings
+        self.card_hashes = card_hashes
+        self.weights_hash = weights_hash
+
+    def __contains__(self, card: Card) -> bool:
+        return card.image_number in self.captions
+
+    # A random caption of the card, with its normalized text embedding
+    def sample(self, card: Card) -> Tuple[str, torch.Tensor]:
+        k = random.randrange(len(self.captions[card.image_number]))
+        return self.captions[card.image_number][k], self.text_embeddings[card.image_number][k:k + 1].float()
+
+    # All the captions of the cards, grouped by card (same order of caption_images)
+    def candidates(self, cards: List[Card]) -> Tuple[List[str], torch.Tensor]:
+        captions = [caption for card in cards for caption in self.captions[card.image_number]]
+        return captions, torch.cat([self.text_embeddings[card.image_number] for card in cards]).float()
+
+    def to(self, device: str) -> "CaptionBank":
+        self.text_embeddings = {image_number: embeddings.to(device) for image_number, embeddings in self.text_embeddings.items()}
+        return self
+
+    def save(self, path_to_bank: str) -> None:
+        torch.save({
+            "captions": self.captions,
+            "text_embeddings": {image_number: embeddings.cpu() for image_number, embeddings in self.text_embeddings.items()},
+            "card_hashes": self.card_hashes,
+            "weights_hash": self.weights_hash
+        }, path_to_bank)
+
+    @staticmethod
+    def models_hash(path_to_blip_weights: str, path_to_clip_weights: str) -> str:
+        return hashlib.sha256((weights_hash(path_to_blip_weights) + weights_hash(path_to_clip_weights)).encode()).hexdigest()
+
+    @staticmethod
+    def bank_path(path_to_images: str, models_hash: str) -> str:
+        deck_dir = os.path.normpath(path_to_images)
+        return f"{deck_dir}.{models_hash[:16]}.caption_bank.pt"
+
+    @classmethod
+    def load(cls, path_to_bank: str) -> "CaptionBank":
+        data = torch.load(path_to_bank, map_location="cpu")
+        return cls(data["captions"], data["text_embeddings"], data["card_hashes"], data["weights_hash"])
+
+    @classmethod
+    def build(cls, path_to_images: str, models: "Models", device: str, captions_per_card: int, batch_size: int = 16) -> "CaptionBank":
+        cards = load_deck(path_to_images)
+        captions, text_embeddings = {}, {}
+
+        for start in range(0, len(cards), batch_size):
+            batch = cards[start:start + batch_size]
+            batch_captions = caption_images(models.blip_model, models.blip_processor, [card.pixels for card in batch], device, captions_per_card)
+            batch_embeddings = encode_text(models.clip_model, models.clip_processor, batch_captions, device).half().cpu()
+
+            for k, card in enumerate(batch):
+                captions[card.image_number] = batch_captions[k * captions_per_card:(k + 1) * captions_per_card]
+                text_embeddings[card.image_number] = batch_embeddings[k * captions_per_card:(k + 1) * captions_per_card]
+
+        return cls(captions, text_embeddings, deck_hashes(path_to_images), cls.models_hash(models.blip_weights, models.clip_weights))
+
+    # None when the bank has not been built (or is out of date): the bots then generate their captions live
+    @classmethod
+    def find(cls, path_to_images: str, path_to_blip_weights: str, path_to_clip_weights: str, device: str) -> Optional["CaptionBank"]:
+        models_hash = cls.models_hash(path_to_blip_weights, path_to_clip_weights)
+        path_to_bank = cls.bank_path(path_to_images, models_hash)
+        if not os.path.exists(path_to_bank):
+            return None
+
+        bank = cls.load(path_to_bank)
+        if bank.weights_hash != models_hash or bank.card_hashes != deck_hashes(path_to_images):
+            return None
+        return bank.to(device)
+
+if __name__ == "__main__":
+    from models import device_name, load_models
+
+    args = argument_parsing()
+    decks = args.decks if args.decks is not None else [os.path.join("../cards", deck) for deck in sorted(os.listdir("../cards")) if os.path.isdir(os.path.join("../cards", deck))]
+
+    device = device_name()
+    print("Loading models...")
+    models = load_models(args.blip_weights, args.clip_weights, device)
+
+    for deck in decks:
+        print(f"Captioning {deck}...")
+        bank = CaptionBank.build(deck, models, device, args.captions_per_card, args.batch_size)
+        path_to_bank = CaptionBank.bank_path(deck, bank.weights_hash)
+        bank.save(path_to_bank)
+        print(f"{sum(len(captions) for captions in bank.captions.values())} captions saved in {path_to_bank}")
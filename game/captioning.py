@@ -0,0 +1,40 @@
+from typing import TYPE_CHECKING, List, NamedTuple, Optional
+import numpy as np
+
+from instrumentation import timer
+
+# torch is imported only when captions are generated, so that the options can be imported without it
+if TYPE_CHECKING:
+    from transformers import BlipForConditionalGeneration, BlipProcessor
+
+CAPTION_GENERATION_KWARGS = {
+    "max_length": 50,
+    "do_sample": True,
+    "top_k": 50,
+    "top_p": 0.95,
+    "temperature": 0.7,
+    "repetition_penalty": 1.2,
+    "no_repeat_ngram_size": 3
+}
+
+# How the bots narrate: with candidates > 1 every card of the hand gets that many captions and the pair to play is chosen
+# with CLIP (see Bot.choose_card_and_caption), otherwise a random card gets a single caption
+class NarratorOptions(NamedTuple):
+    candidates: int = 1
+    target: float = 0.5 # Probability of the narrator card (against the rest of the hand) the chosen caption should get
+    max_time: Optional[float] = None # Time budget (in seconds) of the caption generation
+    use_bank: bool = False # Take the captions from the precomputed caption bank of the deck (see caption_bank.py) instead of generating them
+
+# Returns num_return_sequences captions per image, grouped by image.
+# With max_time the generation stops when the time is over, returning the captions as they are at that point
+def caption_images(blip_model: "BlipForConditionalGeneration", blip_processor: "BlipProcessor", images: List[np.ndarray], device: str, num_return_sequences: int = 1, max_time: Optional[float] = None) -> List[str]:
+    import torch
+
+    with timer("blip.image_preprocessing"):
+        inputs = blip_processor(images, return_tensors="pt").to(device)
+    kwargs = dict(CAPTION_GENERATION_KWARGS, max_time=max_time) if max_time is not None else CAPTION_GENERATION_KWARGS
+
+    with timer("blip.generate"), torch.no_grad():
+        caption_ids = blip_model.generate(**inputs, num_return_sequences=num_return_sequences, **kwargs)
+
+    return blip_processor.batch_decode(caption_ids, skip_special_tokens=True)
@@ -1,9 +1,35 @@
+import os
+import re
+import numpy as np
 from PIL import Image
 
 class Card():
-    def __init__(self, image_number: int, image: Image.Image):
+    __slots__ = ("image_number", "pixels")
+
+    # pixels is a 224x224x3 uint8 array, usually a view into the memory mapped deck (see card_store.py)
+    def __init__(self, image_number: int, pixels: np.ndarray):
         self.image_number = image_number
-        self.image = image
+        self.pixels = pixels
+
+    # A card is identified by its number
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, Card) and self.image_number == other.image_number
+
+    def __hash__(self) -> int:
+        return self.image_number
+
+    # Decoded only when needed (human or GPT players), the bots work directly on the pixels
+    @property
+    def image(self) -> Image.Image:
+        return Image.fromarray(np.asarray(self.pixels))
 
     def __repr__(self) -> str:
         return str(self.image_number)
+
+# Card files are named after their number (e.g. "12.jpg", "card_00012.jpg")
+def card_number_from_file(image_name: str) -> int:
+    return int(re.sub(r"\D", "", os.path.splitext(image_name)[0]))
+
+def load_card_image(path_to_image: str) -> Image.Image:
+    image = Image.open(path_to_image).convert("RGB")
+    return image.resize((224,224))
@@ -0,0 +1,98 @@
+import os
+import hashlib
+from typing import TYPE_CHECKING, Dict, List
+import numpy as np
+import torch
+
+from card import Card, card_number_from_file, load_card_image
+from clip_features import encode_images
+
+if TYPE_CHECKING:
+    from transformers import CLIPModel, CLIPProcessor
+
+_weights_hashes: Dict[tuple, str] = {}
+
+def file_hash(path: str) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+# The weights files are big, so their hash is computed once per process
+def weights_hash(path_to_weights: str) -> str:
+    stat = os.stat(path_to_weights)
+    key = (os.path.abspath(path_to_weights), stat.st_size, stat.st_mtime_ns)
+    if key not in _weights_hashes:
+        _weights_hashes[key] = file_hash(path_to_weights)
+    return _weights_hashes[key]
+
+def deck_hashes(path_to_images: str) -> Dict[int, str]:
+    return {card_number_from_file(image_name): file_hash(os.path.join(path_to_images, image_name)) for image_name in sorted(os.listdir(path_to_images))}
+
+
+# CLIP image embeddings of a whole deck, computed once for a given set of CLIP weights.
+# The index is saved next to the deck directory (e.g. cards/odissey_cards.<weights hash>.clip_index.pt)
+# and it is rebuilt whenever the hash of a card or of the weights does not match the stored one.
+class CardIndex():
+
+    def __init__(self, image_numbers: List[int], embeddings: torch.Tensor, card_hashes: Dict[int, str], clip_weights_hash: str):
+        self.image_numbers = image_numbers
+        self.embeddings = embeddings
+        self.card_hashes = card_hashes
+        self.clip_weights_hash = clip_weights_hash
+
+        self.positions = {image_number: position for position, image_number in enumerate(image_numbers)}
+
+    def embeddings_for(self, cards: List[Card]) -> torch.Tensor:
+        rows = torch.tensor([self.positions[card.image_number] for card in cards], device=self.embeddings.device)
+        return self.embeddings.index_select(0, rows)
+
+    def to(self, device: str) -> "CardIndex":
+        self.embeddings = self.embeddings.to(device)
+        return self
+
+    def save(self, path_to_index: str) -> None:
+        torch.save({
+            "image_numbers": self.image_numbers,
+            "embeddings": self.embeddings.cpu(),
+            "card_hashes": self.card_hashes,
+            "clip_weights_hash": self.clip_weights_hash
+        }, path_to_index)
+
+    @staticmethod
+    def index_path(path_to_images: str, clip_weights_hash: str) -> str:
+        deck_dir = os.path.normpath(path_to_images)
+        return f"{deck_dir}.{clip_weights_hash[:16]}.clip_index.pt"
+
+    @classmethod
+    def load(cls, path_to_index: str) -> "CardIndex":
+        data = torch.load(path_to_index, map_location="cpu")
+        return cls(data["image_numbers"], data["embeddings"], data["card_hashes"], data["clip_weights_hash"])
+
+    @classmethod
+    def build(cls, path_to_images: str, clip_weights_hash: str, clip_model: "CLIPModel", clip_processor: "CLIPProcessor", device: str, batch_size: int = 32) -> "CardIndex":
+        image_names = sorted(os.listdir(path_to_images))
+        image_numbers = [card_number_from_file(image_name) for image_name in image_names]
+
+        embeddings = []
+        for start in range(0, len(image_names), batch_size):
+            images = [np.asarray(load_card_image(os.path.join(path_to_images, image_name))) for image_name in image_names[start:start + batch_size]]
+            embeddings.append(encode_images(clip_model, clip_processor, images, device).cpu())
+
+        return cls(image_numbers, torch.cat(embeddings), deck_hashes(path_to_images), clip_weights_hash)
+
+    @classmethod
+    def load_or_build(cls, path_to_images: str, path_to_clip_weights: str, clip_model: "CLIPModel", clip_processor: "CLIPProcessor", device: str) -> "CardIndex":
+        clip_weights_hash = weights_hash(path_to_clip_weights)
+        path_to_index = cls.index_path(path_to_images, clip_weights_hash)
+
+        if os.path.exists(path_to_index):
+            index = cls.load(path_to_index)
+            if index.clip_weights_hash == clip_weights_hash and index.card_hashes == deck_hashes(path_to_images):
+                return index.to(device)
+
+        print("Building the card embedding index...")
+        index = cls.build(path_to_images, clip_weights_hash, clip_model, clip_processor, device)
+        index.save(path_to_index)
+        return index.to(device)
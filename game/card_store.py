@@ -0,0 +1,72 @@
+import os
+import json
+import argparse
+from argparse import Namespace
+from typing import Dict, List, Tuple
+import numpy as np
+
+from card import Card, card_number_from_file, load_card_image
+
+def argument_parsing() -> Namespace:
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-d", "--decks", type=str, nargs="+", required=True, help="Specify the directories of the decks to pack")
+
+    return parser.parse_args()
+
+# The deck cards/odissey_cards is packed into cards/odissey_cards.cards.npy (N x 224 x 224 x 3 uint8)
+# and cards/odissey_cards.cards.json (card numbers, in the same order, plus size and mtime of the files used)
+def store_paths(path_to_images: str) -> Tuple[str, str]:
+    deck_dir = os.path.normpath(path_to_images)
+    return f"{deck_dir}.cards.npy", f"{deck_dir}.cards.json"
+
+def deck_files(path_to_images: str) -> Dict[str, List[int]]:
+    files = {}
+    for image_name in sorted(os.listdir(path_to_images)):
+        stat = os.stat(os.path.join(path_to_images, image_name))
+        files[image_name] = [stat.st_size, stat.st_mtime_ns]
+    return files
+
+def pack_deck(path_to_images: str) -> None:
+    path_to_pixels, path_to_ids = store_paths(path_to_images)
+    files = deck_files(path_to_images)
+
+    pixels = np.lib.format.open_memmap(path_to_pixels + ".tmp", mode="w+", dtype=np.uint8, shape=(len(files), 224, 224, 3))
+    for k, image_name in enumerate(files):
+        pixels[k] = np.asarray(load_card_image(os.path.join(path_to_images, image_name)))
+    pixels.flush()
+    del pixels
+    os.replace(path_to_pixels + ".tmp", path_to_pixels)
+
+    with open(path_to_ids, "w") as f:
+        json.dump({"image_numbers": [card_number_from_file(image_name) for image_name in files], "files": files}, f)
+
+def is_up_to_date(path_to_images: str) -> bool:
+    path_to_pixels, path_to_ids = store_paths(path_to_images)
+    if not (os.path.exists(path_to_pixels) and os.path.exists(path_to_ids)):
+        return False
+
+    with open(path_to_ids, "r") as f:
+        return json.load(f)["files"] == deck_files(path_to_images)
+
+# Packs the deck the first time (or when its files change), then every card is a view into the memory mapped array:
+# nothing is decoded at startup and the pages are shared between the processes using the same deck
+def load_deck(path_to_images: str) -> List[Card]:
+    if not is_up_to_date(path_to_images):
+        print("Packing the deck...")
+        pack_deck(path_to_images)
+
+    path_to_pixels, path_to_ids = store_paths(path_to_images)
+    with open(path_to_ids, "r") as f:
+        image_numbers = json.load(f)["image_numbers"]
+
+    pixels = np.load(path_to_pixels, mmap_mode="r")
+    return [Card(image_number, pixels[k]) for k, image_number in enumerate(image_numbers)]
+
+if __name__ == "__main__":
+
+    args = argument_parsing()
+
+    for deck in args.decks:
+        pack_deck(deck)
+        print(f"{deck} packed in {store_paths(deck)[0]}")
@@ -0,0 +1,138 @@
+import weakref
+import threading
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Dict, List
+import numpy as np
+import torch
+
+from instrumentation import timer
+
+if TYPE_CHECKING:
+    from transformers import CLIPModel, CLIPProcessor
+
+# Older transformers versions return the projected features directly, newer ones inside pooler_output
+def projected_features(outputs) -> torch.Tensor:
+    return outputs if isinstance(outputs, torch.Tensor) else outputs.pooler_output
+
+# Normalized projections, the same ones CLIPModel.forward compares to compute its logits
+def encode_images(clip_model: "CLIPModel", clip_processor: "CLIPProcessor", images: List[np.ndarray], device: str) -> torch.Tensor:
+    with timer("clip.image_preprocessing"):
+        inputs = clip_processor(images=images, return_tensors="pt").to(device)
+
+    with timer("clip.image_forward"), torch.no_grad():
+        image_embeds = projected_features(clip_model.get_image_features(**inputs))
+
+    return image_embeds / image_embeds.norm(p=2, dim=-1, keepdim=True)
+
+# Captions are padded to the longest one of the batch (the pooled token is the end of text one, padding after it does not change it),
+# except for models that only accept the full 77 tokens context (the exported graphs of clip_runtime.py)
+def text_padding(clip_model: "CLIPModel") -> str:
+    return "max_length" if getattr(clip_model, "fixed_text_length", False) else "longest"
+
+def encode_text(clip_model: "CLIPModel", clip_processor: "CLIPProcessor", captions: List[str], device: str) -> torch.Tensor:
+    with timer("clip.tokenization"):
+        inputs = clip_processor(text=captions, return_tensors="pt", padding=text_padding(clip_model), truncation=True).to(device)
+
+    with timer("clip.text_forward"), torch.no_grad():
+        text_embeds = projected_features(clip_model.get_text_features(**inputs))
+
+    return text_embeds / text_embeds.norm(p=2, dim=-1, keepdim=True)
+
+# Equivalent to outputs.logits_per_image: one row per image, one column per caption
+def caption_logits(clip_model: "CLIPModel", text_embeds: torch.Tensor, image_embeds: torch.Tensor) -> torch.Tensor:
+    with torch.no_grad():
+        return clip_model.logit_scale.exp() * image_embeds @ text_embeds.t()
+
+TEXT_CACHE_SIZE = 256
+
+# Text embeddings of the last captions encoded by a CLIP model, shared by all the bots of the process using it:
+# the caption of a round is encoded by the first bot scoring it (or by the narrator choosing it) and read by all the others.
+# The LRU bound keeps only the last rounds, the captions of older ones are almost never seen again.
+class TextEmbeddingCache():
+
+    def __init__(self, max_size: int = TEXT_CACHE_SIZE):
+        self.max_size = max_size
+        self.embeddings: "OrderedDict[str, torch.Tensor]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # Only the captions not in the cache are encoded, all together in one forward pass
+    def encode(self, clip_model: "CLIPModel", clip_processor: "CLIPProcessor", captions: List[str], device: str) -> torch.Tensor:
+        with self.lock:
+            found = {}
+            for caption in captions:
+                if caption in self.embeddings:
+                    self.embeddings.move_to_end(caption)
+                    found[caption] = self.embeddings[caption]
+            missing = [caption for caption in dict.fromkeys(captions) if caption not in found]
+            self.hits += len(captions) - len(missing)
+            self.misses += len(missing)
+
+        if len(missing) != 0:
+            text_embeds = encode_text(clip_model, clip_processor, missing, device)
+            with self.lock:
+                for caption, embedding in zip(missing, text_embeds):
+                    found[caption] = embedding
+                    self.embeddings[caption] = embedding
+                    self.embeddings.move_to_end(caption)
+                while len(self.embeddings) > self.max_size:
+                    self.embeddings.popitem(last=False)
+
+        return torch.stack([found[caption] for caption in captions])
+
+    # Embeddings computed elsewhere (e.g. stored in the caption bank), so that their captions never reach the text encoder
+    def put(self, captions: List[str], text_embeds: torch.Tensor) -> None:
+        with self.lock:
+            for caption, embedding in zip(captions, text_embeds):
+                self.embeddings[caption] = embedding
+                self.embeddings.move_to_end(caption)
+            while len(self.embeddings) > self.max_size:
+                self.embeddings.popitem(last=False)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.embeddings.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> Dict:
+        with self.lock:
+            requests = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / requests if requests else 0.0, "size": len(self.embeddings)}
+
+# One cache per CLIP model (a quantized or exported model gives different embeddings), dropped together with the model
+_text_caches: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+_text_caches_lock = threading.Lock()
+
+def text_cache(clip_model: "CLIPModel") -> TextEmbeddingCache:
+    with _text_caches_lock:
+        cache = _text_caches.get(clip_model)
+        if cache is None:
+            cache = _text_caches[clip_model] = TextEmbeddingCache()
+        return cache
+
+def encode_text_cached(clip_model: "CLIPModel", clip_processor: "CLIPProcessor", captions: List[str], device: str) -> torch.Tensor:
+    return text_cache(clip_model).encode(clip_model, clip_processor, captions, device)
+
+def cache_text_embeddings(clip_model: "CLIPModel", captions: List[str], text_embeds: torch.Tensor) -> None:
+    text_cache(clip_model).put(captions, text_embeds)
+
+# Counters of all the caches of the process
+def text_cache_stats() -> Dict:
+    with _text_caches_lock:
+        caches = list(_text_caches.values())
+    stats = [cache.stats() for cache in caches]
+    hits, misses = sum(s["hits"] for s in stats), sum(s["misses"] for s in stats)
+    return {"hits": hits, "misses": misses, "hit_rate": hits / (hits + misses) if hits + misses else 0.0, "size": sum(s["size"] for s in stats)}
+
+def clear_text_caches() -> None:
+    with _text_caches_lock:
+        caches = list(_text_caches.values())
+    for cache in caches:
+        cache.clear()
+
+# The embeddings cached for a model are no longer valid when its weights change in place (e.g. quantize_models)
+def drop_text_cache(clip_model: "CLIPModel") -> None:
+    with _text_caches_lock:
+        _text_caches.pop(clip_model, None)
@@ -0,0 +1,150 @@
+import os
+import json
+import argparse
+from argparse import Namespace
+from typing import TYPE_CHECKING, Dict, Optional, Union
+import numpy as np
+import torch
+
+from card_index import weights_hash
+from clip_features import projected_features
+
+if TYPE_CHECKING:
+    from transformers import CLIPModel
+
+# The CLIP towers exported as two separate graphs (text and vision), with the shapes the bots always use:
+# captions padded to 77 tokens and 224x224 images, only the batch size changes.
+# ExportedCLIP exposes the only parts of CLIPModel the bots use (get_text_features, get_image_features and logit_scale),
+# so it can replace it everywhere (see clip_features.py).
+
+BACKENDS = ["eager", "torchscript", "onnx"]
+EXPORT_DIR = "../weights/clip_runtime"
+TEXT_LENGTH = 77
+IMAGE_SIZE = 224
+
+def argument_parsing() -> Namespace:
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--backend", type=str, choices=["torchscript", "onnx"], default="torchscript", help="Specify the format of the exported graphs")
+    parser.add_argument("--blip_weights", type=str, default="../weights/rephrased_blip(2nd)/epoch50.pt", help="Specify the fine tuned BLIP weights")
+    parser.add_argument("--clip_weights", type=str, default="../weights/rephrased_coco_clip(2nd)/epoch13.pt", help="Specify the fine tuned CLIP weights")
+    parser.add_argument("-dst", "--export_dir", type=str, default=EXPORT_DIR, help="Specify the directory where the graphs are saved")
+
+    return parser.parse_args()
+
+class TextTower(torch.nn.Module):
+    def __init__(self, clip_model: "CLIPModel"):
+        super().__init__()
+        self.clip_model = clip_model
+
+    def forward(self, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+        return projected_features(self.clip_model.get_text_features(input_ids=input_ids, attention_mask=attention_mask))
+
+class VisionTower(torch.nn.Module):
+    def __init__(self, clip_model: "CLIPModel"):
+        super().__init__()
+        self.clip_model = clip_model
+
+    def forward(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        return projected_features(self.clip_model.get_image_features(pixel_values=pixel_values))
+
+def graph_paths(export_dir: str, backend: str) -> Dict[str, str]:
+    extension = "onnx" if backend == "onnx" else "pt"
+    return {"text": os.path.join(export_dir, f"clip_text.{extension}"), "vision": os.path.join(export_dir, f"clip_vision.{extension}"),
+            "meta": os.path.join(export_dir, f"clip_{backend}.json")}
+
+def export_towers(clip_model: "CLIPModel", path_to_clip_weights: str, export_dir: str, backend: str) -> None:
+    os.makedirs(export_dir, exist_ok=True)
+    paths = graph_paths(export_dir, backend)
+    clip_model = clip_model.cpu().eval()
+
+    text_inputs = (torch.ones(2, TEXT_LENGTH, dtype=torch.long), torch.ones(2, TEXT_LENGTH, dtype=torch.long))
+    vision_inputs = (torch.zeros(2, 3, IMAGE_SIZE, IMAGE_SIZE),)
+
+    with torch.no_grad():
+        if backend == "onnx":
+            torch.onnx.export(TextTower(clip_model), text_inputs, paths["text"], input_names=["input_ids", "attention_mask"], output_names=["text_embeds"],
+                              dynamic_axes={"input_ids": {0: "batch"}, "attention_mask": {0: "batch"}, "text_embeds": {0: "batch"}}, opset_version=17)
+            torch.onnx.export(VisionTower(clip_model), vision_inputs, paths["vision"], input_names=["pixel_values"], output_names=["image_embeds"],
+                              dynamic_axes={"pixel_values": {0: "batch"}, "image_embeds": {0: "batch"}}, opset_version=17)
+        else:
+            torch.jit.trace(TextTower(clip_model), text_inputs, check_trace=False).save(paths["text"])
+            torch.jit.trace(VisionTower(clip_model), vision_inputs, check_trace=False).save(paths["vision"])
+
+    with open(paths["meta"], "w") as f:
+        json.dump({"logit_scale": clip_model.logit_scale.item(), "clip_weights_hash": weights_hash(path_to_clip_weights)}, f)
+
+class ExportedCLIP():
+    # The graphs were traced with captions of TEXT_LENGTH tokens
+    fixed_text_length = True
+
+    def __init__(self, export_dir: str, backend: str, threads: Optional[int] = None):
+        self.backend = backend
+        paths = graph_paths(export_dir, backend)
+
+        with open(paths["meta"], "r") as f:
+            meta = json.load(f)
+        self.logit_scale = torch.tensor(meta["logit_scale"])
+        self.clip_weights_hash = meta["clip_weights_hash"]
+
+        if backend == "onnx":
+            import onnxruntime
+
+            options = onnxruntime.SessionOptions()
+            if threads is not None:
+                options.intra_op_num_threads = threads
+            self.text = onnxruntime.InferenceSession(paths["text"], options, providers=["CPUExecutionProvider"])
+            self.vision = onnxruntime.InferenceSession(paths["vision"], options, providers=["CPUExecutionProvider"])
+        else:
+            # TorchScript runs on the torch thread pool of the process
+            if threads is not None:
+                torch.set_num_threads(threads)
+            self.text = torch.jit.load(paths["text"], map_location="cpu").eval()
+            self.vision = torch.jit.load(paths["vision"], map_location="cpu").eval()
+
+    def run(self, graph, inputs: Dict[str, torch.Tensor]) -> torch.Tensor:
+        device = next(iter(inputs.values())).device
+        if self.backend == "onnx":
+            outputs = graph.run(None, {name: tensor.cpu().numpy() for name, tensor in inputs.items()})[0]
+            return torch.from_numpy(np.asarray(outputs)).to(device)
+        with torch.no_grad():
+            return graph(*[tensor.cpu() for tensor in inputs.values()]).to(device)
+
+    def get_text_features(self, input_ids: torch.Tensor, attention_mask: torch.Tensor, **kwargs) -> torch.Tensor:
+        return self.run(self.text, {"input_ids": input_ids.long(), "attention_mask": attention_mask.long()})
+
+    def get_image_features(self, pixel_values: torch.Tensor, **kwargs) -> torch.Tensor:
+        return self.run(self.vision, {"pixel_values": pixel_values.float()})
+
+    def eval(self) -> "ExportedCLIP":
+        return self
+
+# The exported graphs when they are available (and were exported from the same weights), the eager model otherwise
+def load_clip_runtime(clip_model: "CLIPModel", path_to_clip_weights: str, backend: str, export_dir: str = EXPORT_DIR, threads: Optional[int] = None) -> Union["CLIPModel", ExportedCLIP]:
+    if backend == "eager":
+        return clip_model
+
+    if not os.path.exists(graph_paths(export_dir, backend)["meta"]):
+        print(f"No {backend} export in {export_dir}, using the eager CLIP model (run clip_runtime.py once to create it)")
+        return clip_model
+
+    try:
+        runtime = ExportedCLIP(export_dir, backend, threads)
+    except ImportError:
+        print(f"The {backend} runtime is not installed, using the eager CLIP model")
+        return clip_model
+
+    if runtime.clip_weights_hash != weights_hash(path_to_clip_weights):
+        print(f"The {backend} export in {export_dir} comes from other CLIP weights, using the eager CLIP model")
+        return clip_model
+
+    return runtime
+
+if __name__ == "__main__":
+    from models import load_models
+
+    args = argument_parsing()
+
+    models = load_models(args.blip_weights, args.clip_weights, "cpu")
+    export_towers(models.clip_model, models.clip_weights, args.export_dir, args.backend)
+    print(f"CLIP towers exported in {args.export_dir}")
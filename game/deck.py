@@ -0,0 +1,74 @@
+import random
+from collections import deque
+from typing import Deque, Dict, Iterator, List, Optional
+
+from card import Card
+from instrumentation import profiled
+
+# Draw pile shuffled once, cards are taken from its end. The played cards go to the discard pile,
+# which becomes the new draw pile (shuffled) when the deck runs out
+class Deck():
+    def __init__(self, cards: List[Card]):
+        self.cards: Dict[int, Card] = {card.image_number: card for card in cards}
+
+        shuffled = list(self.cards)
+        random.shuffle(shuffled)
+        self.draw_pile: Deque[int] = deque(shuffled)
+        self.discard_pile: List[int] = []
+
+    def __len__(self) -> int:
+        return len(self.draw_pile)
+
+    @profiled
+    def draw(self) -> Card:
+        return self.cards[self.draw_pile.pop()]
+
+    @profiled
+    def discard(self, card: Card) -> None:
+        self.discard_pile.append(card.image_number)
+
+    # The cards left in the draw pile are shuffled together with the discarded ones
+    @profiled
+    def reshuffle(self) -> None:
+        self.discard_pile.extend(self.draw_pile)
+        random.shuffle(self.discard_pile)
+        self.draw_pile = deque(self.discard_pile)
+        self.discard_pile = []
+
+# Cards of a player: removing a card swaps it with the last one, so the order of the hand changes when a card is played
+class Hand():
+    def __init__(self, cards: Optional[List[Card]] = None):
+        self.cards: List[Card] = []
+        self.positions: Dict[int, int] = {} # image_number -> position in cards
+        for card in cards if cards is not None else []:
+            self.append(card)
+
+    def __len__(self) -> int:
+        return len(self.cards)
+
+    def __iter__(self) -> Iterator[Card]:
+        return iter(self.cards)
+
+    def __getitem__(self, position: int) -> Card:
+        return self.cards[position]
+
+    def __contains__(self, card: Card) -> bool:
+        return card.image_number in self.positions
+
+    def __repr__(self) -> str:
+        return repr(self.cards)
+
+    def append(self, card: Card) -> None:
+        self.positions[card.image_number] = len(self.cards)
+        self.cards.append(card)
+
+    def get(self, image_number: int) -> Optional[Card]:
+        position = self.positions.get(image_number)
+        return self.cards[position] if position is not None else None
+
+    def remove(self, card: Card) -> None:
+        position = self.positions.pop(card.image_number)
+        last = self.cards.pop()
+        if position < len(self.cards):
+            self.cards[position] = last
+            self.positions[last.image_number] = position
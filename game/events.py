@@ -0,0 +1,118 @@
+import os
+import json
+from abc import ABC, abstractmethod
+from dataclasses import asdict, dataclass
+from typing import ClassVar, Dict, List
+
+# Every event is saved as a flat record with these fields (the ones an event does not have are None)
+FIELDS = ["game", "round", "event", "player", "card", "caption", "cards", "voted_player", "points"]
+
+@dataclass
+class Event():
+    game: str
+    round: int
+
+    event: ClassVar[str] = ""
+
+    def record(self) -> Dict:
+        record = dict.fromkeys(FIELDS)
+        record.update(asdict(self))
+        record["event"] = self.event
+        return record
+
+@dataclass
+class RoundStart(Event):
+    player: str # Narrator of the round
+    event: ClassVar[str] = "round_start"
+
+@dataclass
+class Hand(Event):
+    player: str
+    cards: List[int]
+    event: ClassVar[str] = "hand"
+
+@dataclass
+class Narration(Event):
+    player: str
+    card: int
+    caption: str
+    event: ClassVar[str] = "narration"
+
+@dataclass
+class Selection(Event):
+    player: str
+    card: int
+    event: ClassVar[str] = "selection"
+
+@dataclass
+class Vote(Event):
+    player: str
+    voted_player: str
+    event: ClassVar[str] = "vote"
+
+@dataclass
+class Score(Event):
+    player: str
+    points: int # Total points at the end of the round
+    event: ClassVar[str] = "score"
+
+@dataclass
+class Winner(Event):
+    player: str
+    event: ClassVar[str] = "winner"
+
+
+class EventSink(ABC):
+
+    @abstractmethod
+    def emit(self, event: Event) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+# Append-only, one JSON record per line
+class JsonlSink(EventSink):
+    def __init__(self, path: str):
+        self.f = open(path, "x")
+
+    def emit(self, event: Event) -> None:
+        self.f.write(json.dumps(event.record()) + "\n")
+
+    def close(self) -> None:
+        self.f.close()
+
+# Columnar file, written when the sink is closed
+class ParquetSink(EventSink):
+    def __init__(self, path: str):
+        if os.path.exists(path):
+            raise FileExistsError(f"File exists: '{path}'")
+        self.path = path
+        self.records = []
+
+    def emit(self, event: Event) -> None:
+        self.records.append(event.record())
+
+    def close(self) -> None:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        schema = pa.schema([
+            ("game", pa.string()), ("round", pa.int32()), ("event", pa.string()), ("player", pa.string()), ("card", pa.int32()),
+            ("caption", pa.string()), ("cards", pa.list_(pa.int32())), ("voted_player", pa.string()), ("points", pa.int32())
+        ])
+        pq.write_table(pa.Table.from_pylist(self.records, schema=schema), self.path)
+
+# Keeps the events in memory
+class ListSink(EventSink):
+    def __init__(self):
+        self.events: List[Event] = []
+
+    def emit(self, event: Event) -> None:
+        self.events.append(event)
+
+# The file must not exist yet: the events of a new run are never mixed with the ones of a game already saved there
+def open_sink(path: str) -> EventSink:
+    if os.path.splitext(path)[1] == ".parquet":
+        return ParquetSink(path)
+    return JsonlSink(path)
@@ -1,41 +1,57 @@
-import os
-from PIL import Image
+import time
 import random
-from typing import Dict, List
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple
 import sys
 
 from card import Card
+from captioning import NarratorOptions
+from card_store import load_deck
+from deck import Deck
 from human_player import HumanPlayer
-from bot import Bot
-from player import Player
+from player import Player, Seat
 from gpt_bot import GPT_bot
-
-from transformers import BlipProcessor, BlipForConditionalGeneration, CLIPProcessor, CLIPModel
-import torch
+from gpt_client import GPTClient
+from image_payload import ImagePayloadCache
+from events import Event, EventSink, Hand, Narration, RoundStart, Score, Selection, Vote, Winner
+from models import Models, copy_models, device_name, load_models, quantize_models
+from instrumentation import record_phase
+from online_stats import OnlineStats
+
+# The model-backed modules import torch and transformers, so they are only imported when the bots are created
+if TYPE_CHECKING:
+    import torch
+    from card_index import CardIndex
+    from caption_bank import CaptionBank
+    from inference_server import InferenceServer
 
 class Game():
 
-    def __init__(self, n_players: int, gpt_players: int, path_to_images: str, playable: bool, points_to_win: int, print_cards: bool, path_to_blip_weights: str = "../weights/rephrased_blip(2nd)/epoch50.pt", path_to_clip_weights: str = "../weights/rephrased_coco_clip(2nd)/epoch13.pt"):
+    def __init__(self, n_players: int, gpt_players: int, path_to_images: str, playable: bool, points_to_win: int, print_cards: bool, path_to_blip_weights: str = "../weights/rephrased_blip(2nd)/epoch50.pt", path_to_clip_weights: str = "../weights/rephrased_coco_clip(2nd)/epoch13.pt", models: Optional[Models] = None, card_index: Optional["CardIndex"] = None, inference: Optional["InferenceServer"] = None, gpt_client: Optional[GPTClient] = None, gpt_payloads: Optional[ImagePayloadCache] = None, sinks: Optional[List[EventSink]] = None, verbose: bool = True, game_id: str = "0", narrator: NarratorOptions = NarratorOptions(), caption_bank: Optional["CaptionBank"] = None, quantize: bool = False, clip_backend: str = "eager", clip_threads: Optional[int] = None, player_factory: Optional[Callable[[str, int], Seat]] = None, stats: Optional[OnlineStats] = None):
         self.playable = playable
         self.n_players = n_players
         
         self.print_cards = print_cards
         self.n_bots = n_players
+        self.rounds_played = 0
+        self.phase_seconds: Dict[str, float] = {} # Time spent in each phase of the rounds, see add_phase_time
+
+        # The game is recorded through the events sent to the sinks, printing is only for who is watching
+        self.sinks = sinks if sinks is not None else []
+        self.verbose = verbose
+        self.game_id = game_id
+        self.stats = stats # Running statistics, updated at the end of every round (can be shared by several games)
         
-        self.played_cards = list()
-        self.deck = list()
-        for image_name in os.listdir(path_to_images):
-            image_number = int(image_name.split(".")[0])
-            image = Image.open(os.path.join(path_to_images, image_name)).convert("RGB")
-            image = image.resize((224,224))
-            card = Card(image_number, image)
-            self.deck.append(card)
+        self.deck = Deck(load_deck(path_to_images))
+
+        # With a human at the table the bots score the cards in this thread while the human is choosing (see submit_bots_work)
+        self.background = ThreadPoolExecutor(1, thread_name_prefix="bots") if playable else None
 
         self.players = []
         if self.playable:
             self.n_bots -= 1
             human_player = HumanPlayer("Human Player", points_to_win) 
-            self.deck = human_player.draw_initial_hand(self.deck)
+            human_player.draw_initial_hand(self.deck)
             self.players.append(human_player)
 
         if gpt_players != 0:
@@ -44,113 +60,276 @@ class Game():
                 print("Too many GPT players")
                 sys.exit()
             
-        api_key = " "
+        # A client created here is owned by the game and closed when it ends, a client passed in is left to the caller
+        self.owned_gpt_client: Optional[GPTClient] = None
+        if gpt_players != 0 and gpt_client is None:
+            api_key = " "
+            gpt_client = GPTClient(api_key)
+            self.owned_gpt_client = gpt_client
+
+        # The encoded cards are shared by all the GPT players
+        gpt_payloads = gpt_payloads if gpt_payloads is not None else ImagePayloadCache()
         for k in range(gpt_players):
-            gpt = GPT_bot(f"GPT Bot {k+1}", points_to_win, api_key)
-            self.deck = gpt.draw_initial_hand(self.deck)
+            gpt = GPT_bot(f"GPT Bot {k+1}", points_to_win, gpt_client, gpt_payloads)
+            gpt.draw_initial_hand(self.deck)
             self.players.append(gpt)
 
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-
-        print("Loading models...")
-
-        blip_processor = BlipProcessor.from_pretrained("Salesforce/blip-image-captioning-base")
-        blip_model = BlipForConditionalGeneration.from_pretrained("Salesforce/blip-image-captioning-base").to(device)
-
-        clip_model = CLIPModel.from_pretrained("openai/clip-vit-base-patch16").to(device)
-        clip_processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch16")
-
-        blip_model.load_state_dict(torch.load(path_to_blip_weights))
-        clip_model.load_state_dict(torch.load(path_to_clip_weights))
-
-        print("Models loaded successfully!")
+        # The other seats are bots, unless the players are created by player_factory (e.g. the stub players of benchmark.py, without models,
+        # or the remote seats of game_server.py, whose tables play the rounds themselves)
+        if player_factory is None:
+            from bot import Bot
+            from card_index import CardIndex
+            from caption_bank import CaptionBank
+            from clip_runtime import load_clip_runtime
+
+            device = device_name()
+
+            # Models and card index can be shared between games (e.g. by the tournament workers)
+            shared_models = models is not None
+            if models is None:
+                self.log("Loading models...")
+                models = load_models(path_to_blip_weights, path_to_clip_weights, device)
+                self.log("Models loaded successfully!")
+
+            if card_index is None:
+                card_index = CardIndex.load_or_build(path_to_images, models.clip_weights, models.clip_model, models.clip_processor, device)
+
+            if narrator.use_bank and caption_bank is None:
+                caption_bank = CaptionBank.find(path_to_images, models.blip_weights, models.clip_weights, device)
+                if caption_bank is None:
+                    self.log("No caption bank for this deck and these models, the captions are generated live (run caption_bank.py once to build it)")
+
+            # After building the card index, that keeps the fp32 image embeddings
+            if quantize:
+                if device != "cpu":
+                    self.log("The quantized models only run on CPU, using the fp32 ones")
+                else:
+                    # Quantized in place, so the models shared with the caller (and its other games) are copied first
+                    models = quantize_models(copy_models(models) if shared_models else models)
+                    # The exported towers are fp32, they would silently replace the quantized CLIP
+                    if clip_backend != "eager":
+                        self.log(f"The {clip_backend} CLIP towers are not quantized, using the quantized eager model")
+                        clip_backend = "eager"
+
+            # The exported CLIP towers (see clip_runtime.py) replace the eager model, which is kept when they are not available
+            models = models._replace(clip_model=load_clip_runtime(models.clip_model, models.clip_weights, clip_backend, threads=clip_threads))
+
+            def player_factory(player_name: str, points_to_win: int) -> Player:
+                return Bot(player_name, points_to_win, models.blip_model, models.blip_processor, models.clip_model, models.clip_processor, card_index, inference, narrator, caption_bank)
 
         for k in range(self.n_bots):
-            p = Bot(f"Bot {k+1}", points_to_win, blip_model, blip_processor, clip_model, clip_processor)
-            self.deck = p.draw_initial_hand(self.deck)
+            p = player_factory(f"Bot {k+1}", points_to_win)
+            p.draw_initial_hand(self.deck)
             self.players.append(p)
 
-        blip_model.eval()
-        clip_model.eval()
+        for p in self.players:
+            p.verbose = verbose
 
         self.first_to_start = random.randint(0, n_players-1)
 
-    def simulate(self) -> None:
+    def log(self, message: str = "") -> None:
+        if self.verbose:
+            print(message)
+
+    def emit(self, event: Event) -> None:
+        for sink in self.sinks:
+            sink.emit(event)
+
+    def simulate(self) -> List[Player]:
+        try:
+            return self.play()
+        finally:
+            self.close()
+
+    def play(self) -> List[Player]:
         players_winning_conditions = {p:p.check_winning_condition() for p in self.players}
         while not any(players_winning_conditions.values()):
             if self.print_cards:
-                print("PLAYERS CARDS:")
+                self.log("PLAYERS CARDS:")
                 for p in self.players:
-                    print(f"{p} has the following cards: {p.cards_in_hand}")
-                print()
+                    self.log(f"{p} has the following cards: {p.cards_in_hand}")
+                self.log()
             self.do_one_round()
             players_winning_conditions = {p:p.check_winning_condition() for p in self.players}
             points_dict = {p:p.points for p in self.players}
-            print("\n" + "-"*15 + "POINTS" + "-"*15 + "\n")
+            self.log("\n" + "-"*15 + "POINTS" + "-"*15 + "\n")
             for p, points in points_dict.items():
-                print(f"{p}: {points}")
-            print("\n" + "="*35 + "\n")
+                self.log(f"{p}: {points}")
+            self.log("\n" + "="*35 + "\n")
 
-        final_points = {p:p.points for p in self.players}
-        
-        max_score = max(final_points.values())
-        winners = [player for player, score in final_points.items() if score == max_score]
+        winners = self.winners()
 
         for player in winners:
-            print(f"{player} has won!")
+            self.log(f"{player} has won!")
+            self.emit(Winner(self.game_id, self.rounds_played, str(player)))
+
+        if self.stats is not None:
+            self.stats.add_game(self.players, winners)
+
+        return winners
+
+    # Stops the background thread and the GPT client owned by the game (also when a round raised)
+    def close(self) -> None:
+        if self.background is not None:
+            self.background.shutdown()
+            self.background = None
+        if self.owned_gpt_client is not None:
+            self.owned_gpt_client.close()
+            self.owned_gpt_client = None
 
     
     def do_one_round(self) -> None:
         current_player = self.first_to_start
-        print("\n" + "-"*10 + "NARRATOR PHASE" + "-"*10 + "\n")
+        round_number = self.rounds_played + 1
+        self.emit(RoundStart(self.game_id, round_number, str(self.players[current_player])))
+        for p in self.players:
+            self.emit(Hand(self.game_id, round_number, str(p), [card.image_number for card in p.cards_in_hand]))
+
+        self.log("\n" + "-"*10 + "NARRATOR PHASE" + "-"*10 + "\n")
+        start = time.perf_counter()
         selected_card, caption = self.players[current_player].get_card_and_caption()
+        self.add_phase_time("narration", start)
+        self.emit(Narration(self.game_id, round_number, str(self.players[current_player]), selected_card.image_number, caption))
         
         other_players = [player for player_index, player in enumerate(self.players) if player_index != current_player]
-        print("\n" + "-"*10 + "SELECTION PHASE" + "-"*10 + "\n")
-        cards_on_table = [(player, player.select_card_from_caption(caption)) for player in other_players]
+        self.log("\n" + "-"*10 + "SELECTION PHASE" + "-"*10 + "\n")
+        start = time.perf_counter()
+        cards_on_table = self.select_cards(other_players, caption)
+        self.add_phase_time("selection", start)
+        for player, card in cards_on_table:
+            self.emit(Selection(self.game_id, round_number, str(player), card.image_number))
         cards_on_table.append((self.players[current_player], selected_card))
 
-        print("\n" + "-"*10 + "VOTING PHASE" + "-"*10 + "\n")
+        self.log("\n" + "-"*10 + "VOTING PHASE" + "-"*10 + "\n")
+        start = time.perf_counter()
         votes = {p:[] for p in self.players} #Key: player Value: players who voted for him
+        gpt_players = [player for player in other_players if isinstance(player, GPT_bot)]
+        gpt_votes = GPT_bot.submit_votes(gpt_players, cards_on_table, caption) if len(gpt_players) != 0 else None
+
+        table_scores = self.submit_bots_work(self.score_table, cards_on_table, caption, other_players)
+        players_votes = {}
+        for player in other_players:
+            if not isinstance(player, GPT_bot) and not player.model_backed:
+                others_card_on_table = [(player_who_played_card,card) for player_who_played_card,card in cards_on_table if player != player_who_played_card]
+                players_votes[player] = player.get_most_likely_card(others_card_on_table, caption)
+
+        table_scores = table_scores.result()
+        for player in other_players:
+            if player.model_backed:
+                players_votes[player] = player.get_most_likely_card_from_scores(cards_on_table, table_scores[id(player.clip_model)])
+
+        if gpt_votes is not None:
+            players_votes.update(zip(gpt_players, GPT_bot.wait(gpt_votes)))
+
+        self.add_phase_time("voting", start)
         for player in other_players:
-            others_card_on_table = [(player_who_played_card,card) for player_who_played_card,card in cards_on_table if player != player_who_played_card]
-            player_vote = player.get_most_likely_card(others_card_on_table, caption)
-            votes[player_vote].append(player)
+            votes[players_votes[player]].append(player)
+            self.emit(Vote(self.game_id, round_number, str(player), str(players_votes[player])))
 
-        print("\n" + "-"*15 + "VOTES" + "-"*15 + "\n")
+        self.log("\n" + "-"*15 + "VOTES" + "-"*15 + "\n")
+        played_cards = dict(cards_on_table)
         for player, players_who_voted in votes.items():
             players_who_voted = ", ".join([str(p) for p in players_who_voted]) if len(players_who_voted) != 0 else "no one"
-            played_card = None
-            for p, card in cards_on_table:
-                if p == player:
-                    played_card = card
-                    break
-            print(f"{player} with card {played_card} has been voted by {players_who_voted}")
+            self.log(f"{player} with card {played_cards.get(player)} has been voted by {players_who_voted}")
 
+        start = time.perf_counter()
+        points_before = {p: p.points for p in self.players}
         self.compute_scores(votes, current_player, other_players)
+        if self.stats is not None:
+            self.stats.add_round(self.players[current_player], other_players, votes, {p: p.points - points_before[p] for p in self.players})
+        for p in self.players:
+            self.emit(Score(self.game_id, round_number, str(p), p.points))
+
+        self.end_round(cards_on_table, current_player)
+        self.add_phase_time("scoring", start)
 
+    # Shared with the tables of game_server.py, which play the rounds asynchronously
+    def end_round(self, cards_on_table: List[Tuple[Player, Card]], current_player: int) -> None:
         for _, card in cards_on_table:
-            self.played_cards.append(card)
+            self.deck.discard(card)
         
         # If there are less cards in the deck than players, shuffle and reuse the already played ones
+        # (together with the cards still in the deck, not enough for all the players)
         if len(self.deck) < self.n_players:
-
-            # If there are still some cards in the deck (not enough for all the players), add them to the already played ones
-            for card in self.deck:
-                self.played_cards.append(card)
-
-            #Shuffle and reuse the already played cards
-            random.shuffle(self.played_cards)
-            self.deck = self.played_cards.copy() # Shallow copy of already played cards
+            self.deck.reshuffle()
 
         # Each player takes a card
         for player in self.players:
-            self.deck = player.draw_card(self.deck)
+            player.draw_card(self.deck)
 
         #Compute next player. If the current is the last one, we skip to the first one
         next_player = (current_player + 1) % self.n_players
         self.first_to_start = next_player
-
+        self.rounds_played += 1
+
+    def is_over(self) -> bool:
+        return any(p.check_winning_condition() for p in self.players)
+
+    def winners(self) -> List[Player]:
+        max_score = max(p.points for p in self.players)
+        return [player for player in self.players if player.points == max_score]
+
+    # Logging and events are left out of the phases
+    def add_phase_time(self, phase: str, start: float) -> None:
+        seconds = time.perf_counter() - start
+        self.phase_seconds[phase] = self.phase_seconds.get(phase, 0.0) + seconds
+        record_phase(phase, seconds)
+
+    # GPT players only wait for the API, so their requests are sent all at once and the other players play in the meantime
+    def select_cards(self, players: List[Player], caption: str) -> List[Tuple[Player, Card]]:
+        gpt_players = [player for player in players if isinstance(player, GPT_bot)]
+        gpt_cards = GPT_bot.submit_selections(gpt_players, caption) if len(gpt_players) != 0 else None
+
+        model_players = [player for player in players if player.model_backed]
+        hand_scores = self.submit_bots_work(self.score_hands, caption, model_players)
+
+        selected_cards = {}
+        for player in players:
+            if not isinstance(player, GPT_bot) and not player.model_backed:
+                selected_cards[player] = player.select_card_from_caption(caption)
+
+        hand_scores = hand_scores.result()
+        for player in model_players:
+            selected_cards[player] = player.select_card_from_scores(hand_scores[player])
+        if gpt_cards is not None:
+            selected_cards.update(zip(gpt_players, GPT_bot.wait(gpt_cards)))
+
+        return [(player, selected_cards[player]) for player in players]
+
+    # The hands of the bots and the table do not depend on what the human chooses or votes: when there is a human player,
+    # the bots work on them in the background thread while the human is typing, and their choices are made once the human answers
+    # (from the main thread, so the logs and the hands are only touched there). Without a human player the work is done right away.
+    def submit_bots_work(self, function: Callable, *args) -> Future:
+        if self.background is not None:
+            return self.background.submit(function, *args)
+        future = Future()
+        future.set_result(function(*args))
+        return future
+
+    # The hands of all the bots sharing a CLIP model are scored in a single call, and each bot gets the rows of its own hand
+    def score_hands(self, caption: str, players: List[Player]) -> Dict[Player, "torch.Tensor"]:
+        groups: Dict[int, List[Player]] = {}
+        for player in players:
+            groups.setdefault(id(player.clip_model), []).append(player)
+
+        hand_scores = {}
+        for group in groups.values():
+            logits_per_image = group[0].score_cards(caption, [card for player in group for card in player.cards_in_hand])
+            start = 0
+            for player in group:
+                end = start + len(player.cards_in_hand)
+                hand_scores[player] = logits_per_image[start:end]
+                start = end
+        return hand_scores
+
+    # Every bot would score the same caption against the table minus its own card, so the whole table is scored once per CLIP model
+    # and each bot masks its own card when voting
+    def score_table(self, cards_on_table: List[Tuple[Player, Card]], caption: str, voters: List[Player]) -> Dict[int, "torch.Tensor"]:
+        table_scores = {}
+        for player in voters:
+            if player.model_backed and id(player.clip_model) not in table_scores:
+                table_scores[id(player.clip_model)] = player.score_cards(caption, [card for _, card in cards_on_table])
+        return table_scores
 
     def compute_scores(self, votes: Dict[Player, List[Player]], current_player: int, other_players: List[Player]) -> None:
         narrator = self.players[current_player]
@@ -0,0 +1,362 @@
+import asyncio
+import json
+import argparse
+from argparse import Namespace
+from typing import Dict, List, Optional, Tuple
+
+import torch
+from aiohttp import WSMsgType, web
+
+from bot import Bot
+from captioning import NarratorOptions
+from caption_bank import CaptionBank
+from card import Card
+from card_index import CardIndex
+from card_store import load_deck
+from game import Game
+from inference_server import InferenceServer
+from models import device_name, load_models
+from player import Player, Seat
+
+# Local server hosting many tables at once in a single event loop. Every table is a coroutine playing the rounds of a Game,
+# the human seats play over a WebSocket and all the bots of all the tables share one copy of the models through the
+# batching inference server (awaited without blocking the loop).
+#
+# HTTP:
+#   POST /tables {"players": 5, "humans": 1, "points_to_win": 30} -> {"table": "1", "seats": ["Human 1"]}
+#   GET  /tables, GET /tables/{table} -> state of the tables (status, round, points, winners)
+#   GET  /tables/{table}/seats/{n} -> WebSocket of the seat "Human n"
+# WebSocket (JSON messages), the server asks and the seat answers echoing the id of the question:
+#   {"type": "narrate", "id": 7, "hand": [...]} -> {"id": 7, "card": 12, "caption": "..."}
+#   {"type": "select", "id": 8, "caption": "...", "hand": [...]} -> {"id": 8, "card": 12}
+#   {"type": "vote", "id": 9, "caption": "...", "cards": [...]} -> {"id": 9, "card": 12}
+#   and it sends "welcome", "narration", "round_result", "game_over" and "error" (invalid answer, the question is asked again with a new id).
+#   Answers without the id of the pending question (late or repeated ones) are dropped.
+# A table stopped by an error closes its seats and is removed.
+# The table starts when all its human seats are connected. A seat can reconnect, the pending question is sent again.
+
+def argument_parsing() -> Namespace:
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Specify the address the server listens on")
+    parser.add_argument("--port", type=int, default=8000, help="Specify the port of the server")
+    parser.add_argument("--deck", type=str, default="../cards/odissey_cards", help="Specify the directory of the deck")
+    parser.add_argument("--max_tables", type=int, default=64, help="Specify the maximum number of tables open at the same time")
+    parser.add_argument("--max_batch_size", type=int, default=32, help="Specify the maximum batch size of the inference server")
+    parser.add_argument("--max_latency", type=float, default=0.005, help="Specify how long (in seconds) the inference server waits to fill a batch")
+    parser.add_argument("--narrator_candidates", type=int, default=1, help="Specify the number of captions generated for each card in hand when a bot narrates (with 1 a random card gets a single caption)")
+    parser.add_argument("--narrator_target", type=float, default=0.5, help="Specify the probability of being found (against the rest of the hand) the caption chosen by a bot narrator should have")
+    parser.add_argument("--narrator_max_time", type=float, default=None, help="Specify the time budget (in seconds) of the bot captions generation")
+    parser.add_argument("--caption_bank", action="store_true", help="Let the bots take their captions from the precomputed caption bank of the deck (see caption_bank.py)")
+    parser.add_argument("--blip_weights", type=str, default="../weights/rephrased_blip(2nd)/epoch50.pt", help="Specify the fine tuned BLIP weights")
+    parser.add_argument("--clip_weights", type=str, default="../weights/rephrased_coco_clip(2nd)/epoch13.pt", help="Specify the fine tuned CLIP weights")
+
+    return parser.parse_args()
+
+# A human seat: only its hand and points are kept by the game, its choices are asked by the table through the WebSocket
+class RemotePlayer(Seat):
+
+    def __init__(self, player_name: str, points_to_win: int):
+        super().__init__(player_name, points_to_win)
+        self.socket: Optional[web.WebSocketResponse] = None
+        self.connected = asyncio.Event()
+        self.answers: "asyncio.Queue[Dict]" = asyncio.Queue()
+        self.pending: Optional[Dict] = None # Question waiting for an answer, sent again when the seat reconnects
+        self.questions = 0
+
+    async def send(self, message: Dict) -> None:
+        if self.socket is not None and not self.socket.closed:
+            await self.socket.send_json(message)
+
+    async def close(self) -> None:
+        if self.socket is not None and not self.socket.closed:
+            await self.socket.close()
+
+    # Every question gets a new id, and only an answer echoing it is taken
+    async def ask(self, question: Dict) -> Dict:
+        self.questions += 1
+        question = {**question, "id": self.questions}
+        while not self.answers.empty():
+            self.answers.get_nowait()
+
+        self.pending = question
+        await self.send(question)
+        while True:
+            answer = await self.answers.get()
+            if answer.get("id") == question["id"]:
+                break
+        self.pending = None
+        return answer
+
+    def is_pending(self, answer: Dict) -> bool:
+        return self.pending is not None and answer.get("id") == self.pending["id"]
+
+class Table():
+
+    def __init__(self, table_id: str, n_players: int, humans: int, path_to_images: str, points_to_win: int, inference: InferenceServer, narrator: NarratorOptions = NarratorOptions(), caption_bank: Optional[CaptionBank] = None):
+        self.table_id = table_id
+        self.inference = inference
+        self.humans: Dict[str, RemotePlayer] = {}
+        self.status = "waiting"
+        self.winners: List[Seat] = []
+
+        bots = 0
+        def player_factory(player_name: str, points_to_win: int) -> Seat:
+            nonlocal bots
+            if len(self.humans) < humans:
+                human = RemotePlayer(f"Human {len(self.humans) + 1}", points_to_win)
+                self.humans[human.player_name] = human
+                return human
+            bots += 1
+            models = inference.models
+            return Bot(f"Bot {bots}", points_to_win, models.blip_model, models.blip_processor, models.clip_model, models.clip_processor, inference.card_index, inference, narrator, caption_bank)
+
+        self.game = Game(n_players, 0, path_to_images, False, points_to_win, False, verbose=False, game_id=table_id, player_factory=player_factory)
+
+    def state(self) -> Dict:
+        return {
+            "table": self.table_id,
+            "status": self.status,
+            "round": self.game.rounds_played,
+            "points": {str(p): p.points for p in self.game.players},
+            "seats": {name: human.socket is not None for name, human in self.humans.items()},
+            "winners": [str(p) for p in self.winners]
+        }
+
+    async def broadcast(self, message: Dict) -> None:
+        await asyncio.gather(*(human.send(message) for human in self.humans.values()))
+
+    async def play(self) -> None:
+        await asyncio.gather(*(human.connected.wait() for human in self.humans.values()))
+        self.status = "playing"
+        try:
+            while not self.game.is_over():
+                await self.play_round()
+        except Exception as e:
+            self.status = "error"
+            await self.broadcast({"type": "error", "message": f"The table stopped: {e}"})
+            # The seats would wait for questions that never come
+            await asyncio.gather(*(human.close() for human in self.humans.values()))
+            raise
+
+        self.winners = self.game.winners()
+        self.status = "finished"
+        await self.broadcast({"type": "game_over", **self.state()})
+
+    # Same round as Game.do_one_round: the humans are asked at the same time as the bots run their forward passes
+    async def play_round(self) -> None:
+        game = self.game
+        current_player = game.first_to_start
+        narrator = game.players[current_player]
+        other_players = [player for player in game.players if player is not narrator]
+        bots = [player for player in other_players if player.model_backed]
+        humans = [player for player in other_players if isinstance(player, RemotePlayer)]
+
+        if isinstance(narrator, RemotePlayer):
+            narrator_card, caption = await self.ask_narration(narrator)
+        else:
+            narrator_card, caption = await self.bot_narration(narrator)
+        await self.broadcast({"type": "narration", "round": game.rounds_played + 1, "narrator": str(narrator), "caption": caption})
+
+        hand_scores, human_cards = await asyncio.gather(self.score_hands(caption, bots), asyncio.gather(*(self.ask_selection(human, caption) for human in humans)))
+        selected_cards = dict(zip(humans, human_cards))
+        for bot in bots:
+            selected_cards[bot] = bot.select_card_from_scores(hand_scores[bot])
+        cards_on_table = [(player, selected_cards[player]) for player in other_players] + [(narrator, narrator_card)]
+
+        # Every bot masks its own card from the scores of the whole table, as in Game.score_table
+        table_scores, human_votes = await asyncio.gather(self.score_table(caption, cards_on_table, bots),
+                                                         asyncio.gather(*(self.ask_vote(human, caption, cards_on_table) for human in humans)))
+        players_votes = dict(zip(humans, human_votes))
+        for bot in bots:
+            players_votes[bot] = bot.get_most_likely_card_from_scores(cards_on_table, table_scores)
+
+        votes = {player: [] for player in game.players}
+        for player in other_players:
+            votes[players_votes[player]].append(player)
+
+        game.compute_scores(votes, current_player, other_players)
+        game.end_round(cards_on_table, current_player)
+
+        await self.broadcast({
+            "type": "round_result",
+            "round": game.rounds_played,
+            "narrator": str(narrator),
+            "caption": caption,
+            "cards": {str(player): card.image_number for player, card in cards_on_table},
+            "votes": {str(player): [str(voter) for voter in voters] for player, voters in votes.items()},
+            "points": {str(p): p.points for p in game.players}
+        })
+
+    # In a thread, as the bot may rerank its candidate captions or read them from the caption bank (see Bot.get_card_and_caption);
+    # a single live caption still goes through the inference server
+    async def bot_narration(self, bot: Bot) -> Tuple[Card, str]:
+        return await asyncio.to_thread(bot.get_card_and_caption)
+
+    async def score_cards(self, caption: str, cards: List[Card]) -> torch.Tensor:
+        return await asyncio.wrap_future(self.inference.submit_score(caption, cards))
+
+    # Only the bots vote with the scores, a table of humans does not run the models
+    async def score_table(self, caption: str, cards_on_table: List[Tuple[Seat, Card]], bots: List[Player]) -> Optional[torch.Tensor]:
+        if len(bots) == 0:
+            return None
+        return await self.score_cards(caption, [card for _, card in cards_on_table])
+
+    # The hands of all the bots of the table in one request, as in Game.score_hands
+    async def score_hands(self, caption: str, bots: List[Player]) -> Dict[Player, torch.Tensor]:
+        if len(bots) == 0:
+            return {}
+        logits_per_image = await self.score_cards(caption, [card for bot in bots for card in bot.cards_in_hand])
+
+        hand_scores = {}
+        start = 0
+        for bot in bots:
+            end = start + len(bot.cards_in_hand)
+            hand_scores[bot] = logits_per_image[start:end]
+            start = end
+        return hand_scores
+
+    # Asks again until the answer names one of the valid cards
+    async def ask_card(self, human: RemotePlayer, question: Dict, valid_cards: Dict[int, Card]) -> Tuple[Card, Dict]:
+        while True:
+            answer = await human.ask(question)
+            card = valid_cards.get(answer.get("card"))
+            if card is not None:
+                return card, answer
+            await human.send({"type": "error", "message": f"Choose one of the cards {sorted(valid_cards)}"})
+
+    async def ask_narration(self, human: RemotePlayer) -> Tuple[Card, str]:
+        while True:
+            card, answer = await self.ask_card(human, {"type": "narrate", "hand": [card.image_number for card in human.cards_in_hand]}, {card.image_number: card for card in human.cards_in_hand})
+            caption = str(answer.get("caption", "")).strip()
+            if len(caption) != 0:
+                break
+            await human.send({"type": "error", "message": "The caption cannot be empty"})
+
+        human.cards_in_hand.remove(card)
+        return card, caption
+
+    async def ask_selection(self, human: RemotePlayer, caption: str) -> Card:
+        card, _ = await self.ask_card(human, {"type": "select", "caption": caption, "hand": [card.image_number for card in human.cards_in_hand]}, {card.image_number: card for card in human.cards_in_hand})
+        human.cards_in_hand.remove(card)
+        return card
+
+    # The cards are sent sorted, so that their order does not tell who played them
+    async def ask_vote(self, human: RemotePlayer, caption: str, cards_on_table: List[Tuple[Seat, Card]]) -> Seat:
+        others_cards = {card.image_number: (player, card) for player, card in cards_on_table if player is not human}
+        card, _ = await self.ask_card(human, {"type": "vote", "caption": caption, "cards": sorted(others_cards)}, {image_number: card for image_number, (_, card) in others_cards.items()})
+        return others_cards[card.image_number][0]
+
+def create_app(inference: InferenceServer, path_to_images: str, max_tables: int = 64, narrator: NarratorOptions = NarratorOptions(), caption_bank: Optional[CaptionBank] = None) -> web.Application:
+    app = web.Application()
+    tables: Dict[str, Table] = {}
+    tasks: Dict[str, asyncio.Task] = {}
+    next_id = 0
+
+    # Packs the deck (if needed) once, before the first table reads it
+    load_deck(path_to_images)
+
+    def get_table(request: web.Request) -> Table:
+        table = tables.get(request.match_info["table"])
+        if table is None:
+            raise web.HTTPNotFound(text=json.dumps({"error": "no such table"}), content_type="application/json")
+        return table
+
+    # A table stopped by an error (its seats already closed by Table.play) is dropped, the finished ones are kept to show their winners
+    def drop_table(table_id: str, task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Table {table_id} stopped: {task.exception()!r}")
+            tables.pop(table_id, None)
+            tasks.pop(table_id, None)
+
+    async def create_table(request: web.Request) -> web.Response:
+        nonlocal next_id
+        try:
+            data = await request.json() if request.can_read_body else {}
+            n_players, humans, points_to_win = int(data.get("players", 5)), int(data.get("humans", 1)), int(data.get("points_to_win", 30))
+        except (ValueError, TypeError):
+            return web.json_response({"error": "invalid table settings"}, status=400)
+
+        if not 3 <= n_players <= 6 or not 0 <= humans <= n_players or points_to_win <= 0:
+            return web.json_response({"error": "players must be between 3 and 6, humans between 0 and players"}, status=400)
+        if sum(table.status in ["waiting", "playing"] for table in tables.values()) >= max_tables:
+            return web.json_response({"error": "too many open tables"}, status=503)
+
+        next_id += 1
+        table = Table(str(next_id), n_players, humans, path_to_images, points_to_win, inference, narrator, caption_bank)
+        tables[table.table_id] = table
+        tasks[table.table_id] = asyncio.create_task(table.play())
+        tasks[table.table_id].add_done_callback(lambda task: drop_table(table.table_id, task))
+        return web.json_response({"table": table.table_id, "seats": list(table.humans)}, status=201)
+
+    async def list_tables(request: web.Request) -> web.Response:
+        return web.json_response([table.state() for table in tables.values()])
+
+    async def table_state(request: web.Request) -> web.Response:
+        return web.json_response(get_table(request).state())
+
+    async def seat_socket(request: web.Request) -> web.WebSocketResponse:
+        table = get_table(request)
+        human = table.humans.get(f"Human {request.match_info['seat']}")
+        if human is None:
+            raise web.HTTPNotFound(text=json.dumps({"error": "no such seat"}), content_type="application/json")
+        if human.socket is not None and not human.socket.closed:
+            raise web.HTTPConflict(text=json.dumps({"error": "seat already taken"}), content_type="application/json")
+
+        socket = web.WebSocketResponse()
+        await socket.prepare(request)
+        human.socket = socket
+        human.connected.set()
+
+        await socket.send_json({"type": "welcome", "seat": human.player_name, **table.state()})
+        if human.pending is not None:
+            await socket.send_json(human.pending)
+
+        async for message in socket:
+            if message.type != WSMsgType.TEXT:
+                continue
+            try:
+                answer = json.loads(message.data)
+            except json.JSONDecodeError:
+                await socket.send_json({"type": "error", "message": "invalid JSON"})
+                continue
+            if not isinstance(answer, dict) or not human.is_pending(answer):
+                await socket.send_json({"type": "error", "message": "no question with this id is waiting for an answer"})
+                continue
+            human.answers.put_nowait(answer)
+
+        if human.socket is socket:
+            human.socket = None
+        return socket
+
+    async def close_tables(app: web.Application) -> None:
+        for task in tasks.values():
+            task.cancel()
+        await asyncio.gather(*tasks.values(), return_exceptions=True)
+
+    app.router.add_post("/tables", create_table)
+    app.router.add_get("/tables", list_tables)
+    app.router.add_get("/tables/{table}", table_state)
+    app.router.add_get("/tables/{table}/seats/{seat}", seat_socket)
+    app.on_cleanup.append(close_tables)
+    return app
+
+if __name__ == "__main__":
+
+    args = argument_parsing()
+    device = device_name()
+
+    # The only copy of the models, whatever the number of tables
+    print("Loading models...")
+    models = load_models(args.blip_weights, args.clip_weights, device)
+    card_index = CardIndex.load_or_build(args.deck, models.clip_weights, models.clip_model, models.clip_processor, device)
+    caption_bank = None
+    if args.caption_bank:
+        caption_bank = CaptionBank.find(args.deck, models.blip_weights, models.clip_weights, device)
+        if caption_bank is None:
+            print("No caption bank for this deck and these models, the captions are generated live (run caption_bank.py once to build it)")
+    print("Models loaded successfully!")
+
+    narrator = NarratorOptions(args.narrator_candidates, args.narrator_target, args.narrator_max_time, args.caption_bank)
+    with InferenceServer(models, card_index, device, args.max_batch_size, args.max_latency) as inference:
+        web.run_app(create_app(inference, args.deck, args.max_tables, narrator, caption_bank), host=args.host, port=args.port)
@@ -1,111 +1,48 @@
 from player import Player
 from card import Card
+from gpt_client import GPTClient, GPTUnavailableError
+from image_payload import ImagePayloadCache
+from instrumentation import profiled
 
-from typing import List, Tuple
-import base64
-import io
-import requests
-import time
+from typing import Any, Coroutine, Dict, List, Optional, Tuple, TypeVar
+import asyncio
 import re
 import sys
-from PIL import Image
+from concurrent.futures import Future
 
-class GPT_bot(Player):
-    def __init__(self, player_name: str, points_to_win: int, api_key: str):
-        super().__init__(player_name, points_to_win)
+T = TypeVar("T")
 
-        self.api_key = api_key
+SELECTION_PROMPT = "You are playing a game of Dixit. Your task is to select the best matching card for a given story prompt from the images provided. Return the index of the selected card as a number between 0 and N-1, where N is the number of cards."
+NARRATOR_PROMPT = "You are playing a game of Dixit. Your task is to select a card and return a caption for it. Return the index of the selected card as a number between 0 and N-1, where N is the number of cards. Return also the caption between quotes"
 
-        self.headers = {"Content-Type": "application/json", "Authorization": f"Bearer {api_key}"}
+class GPT_bot(Player):
+    def __init__(self, player_name: str, points_to_win: int, client: GPTClient, payloads: Optional[ImagePayloadCache] = None):
+        super().__init__(player_name, points_to_win)
 
-    def encode_image(self, image: Image.Image) -> str:
-        buffered = io.BytesIO()
-        image.save(buffered, format="PNG") 
-        image_bytes = buffered.getvalue()
-        return base64.b64encode(image_bytes).decode('utf-8')
+        self.client = client
+        self.payloads = payloads if payloads is not None else ImagePayloadCache()
 
-    def get_card_and_caption(self) -> Tuple[Card, str]:
-        print(f"{self.player_name} is giving a caption...")
+        # Size (in bytes) of the images sent in each request
+        self.request_payload_bytes: List[int] = []
 
-        base64_cards = [self.encode_image(card.image) for card in self.cards_in_hand]
+    def create_request(self, system_prompt: str, cards: List[Card], caption: Optional[str] = None) -> Dict:
         messages = [
             {
                 "role": "system",
-                "content": "You are playing a game of Dixit. Your task is to select a card and return a caption for it. Return the index of the selected card as a number between 0 and N-1, where N is the number of cards. Return also the caption between quotes"
+                "content": system_prompt
             }
         ]
 
-        for idx, base64_image in enumerate(base64_cards):
+        if caption is not None:
             messages.append({
                 "role": "user",
-                "content": [{
-                        "type": "text",
-                        "text": f"This is card with index {idx}"
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}
-                    }
-                ]
+                "content": f"The story prompt is: {caption}."
             })
 
-        data = {
-            "model": "gpt-4o-mini",
-            "messages": messages
-        }
-
-        
-        max_retries = 3
-        retries = 0
-
-        while retries < max_retries:
-
-            try:
-                response = requests.post('https://api.openai.com/v1/chat/completions', headers=self.headers, json=data)
-                response = response.json()
-
-                content = response['choices'][0]["message"]['content']
-                number_pattern = r'\d+'
-                caption_pattern = r'"([^"]+)"'
-                number_match = re.search(number_pattern, content)
-                caption_match = re.search(caption_pattern, content)
-                index = number_match.group() if number_match else None
-                caption = caption_match.group() if caption_match else None
-                caption = caption.replace("\"", "")
-
-                index = int(index)
-
-                card_to_play = self.cards_in_hand[index]
-                self.cards_in_hand.remove(card_to_play)
-                print(f"{self.player_name} selected a card with caption: \"{caption}\"")
-
-                return card_to_play, caption
-            except Exception  as e:
-                retries += 1
-
-                time.sleep(retries * 60)
-
-        print("MAXIMUM RETRIES NUMBER REACHED. THE GPT BOT IS NOT AVAILABLE AT THE MOMENT. RETRY LATER.")
-        sys.exit(1)
-                
-
-    
-    def select_card_from_caption(self, caption: str) -> Card:
-        print(f"{self.player_name} is selecting a card...")
-        
-        base64_cards = [self.encode_image(card.image) for card in self.cards_in_hand]
-        messages = [
-            {
-                "role": "system",
-                "content": "You are playing a game of Dixit. Your task is to select the best matching card for a given story prompt from the images provided. Return the index of the selected card as a number between 0 and N-1, where N is the number of cards."
-            },
-            {
-                "role": "user",
-                "content": f"The story prompt is: {caption}."
-            }
-        ]
+        image_urls = [self.payloads.data_url(card) for card in cards]
+        self.request_payload_bytes.append(sum(len(url) for url in image_urls))
 
-        for idx, base64_image in enumerate(base64_cards):
+        for idx, image_url in enumerate(image_urls):
             messages.append({
                 "role": "user",
                 "content": [{
@@ -114,94 +51,84 @@ class GPT_bot(Player):
                     },
                     {
                         "type": "image_url",
-                        "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}
+                        "image_url": {"url": image_url}
                     }
                 ]
             })
 
-        data = {
+        return {
             "model": "gpt-4o-mini",
             "messages": messages
         }
 
-        max_retries = 3
-        retries = 0
+    # The sync methods block the game until the answer arrives, the async ones let it send the requests of several GPT players at once
+    @profiled
+    def get_card_and_caption(self) -> Tuple[Card, str]:
+        return self.run(self.aget_card_and_caption())
 
-        while retries < max_retries:
+    @profiled
+    def select_card_from_caption(self, caption: str) -> Card:
+        return self.run(self.aselect_card_from_caption(caption))
 
-            try:
-                response = requests.post('https://api.openai.com/v1/chat/completions', headers=self.headers, json=data)
-                response = response.json()
+    @profiled
+    def get_most_likely_card(self, cards_on_table: List[Tuple[Player, Card]], caption: str) -> Player:
+        return self.run(self.aget_most_likely_card(cards_on_table, caption))
 
-                content = response['choices'][0]["message"]['content']
-                match = re.search(r'\d+', content)
-                index = int(match.group())  
+    async def aget_card_and_caption(self) -> Tuple[Card, str]:
+        self.log(f"{self.player_name} is giving a caption...")
 
-                selected_card = self.cards_in_hand[index]
-                self.cards_in_hand.remove(selected_card)
+        def parse(content: str) -> Tuple[Card, str]:
+            card = self.cards_in_hand[int(re.search(r'\d+', content).group())]
+            caption = re.search(r'"([^"]+)"', content).group().replace("\"", "")
+            return card, caption
 
-                return selected_card
-            
-            except Exception  as e:
-                retries += 1
+        card_to_play, caption = await self.client.complete(self.create_request(NARRATOR_PROMPT, self.cards_in_hand), parse)
+        self.cards_in_hand.remove(card_to_play)
+        self.log(f"{self.player_name} selected a card with caption: \"{caption}\"")
 
-                time.sleep(retries * 60)
+        return card_to_play, caption
 
-        print("MAXIMUM RETRIES NUMBER REACHED. THE GPT BOT IS NOT AVAILABLE AT THE MOMENT. RETRY LATER.")
-        sys.exit(1)
-    
-    def get_most_likely_card(self, cards_on_table: List[Tuple[Player, Card]], caption: str) -> Player:
-        print(f"{self.player_name} is voting...")
-        
-        base64_cards = [self.encode_image(card.image) for _, card in cards_on_table]
-        messages = [
-            {
-                "role": "system",
-                "content": "You are playing a game of Dixit. Your task is to select the best matching card for a given story prompt from the images provided. Return the index of the selected card as a number between 0 and N-1, where N is the number of cards."
-            },
-            {
-                "role": "user",
-                "content": f"The story prompt is: {caption}."
-            }
-        ]
+    async def aselect_card_from_caption(self, caption: str) -> Card:
+        self.log(f"{self.player_name} is selecting a card...")
 
-        for idx, base64_image in enumerate(base64_cards):
-            messages.append({
-                "role": "user",
-                "content": [{
-                        "type": "text",
-                        "text": f"This is card with index {idx}"
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}
-                    }
-                ]
-            })
+        def parse(content: str) -> Card:
+            return self.cards_in_hand[int(re.search(r'\d+', content).group())]
 
-        data = {
-            "model": "gpt-4o-mini",
-            "messages": messages
-        }
+        selected_card = await self.client.complete(self.create_request(SELECTION_PROMPT, self.cards_in_hand, caption), parse)
+        self.cards_in_hand.remove(selected_card)
+
+        return selected_card
+
+    async def aget_most_likely_card(self, cards_on_table: List[Tuple[Player, Card]], caption: str) -> Player:
+        self.log(f"{self.player_name} is voting...")
 
-        max_retries = 3
-        retries = 0
+        def parse(content: str) -> Player:
+            return cards_on_table[int(re.search(r'\d+', content).group())][0]
 
-        while retries < max_retries:
+        return await self.client.complete(self.create_request(SELECTION_PROMPT, [card for _, card in cards_on_table], caption), parse)
 
-            try:
-                response = requests.post('https://api.openai.com/v1/chat/completions', headers=self.headers, json=data)
-                response = response.json()
+    def run(self, coroutine: Coroutine[Any, Any, T]) -> T:
+        return GPT_bot.wait(self.client.submit(coroutine))
 
-                content = response['choices'][0]["message"]['content']
-                match = re.search(r'\d+', content)
-                index = int(match.group())  
+    @staticmethod
+    @profiled
+    def wait(future: "Future[T]") -> T:
+        try:
+            return future.result()
+        except GPTUnavailableError as e:
+            print(f"THE GPT BOT IS NOT AVAILABLE AT THE MOMENT ({e}). RETRY LATER.")
+            sys.exit(1)
 
-                return cards_on_table[index][0]
-            except Exception  as e:
-                retries += 1
+    # Sends the selection requests of all the GPT players (sharing the same client) at once, the returned future holds their cards in the same order
+    @staticmethod
+    def submit_selections(players: List["GPT_bot"], caption: str) -> "Future[List[Card]]":
+        async def select_all() -> List[Card]:
+            return await asyncio.gather(*[p.aselect_card_from_caption(caption) for p in players])
+        return players[0].client.submit(select_all())
 
-                time.sleep(retries * 60)
-        
-        print("MAXIMUM RETRIES NUMBER REACHED. THE GPT BOT IS NOT AVAILABLE AT THE MOMENT. RETRY LATER.")
-        sys.exit(1)
+    # Same for the votes, each player receives the table without its own card
+    @staticmethod
+    def submit_votes(players: List["GPT_bot"], cards_on_table: List[Tuple[Player, Card]], caption: str) -> "Future[List[Player]]":
+        async def vote_all() -> List[Player]:
+            return await asyncio.gather(*[p.aget_most_likely_card([(q, card) for q, card in cards_on_table if q != p], caption) for p in players])
+        return players[0].client.submit(vote_all())
@@ -0,0 +1,80 @@
+import asyncio
+import random
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Coroutine, Dict, Optional, TypeVar
+
+import aiohttp
+
+from instrumentation import timer
+
+T = TypeVar("T")
+
+OPENAI_URL = "https://api.openai.com/v1/chat/completions"
+
+class GPTUnavailableError(Exception):
+    pass
+
+# Shared by all the GPT players of a process: one pooled HTTP session living in its own event loop thread,
+# so that the (blocking) game can send several requests at once and wait for them together
+class GPTClient():
+
+    def __init__(self, api_key: str, api_url: str = OPENAI_URL, timeout: float = 60.0, max_retries: int = 3, backoff_base: float = 1.0, backoff_max: float = 60.0, max_connections: int = 16):
+        self.api_key = api_key
+        self.api_url = api_url
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_connections = max_connections
+
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.rng = random.Random()
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="gpt-client", daemon=True)
+        self.thread.start()
+
+    def submit(self, coroutine: Coroutine[Any, Any, T]) -> "Future[T]":
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def run(self, coroutine: Coroutine[Any, Any, T]) -> T:
+        return self.submit(coroutine).result()
+
+    def close(self) -> None:
+        if self.session is not None:
+            self.run(self.session.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    # Full jitter: a random wait between 0 and the exponential backoff, capped at backoff_max
+    def backoff(self, attempt: int) -> float:
+        return self.rng.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def get_session(self) -> aiohttp.ClientSession:
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                headers={"Content-Type": "application/json", "Authorization": f"Bearer {self.api_key}"},
+                connector=aiohttp.TCPConnector(limit=self.max_connections),
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+        return self.session
+
+    # Sends the request and parses the content of the answer, retrying on network errors, timeouts, rate limits (429), server errors (5xx)
+    # and answers that cannot be parsed. The other client errors (e.g. 400 or 401) would fail again, so they are not retried
+    async def complete(self, data: Dict, parse: Callable[[str], T]) -> T:
+        for attempt in range(self.max_retries):
+            try:
+                with timer("GPTClient.request"):
+                    async with self.get_session().post(self.api_url, json=data) as response:
+                        if 400 <= response.status < 500 and response.status != 429:
+                            raise GPTUnavailableError(f"the API answered {response.status} {response.reason}")
+                        response.raise_for_status()
+                        response = await response.json()
+
+                return parse(response['choices'][0]["message"]['content'])
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, LookupError, AttributeError, TypeError):
+                if attempt < self.max_retries - 1:
+                    await asyncio.sleep(self.backoff(attempt))
+
+        raise GPTUnavailableError(f"no valid answer after {self.max_retries} attempts")
@@ -0,0 +1,45 @@
+import asyncio
+import random
+import argparse
+from argparse import Namespace
+from typing import Optional
+
+from aiohttp import web
+
+# Local stand-in for the chat completions endpoint: it answers with a random card index (and caption),
+# optionally after some latency or with an error, so that the GPT players can be run without the real API
+def argument_parsing() -> Namespace:
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--port", type=int, default=8080, help="Specify the port of the server")
+    parser.add_argument("--latency", type=float, default=0.0, help="Specify the time (in seconds) taken to answer each request")
+    parser.add_argument("--failure_rate", type=float, default=0.0, help="Specify the probability of answering with an error")
+    parser.add_argument("--seed", type=int, default=None, help="Specify the seed used for the answers")
+
+    return parser.parse_args()
+
+def create_app(latency: float = 0.0, failure_rate: float = 0.0, seed: Optional[int] = None) -> web.Application:
+    rng = random.Random(seed)
+    app = web.Application()
+    app["requests"] = 0
+
+    async def chat_completions(request: web.Request) -> web.Response:
+        app["requests"] += 1
+        data = await request.json()
+
+        await asyncio.sleep(latency)
+        if rng.random() < failure_rate:
+            return web.json_response({"error": {"message": "stub failure"}}, status=500)
+
+        n_cards = sum(1 for message in data["messages"] if isinstance(message["content"], list))
+        content = f"{rng.randrange(n_cards)} \"stub caption {app['requests']}\""
+        return web.json_response({"choices": [{"message": {"role": "assistant", "content": content}}]})
+
+    app.router.add_post("/v1/chat/completions", chat_completions)
+    return app
+
+if __name__ == "__main__":
+
+    args = argument_parsing()
+
+    web.run_app(create_app(args.latency, args.failure_rate, args.seed), host="127.0.0.1", port=args.port)
@@ -1,10 +1,12 @@
 from player import Player
 from card import Card
+from instrumentation import profiled
 
 from typing import Tuple, List
 
 class HumanPlayer(Player):
     
+    @profiled
     def get_card_and_caption(self) -> Tuple[Card, str]:
         card = self.select_card_from_hand()
         caption = input("Which caption would you like to use?") 
@@ -12,30 +14,26 @@ class HumanPlayer(Player):
 
         return card, caption
 
+    @profiled
     def select_card_from_caption(self, caption: str) -> Card:
         print("\n========================\n")
         card = self.select_card_from_hand()
         return card
 
+    @profiled
     def get_most_likely_card(self, cards_on_table: List[Tuple[Player, Card]], caption:str) -> Player:
         print("\n========================\n")
         print("Select the most likely card on table:")
         for _, card in cards_on_table:
             print(f"{card}")
 
+        players_by_card = {card.image_number: player for player, card in cards_on_table}
         image_number = int(input("Insert number: "))
-        valid = False
-        player_to_vote = None
-        while not valid:
-            for player, card in cards_on_table:
-                if card.image_number == image_number:
-                    valid = True
-                    player_to_vote = player
-            if not valid:
-                print("You have to insert a valid card on table!")
-                image_number = int(input("Insert number: "))
-
-        return player_to_vote
+        while image_number not in players_by_card:
+            print("You have to insert a valid card on table!")
+            image_number = int(input("Insert number: "))
+
+        return players_by_card[image_number]
 
         
     def select_card_from_hand(self) -> Card:
@@ -54,10 +52,5 @@ class HumanPlayer(Player):
         return valid_card
         
     def get_card_from_index(self, image_number: int) -> Card:
-        output_card = None
-        for card in self.cards_in_hand:
-            if card.image_number == image_number:
-                output_card = card
-
-        return output_card
+        return self.cards_in_hand.get(image_number)
 
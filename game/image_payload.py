@@ -0,0 +1,49 @@
+import io
+import base64
+import threading
+from typing import Dict, Optional
+
+from card import Card
+from instrumentation import profiled
+
+# Base64 payloads of the cards sent to GPT, encoded once per card and shared by all the GPT players
+class ImagePayloadCache():
+
+    def __init__(self, image_format: str = "JPEG", quality: int = 85, size: Optional[int] = None):
+        self.image_format = image_format.upper()
+        self.quality = quality
+        self.size = size # Side of the (square) image sent, None keeps the 224x224 card
+
+        self.payloads: Dict[int, str] = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def mime_type(self) -> str:
+        return "image/jpeg" if self.image_format in ["JPEG", "JPG"] else f"image/{self.image_format.lower()}"
+
+    @profiled
+    def encode(self, card: Card) -> str:
+        image = card.image
+        if self.size is not None:
+            image = image.resize((self.size, self.size))
+
+        buffered = io.BytesIO()
+        if self.image_format in ["JPEG", "JPG"]:
+            image.save(buffered, format="JPEG", quality=self.quality)
+        else:
+            image.save(buffered, format=self.image_format)
+        return base64.b64encode(buffered.getvalue()).decode('utf-8')
+
+    def data_url(self, card: Card) -> str:
+        with self.lock:
+            payload = self.payloads.get(card.image_number)
+            if payload is None:
+                self.misses += 1
+                payload = self.encode(card)
+                self.payloads[card.image_number] = payload
+            else:
+                self.hits += 1
+
+        return f"data:{self.mime_type};base64,{payload}"
@@ -0,0 +1,171 @@
+import time
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+import torch
+
+from card import Card
+from card_index import CardIndex
+from models import Models
+from captioning import caption_images
+from clip_features import caption_logits, encode_images, encode_text_cached
+
+class _Request():
+    def __init__(self, kind: str, payload: Tuple):
+        self.kind = kind
+        self.payload = payload
+        self.future = Future()
+        self.submitted_at = time.perf_counter()
+
+# Collects the CLIP scoring and BLIP captioning requests of all the bots (and tables) of a process and runs them in batches.
+# A batch is closed when it reaches max_batch_size or when its oldest request has waited max_latency seconds.
+class InferenceServer():
+
+    def __init__(self, models: Models, card_index: Optional[CardIndex], device: str, max_batch_size: int = 32, max_latency: float = 0.005):
+        self.models = models
+        self.card_index = card_index
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+
+        self.requests = queue.Queue()
+        self.worker = None
+        self.metrics_lock = threading.Lock()
+        self.reset_metrics()
+
+    def start(self) -> "InferenceServer":
+        self.worker = threading.Thread(target=self.serve, name="inference-server", daemon=True)
+        self.worker.start()
+        return self
+
+    def stop(self) -> None:
+        if self.worker is None:
+            return
+        self.requests.put(None)
+        self.worker.join()
+        self.worker = None
+
+    def __enter__(self) -> "InferenceServer":
+        return self.start()
+
+    def __exit__(self, *_) -> None:
+        self.stop()
+
+    def submit_score(self, caption: str, cards: List[Card]) -> Future:
+        return self.submit(_Request("score", (caption, cards)))
+
+    # max_time is the time budget of the generation (see NarratorOptions)
+    def submit_caption(self, image: np.ndarray, max_time: Optional[float] = None) -> Future:
+        return self.submit(_Request("caption", (image, max_time)))
+
+    # Blocking helpers used by the bots
+    def score(self, caption: str, cards: List[Card]) -> torch.Tensor:
+        return self.submit_score(caption, cards).result()
+
+    def caption(self, image: np.ndarray, max_time: Optional[float] = None) -> str:
+        return self.submit_caption(image, max_time).result()
+
+    def submit(self, request: _Request) -> Future:
+        self.requests.put(request)
+        with self.metrics_lock:
+            self.max_queue_depth = max(self.max_queue_depth, self.requests.qsize())
+        return request.future
+
+    def serve(self) -> None:
+        while True:
+            request = self.requests.get()
+            if request is None:
+                return
+
+            batch = [request]
+            deadline = request.submitted_at + self.max_latency
+            stopping = False
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self.requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if request is None:
+                    stopping = True
+                    break
+                batch.append(request)
+
+            for kind, run_batch in [("score", self.run_score_batch), ("caption", self.run_caption_batch)]:
+                requests = [r for r in batch if r.kind == kind]
+                if len(requests) == 0:
+                    continue
+                try:
+                    run_batch(requests)
+                except Exception as e:
+                    for r in requests:
+                        if not r.future.done():
+                            r.future.set_exception(e)
+                self.record_batch(kind, requests)
+
+            if stopping:
+                return
+
+    # One text forward for all the distinct captions not already cached, plus one image forward for all the cards when there is no card index
+    def run_score_batch(self, requests: List[_Request]) -> None:
+        captions = list(dict.fromkeys(r.payload[0] for r in requests))
+        text_embeds = encode_text_cached(self.models.clip_model, self.models.clip_processor, captions, self.device)
+
+        cards = [card for r in requests for card in r.payload[1]]
+        if self.card_index is not None:
+            image_embeds = self.card_index.embeddings_for(cards)
+        else:
+            image_embeds = encode_images(self.models.clip_model, self.models.clip_processor, [card.pixels for card in cards], self.device)
+
+        start = 0
+        for r in requests:
+            caption, request_cards = r.payload
+            caption_idx = captions.index(caption)
+            end = start + len(request_cards)
+            r.future.set_result(caption_logits(self.models.clip_model, text_embeds[caption_idx:caption_idx + 1], image_embeds[start:end]))
+            start = end
+
+    # One generate call per time budget, so that a request is never cut by the budget of another one
+    def run_caption_batch(self, requests: List[_Request]) -> None:
+        budgets: Dict[Optional[float], List[_Request]] = {}
+        for r in requests:
+            budgets.setdefault(r.payload[1], []).append(r)
+
+        for max_time, group in budgets.items():
+            captions = caption_images(self.models.blip_model, self.models.blip_processor, [r.payload[0] for r in group], self.device, max_time=max_time)
+            for r, caption in zip(group, captions):
+                r.future.set_result(caption)
+
+    def record_batch(self, kind: str, requests: List[_Request]) -> None:
+        now = time.perf_counter()
+        with self.metrics_lock:
+            self.n_requests[kind] += len(requests)
+            self.n_batches[kind] += 1
+            self.batch_sizes[kind][len(requests)] = self.batch_sizes[kind].get(len(requests), 0) + 1
+            self.total_wait[kind] += sum(now - r.submitted_at for r in requests)
+
+    def reset_metrics(self) -> None:
+        with self.metrics_lock:
+            self.n_requests = {"score": 0, "caption": 0}
+            self.n_batches = {"score": 0, "caption": 0}
+            self.batch_sizes: Dict[str, Dict[int, int]] = {"score": {}, "caption": {}}
+            self.total_wait = {"score": 0.0, "caption": 0.0}
+            self.max_queue_depth = 0
+
+    def metrics(self) -> Dict:
+        with self.metrics_lock:
+            return {
+                "queue_depth": self.requests.qsize(),
+                "max_queue_depth": self.max_queue_depth,
+                **{kind: {
+                    "requests": self.n_requests[kind],
+                    "batches": self.n_batches[kind],
+                    "mean_batch_size": self.n_requests[kind] / self.n_batches[kind] if self.n_batches[kind] else 0.0,
+                    "mean_latency": self.total_wait[kind] / self.n_requests[kind] if self.n_requests[kind] else 0.0,
+                    "batch_sizes": dict(self.batch_sizes[kind])
+                } for kind in ["score", "caption"]}
+            }
@@ -0,0 +1,219 @@
+import os
+import sys
+import json
+import time
+import resource
+import threading
+import functools
+from bisect import bisect_left
+from contextlib import nullcontext
+from typing import Callable, ContextManager, Dict, List, Optional, TypeVar
+
+# Opt-in timers of the hot paths (player decisions, model forwards and generation, image preprocessing, GPT requests, deck operations)
+# and per phase latency and memory, exported as Prometheus histograms and as a JSON summary.
+# When profiling is not enabled the timers only check a global, so they can stay on the hot paths.
+
+F = TypeVar("F", bound=Callable)
+
+# Upper bounds (in seconds) of the histogram buckets, the last bucket (+Inf) is implicit
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class Histogram():
+
+    def __init__(self, counts: Optional[List[int]] = None, total: float = 0.0, maximum: float = 0.0):
+        self.counts = counts if counts is not None else [0] * (len(BUCKETS) + 1)
+        self.total = total
+        self.maximum = maximum
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.maximum = max(self.maximum, seconds)
+
+    def merge(self, other: "Histogram") -> None:
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.total += other.total
+        self.maximum = max(self.maximum, other.maximum)
+
+    # Linear interpolation inside the bucket holding the quantile, as histogram_quantile does in Prometheus
+    # (the maximum bounds the last bucket)
+    def quantile(self, q: float) -> float:
+        target = q * self.count
+        cumulative = 0
+        for k, count in enumerate(self.counts):
+            if count != 0 and cumulative + count >= target:
+                lower = BUCKETS[k - 1] if k > 0 else 0.0
+                upper = min(BUCKETS[k], self.maximum) if k < len(BUCKETS) else self.maximum
+                return lower + (upper - lower) * (target - cumulative) / count
+            cumulative += count
+        return self.maximum
+
+    def to_dict(self) -> Dict:
+        return {"counts": self.counts, "total": self.total, "maximum": self.maximum}
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "Histogram":
+        return cls(list(data["counts"]), data["total"], data["maximum"])
+
+def current_rss_bytes() -> Optional[int]:
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+def peak_rss_bytes() -> int:
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 2**10
+
+# Peak of the memory allocated by torch on the GPU since the last call (None on CPU, where torch does not track it)
+def torch_peak_allocated_bytes() -> Optional[int]:
+    torch = sys.modules.get("torch")
+    if torch is None or not torch.cuda.is_available() or not torch.cuda.is_initialized():
+        return None
+    peak = torch.cuda.max_memory_allocated()
+    torch.cuda.reset_peak_memory_stats()
+    return peak
+
+class Profiler():
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phases: Dict[str, Histogram] = {}
+        self.operations: Dict[str, Histogram] = {}
+        self.memory: Dict[str, Dict[str, int]] = {} # Largest values seen at the end of each phase
+
+    def record(self, operation: str, seconds: float) -> None:
+        with self.lock:
+            self.operations.setdefault(operation, Histogram()).observe(seconds)
+
+    def record_phase(self, phase: str, seconds: float) -> None:
+        sample = {"rss_bytes": current_rss_bytes(), "peak_rss_bytes": peak_rss_bytes(), "torch_peak_allocated_bytes": torch_peak_allocated_bytes()}
+        with self.lock:
+            self.phases.setdefault(phase, Histogram()).observe(seconds)
+            memory = self.memory.setdefault(phase, {})
+            for key, value in sample.items():
+                if value is not None:
+                    memory[key] = max(memory.get(key, 0), value)
+
+    # Plain data, to be sent between processes and merged (e.g. by the tournament)
+    def snapshot(self) -> Dict:
+        with self.lock:
+            return {
+                "phases": {name: histogram.to_dict() for name, histogram in self.phases.items()},
+                "operations": {name: histogram.to_dict() for name, histogram in self.operations.items()},
+                "memory": {phase: dict(memory) for phase, memory in self.memory.items()}
+            }
+
+    def merge(self, snapshot: Dict) -> None:
+        with self.lock:
+            for kind, histograms in [("phases", self.phases), ("operations", self.operations)]:
+                for name, data in snapshot[kind].items():
+                    histograms.setdefault(name, Histogram()).merge(Histogram.from_dict(data))
+            for phase, memory in snapshot["memory"].items():
+                merged = self.memory.setdefault(phase, {})
+                for key, value in memory.items():
+                    merged[key] = max(merged.get(key, 0), value)
+
+    def summary(self) -> Dict:
+        def describe(histogram: Histogram) -> Dict:
+            return {
+                "count": histogram.count,
+                "total_seconds": histogram.total,
+                "mean_ms": 1000 * histogram.total / histogram.count if histogram.count else 0.0,
+                "p50_ms": 1000 * histogram.quantile(0.5),
+                "p95_ms": 1000 * histogram.quantile(0.95),
+                "max_ms": 1000 * histogram.maximum
+            }
+
+        with self.lock:
+            return {
+                "phases": {name: {**describe(histogram), **self.memory.get(name, {})} for name, histogram in sorted(self.phases.items())},
+                "operations": {name: describe(histogram) for name, histogram in sorted(self.operations.items())}
+            }
+
+    # Prometheus text exposition format (for the node exporter textfile collector)
+    def prometheus(self) -> str:
+        lines = []
+        with self.lock:
+            for metric, label, histograms in [("dixit_phase_seconds", "phase", self.phases), ("dixit_operation_seconds", "operation", self.operations)]:
+                lines.append(f"# TYPE {metric} histogram")
+                for name, histogram in sorted(histograms.items()):
+                    cumulative = 0
+                    for bound, count in zip([str(bound) for bound in BUCKETS] + ["+Inf"], histogram.counts):
+                        cumulative += count
+                        lines.append(f'{metric}_bucket{{{label}="{name}",le="{bound}"}} {cumulative}')
+                    lines.append(f'{metric}_sum{{{label}="{name}"}} {histogram.total}')
+                    lines.append(f'{metric}_count{{{label}="{name}"}} {histogram.count}')
+
+            for key in ["rss_bytes", "peak_rss_bytes", "torch_peak_allocated_bytes"]:
+                values = {phase: memory[key] for phase, memory in sorted(self.memory.items()) if key in memory}
+                if len(values) != 0:
+                    lines.append(f"# TYPE dixit_phase_{key} gauge")
+                    lines += [f'dixit_phase_{key}{{phase="{phase}"}} {value}' for phase, value in values.items()]
+
+        return "\n".join(lines) + "\n"
+
+    # Saves <prefix>.prom and <prefix>.json
+    def save(self, prefix: str) -> None:
+        with open(f"{prefix}.prom", "w") as f:
+            f.write(self.prometheus())
+        with open(f"{prefix}.json", "w") as f:
+            json.dump(self.summary(), f, indent=1)
+
+_profiler: Optional[Profiler] = None
+
+def enable_profiling() -> Profiler:
+    global _profiler
+    if _profiler is None:
+        _profiler = Profiler()
+    return _profiler
+
+def disable_profiling() -> None:
+    global _profiler
+    _profiler = None
+
+def active_profiler() -> Optional[Profiler]:
+    return _profiler
+
+class _Timer():
+    def __init__(self, profiler: Profiler, operation: str):
+        self.profiler = profiler
+        self.operation = operation
+
+    def __enter__(self) -> None:
+        self.start = time.perf_counter()
+
+    def __exit__(self, *_) -> None:
+        self.profiler.record(self.operation, time.perf_counter() - self.start)
+
+_NOT_TIMED = nullcontext()
+
+def timer(operation: str) -> ContextManager:
+    return _Timer(_profiler, operation) if _profiler is not None else _NOT_TIMED
+
+# Times every call of the function (or method, named after its class)
+def profiled(function: F) -> F:
+    operation = function.__qualname__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        profiler = _profiler
+        if profiler is None:
+            return function(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            profiler.record(operation, time.perf_counter() - start)
+
+    return wrapper
+
+def record_phase(phase: str, seconds: float) -> None:
+    if _profiler is not None:
+        _profiler.record_phase(phase, seconds)
@@ -1,5 +1,12 @@
 from game import Game
+from gpt_client import GPTClient, OPENAI_URL
+from gpt_bot import GPT_bot
+from image_payload import ImagePayloadCache
+from events import open_sink
+from captioning import NarratorOptions
+from instrumentation import enable_profiling
 
+import os
 import argparse
 from argparse import Namespace
 
@@ -10,14 +17,67 @@ def argument_parsing() -> Namespace:
     parser.add_argument("-p", "--play", action="store_true", help="Let the player play against the bots")
     parser.add_argument("--gpt_players", type=int, default = 0, help = "Specify number of GPT players")
     parser.add_argument("--points_to_win", type=int, default = 30, help="Specify the number of points to win")
+    parser.add_argument("--gpt_api_url", type=str, default=OPENAI_URL, help="Specify the chat completions endpoint used by the GPT players (e.g. the local gpt_stub_server.py)")
+    parser.add_argument("--gpt_timeout", type=float, default=60.0, help="Specify the timeout (in seconds) of each GPT request")
+    parser.add_argument("--gpt_max_retries", type=int, default=3, help="Specify the number of attempts for each GPT request")
+    parser.add_argument("--gpt_backoff_base", type=float, default=1.0, help="Specify the base (in seconds) of the exponential backoff between GPT attempts")
+    parser.add_argument("--gpt_backoff_max", type=float, default=60.0, help="Specify the maximum wait (in seconds) between GPT attempts")
+    parser.add_argument("--gpt_image_format", type=str, default="JPEG", help="Specify the format of the images sent to GPT (e.g. JPEG, PNG)")
+    parser.add_argument("--gpt_image_quality", type=int, default=85, help="Specify the JPEG quality of the images sent to GPT")
+    parser.add_argument("--gpt_image_size", type=int, default=None, help="Specify the side of the images sent to GPT (default: the 224x224 card)")
+    parser.add_argument("--payload_stats", action="store_true", help="Print the size of the images sent by the GPT players at the end of the game")
+    parser.add_argument("--narrator_candidates", type=int, default=1, help="Specify the number of captions generated for each card in hand when a bot narrates (with 1 a random card gets a single caption)")
+    parser.add_argument("--narrator_target", type=float, default=0.5, help="Specify the probability of being found (against the rest of the hand) the caption chosen by a bot narrator should have")
+    parser.add_argument("--narrator_max_time", type=float, default=None, help="Specify the time budget (in seconds) of the bot captions generation")
+    parser.add_argument("--quantize", action="store_true", help="Run the bots with int8 dynamic quantized models (CPU only, see quantization_check.py for their agreement with the fp32 ones)")
+    parser.add_argument("--clip_backend", type=str, choices=["eager", "torchscript", "onnx"], default="eager", help="Specify how the bots run CLIP: the eager model or the graphs exported by clip_runtime.py")
+    parser.add_argument("--clip_threads", type=int, default=None, help="Specify the number of threads used by the exported CLIP graphs")
+    parser.add_argument("--caption_bank", action="store_true", help="Let the bots take their captions from the precomputed caption bank of the deck (see caption_bank.py)")
+    parser.add_argument("--profile", type=str, default=None, help="Specify a path prefix to enable the instrumentation, saved as <prefix>.prom (Prometheus) and <prefix>.json")
+    parser.add_argument("--events", type=str, default=None, help="Specify the file (.jsonl or .parquet, not existing yet) where the events of the game are saved")
+    parser.add_argument("-q", "--quiet", action="store_true", help="Do not print the game (useful together with --events)")
     parser.add_argument("--print_cards", action = "store_true", help="Print the card in the hands of the players for each round")
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    # The exported graphs are traced from the fp32 model and would replace the quantized one
+    if args.quantize and args.clip_backend != "eager":
+        parser.error("--quantize runs the eager CLIP model, it cannot be combined with --clip_backend " + args.clip_backend)
+
+    return args
 
 if __name__ == "__main__":
 
     args = argument_parsing()
 
-    game = Game(args.n_players, args.gpt_players, "../cards/odissey_cards", args.play, args.points_to_win, args.print_cards)
+    gpt_client = None
+    gpt_payloads = ImagePayloadCache(args.gpt_image_format, args.gpt_image_quality, args.gpt_image_size)
+    if args.gpt_players != 0:
+        gpt_client = GPTClient(os.environ.get("OPENAI_API_KEY", " "), args.gpt_api_url, args.gpt_timeout, args.gpt_max_retries, args.gpt_backoff_base, args.gpt_backoff_max)
+
+    sinks = [open_sink(args.events)] if args.events is not None else []
+
+    profiler = enable_profiling() if args.profile is not None else None
+
+    narrator = NarratorOptions(args.narrator_candidates, args.narrator_target, args.narrator_max_time, args.caption_bank)
+
+    game = Game(args.n_players, args.gpt_players, "../cards/odissey_cards", args.play, args.points_to_win, args.print_cards, gpt_client=gpt_client, gpt_payloads=gpt_payloads, sinks=sinks, verbose=not args.quiet, narrator=narrator, quantize=args.quantize,
+                clip_backend=args.clip_backend, clip_threads=args.clip_threads)
     
-    game.simulate()
+    try:
+        game.simulate()
+    finally:
+        for sink in sinks:
+            sink.close()
+        # The client is passed in, so the game leaves it open
+        if gpt_client is not None:
+            gpt_client.close()
+
+    if profiler is not None:
+        profiler.save(args.profile)
+        print(f"Instrumentation saved in {args.profile}.prom and {args.profile}.json")
+
+    if args.payload_stats:
+        for p in game.players:
+            if isinstance(p, GPT_bot) and len(p.request_payload_bytes) != 0:
+                print(f"{p}: {len(p.request_payload_bytes)} requests, {sum(p.request_payload_bytes) / len(p.request_payload_bytes):.0f} image bytes per request")
+        print(f"Encoded cards: {gpt_payloads.misses}, reused: {gpt_payloads.hits}")
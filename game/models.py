@@ -0,0 +1,145 @@
+import os
+import copy
+import json
+import argparse
+from argparse import Namespace
+from typing import TYPE_CHECKING, Dict, NamedTuple, Tuple
+
+# torch and transformers are imported only when the models are actually loaded
+if TYPE_CHECKING:
+    from transformers import BlipProcessor, BlipForConditionalGeneration, CLIPProcessor, CLIPModel
+
+CHECKPOINT_DIR = "../weights/checkpoints"
+
+class Models(NamedTuple):
+    blip_model: "BlipForConditionalGeneration"
+    blip_processor: "BlipProcessor"
+    clip_model: "CLIPModel"
+    clip_processor: "CLIPProcessor"
+    clip_weights: str # File the CLIP weights come from, used to key the card index
+    blip_weights: str # File the BLIP weights come from, used (with the CLIP ones) to key the caption bank
+
+def argument_parsing() -> Namespace:
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--blip_weights", type=str, default="../weights/rephrased_blip(2nd)/epoch50.pt", help="Specify the fine tuned BLIP weights")
+    parser.add_argument("--clip_weights", type=str, default="../weights/rephrased_coco_clip(2nd)/epoch13.pt", help="Specify the fine tuned CLIP weights")
+    parser.add_argument("-dst", "--checkpoint_dir", type=str, default=CHECKPOINT_DIR, help="Specify the directory where the local checkpoints are saved")
+
+    return parser.parse_args()
+
+def checkpoint_paths(checkpoint_dir: str) -> Tuple[str, str]:
+    return os.path.join(checkpoint_dir, "blip"), os.path.join(checkpoint_dir, "clip")
+
+def has_checkpoint(checkpoint_dir: str) -> bool:
+    return all(os.path.exists(os.path.join(path, "model.safetensors")) for path in checkpoint_paths(checkpoint_dir))
+
+# Hashes of the fine tuned weights the checkpoint was exported from, as for the exports of clip_runtime.py
+def source_path(checkpoint_dir: str) -> str:
+    return os.path.join(checkpoint_dir, "source.json")
+
+def source_hashes(path_to_blip_weights: str, path_to_clip_weights: str) -> Dict[str, str]:
+    from card_index import weights_hash
+    return {"blip_weights_hash": weights_hash(path_to_blip_weights), "clip_weights_hash": weights_hash(path_to_clip_weights)}
+
+# The checkpoint is used only when it comes from the requested weights
+def checkpoint_matches(checkpoint_dir: str, path_to_blip_weights: str, path_to_clip_weights: str) -> bool:
+    if not os.path.exists(source_path(checkpoint_dir)):
+        print(f"The checkpoint in {checkpoint_dir} does not record the weights it comes from, loading the base models (run models.py again to export it)")
+        return False
+    with open(source_path(checkpoint_dir), "r") as f:
+        source = json.load(f)
+    if source != source_hashes(path_to_blip_weights, path_to_clip_weights):
+        print(f"The checkpoint in {checkpoint_dir} comes from other fine tuned weights, loading the base models (run models.py again to export these ones)")
+        return False
+    return True
+
+def device_name() -> str:
+    import torch
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+# Base checkpoints from the hub, then overwritten with the fine tuned weights: every weight is loaded twice
+def load_finetuned_models(path_to_blip_weights: str, path_to_clip_weights: str, device: str) -> Models:
+    import torch
+    from transformers import BlipProcessor, BlipForConditionalGeneration, CLIPProcessor, CLIPModel
+
+    blip_processor = BlipProcessor.from_pretrained("Salesforce/blip-image-captioning-base")
+    blip_model = BlipForConditionalGeneration.from_pretrained("Salesforce/blip-image-captioning-base").to(device)
+
+    clip_model = CLIPModel.from_pretrained("openai/clip-vit-base-patch16").to(device)
+    clip_processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch16")
+
+    blip_model.load_state_dict(torch.load(path_to_blip_weights, map_location=device))
+    clip_model.load_state_dict(torch.load(path_to_clip_weights, map_location=device))
+
+    return Models(blip_model, blip_processor, clip_model, clip_processor, path_to_clip_weights, path_to_blip_weights)
+
+# The models are built from the local config on the meta device and the weights are read (memory mapped) straight from safetensors.
+# They keep the paths of the fine tuned weights they were exported from, which key the card index, the caption bank and the exports
+def load_checkpoint(checkpoint_dir: str, path_to_blip_weights: str, path_to_clip_weights: str, device: str) -> Models:
+    from transformers import BlipProcessor, BlipForConditionalGeneration, CLIPProcessor, CLIPModel
+
+    blip_path, clip_path = checkpoint_paths(checkpoint_dir)
+
+    blip_processor = BlipProcessor.from_pretrained(blip_path, local_files_only=True)
+    blip_model = BlipForConditionalGeneration.from_pretrained(blip_path, local_files_only=True, low_cpu_mem_usage=True, use_safetensors=True).to(device)
+
+    clip_processor = CLIPProcessor.from_pretrained(clip_path, local_files_only=True)
+    clip_model = CLIPModel.from_pretrained(clip_path, local_files_only=True, low_cpu_mem_usage=True, use_safetensors=True).to(device)
+
+    return Models(blip_model, blip_processor, clip_model, clip_processor, path_to_clip_weights, path_to_blip_weights)
+
+def load_models(path_to_blip_weights: str, path_to_clip_weights: str, device: str, checkpoint_dir: str = CHECKPOINT_DIR) -> Models:
+    if not has_checkpoint(checkpoint_dir):
+        print(f"No local checkpoint in {checkpoint_dir}, loading the base models (run models.py once to create it)")
+        models = load_finetuned_models(path_to_blip_weights, path_to_clip_weights, device)
+    elif checkpoint_matches(checkpoint_dir, path_to_blip_weights, path_to_clip_weights):
+        models = load_checkpoint(checkpoint_dir, path_to_blip_weights, path_to_clip_weights, device)
+    else:
+        models = load_finetuned_models(path_to_blip_weights, path_to_clip_weights, device)
+
+    models.blip_model.eval()
+    models.clip_model.eval()
+
+    return models
+
+# Dynamic int8 quantization (CPU only) of the linear layers of both CLIP towers and of the BLIP text decoder: their weights are stored
+# as int8 and the activations are quantized on the fly. Done in place, so that the fp32 weights are not kept in memory.
+# The card index is meant to be built before, with the fp32 vision tower (it is keyed by the weights file, not by the quantization).
+# The models passed are changed: callers needing the fp32 ones as well quantize a copy (see copy_models)
+def quantize_models(models: Models) -> Models:
+    import torch
+    from torch.ao.quantization import quantize_dynamic
+    from clip_features import drop_text_cache
+
+    quantize_dynamic(models.clip_model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    quantize_dynamic(models.blip_model.text_decoder, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+    # Same model object, but the captions encoded in fp32 before must be encoded again
+    drop_text_cache(models.clip_model)
+
+    return models
+
+# Own copy of the model weights, the processors (that hold no weights) are shared
+def copy_models(models: Models) -> Models:
+    return models._replace(blip_model=copy.deepcopy(models.blip_model), clip_model=copy.deepcopy(models.clip_model))
+
+# One time export (needs the hub): config, processor and fine tuned weights of each model in a single local directory
+def export_checkpoint(path_to_blip_weights: str, path_to_clip_weights: str, checkpoint_dir: str) -> None:
+    models = load_finetuned_models(path_to_blip_weights, path_to_clip_weights, "cpu")
+    blip_path, clip_path = checkpoint_paths(checkpoint_dir)
+
+    models.blip_model.save_pretrained(blip_path, safe_serialization=True)
+    models.blip_processor.save_pretrained(blip_path)
+    models.clip_model.save_pretrained(clip_path, safe_serialization=True)
+    models.clip_processor.save_pretrained(clip_path)
+
+    with open(source_path(checkpoint_dir), "w") as f:
+        json.dump(source_hashes(path_to_blip_weights, path_to_clip_weights), f)
+
+if __name__ == "__main__":
+
+    args = argument_parsing()
+
+    export_checkpoint(args.blip_weights, args.clip_weights, args.checkpoint_dir)
+    print(f"Checkpoints saved in {args.checkpoint_dir}")
@@ -0,0 +1,172 @@
+import math
+import threading
+from typing import Dict, List
+
+from player import Player
+
+# Running versions of the statistics of analyze/analyze_data.py, updated by Game at the end of every round and game
+# instead of being computed from the Excel files afterwards. They use constant memory (counts per player type),
+# can be merged between processes and come with 95% confidence intervals.
+# The rates are pooled over all the rounds (or games) of a player type, while analyze_data.py averages the rates of each game.
+
+Z_95 = 1.96
+
+# Player types as grouped by analyze_data.py, from the names given by Game
+def player_type(player_name: str) -> str:
+    if player_name.startswith("GPT Bot"):
+        return "GPT"
+    if player_name.startswith("Bot"):
+        return "Bot"
+    return "Human"
+
+class Proportion():
+
+    def __init__(self, successes: int = 0, trials: int = 0):
+        self.successes = successes
+        self.trials = trials
+
+    def add(self, success: bool) -> None:
+        self.successes += success
+        self.trials += 1
+
+    def merge(self, other: "Proportion") -> None:
+        self.successes += other.successes
+        self.trials += other.trials
+
+    # Wilson score interval, sensible also for rates close to 0 or 1
+    def interval(self, z: float = Z_95) -> Dict:
+        if self.trials == 0:
+            return {"n": 0, "percent": 0.0, "low": 0.0, "high": 100.0}
+        p = self.successes / self.trials
+        denominator = 1 + z**2 / self.trials
+        center = (p + z**2 / (2 * self.trials)) / denominator
+        half_width = z * math.sqrt(p * (1 - p) / self.trials + z**2 / (4 * self.trials**2)) / denominator
+        return {"n": self.trials, "percent": 100 * p, "low": 100 * (center - half_width), "high": 100 * (center + half_width)}
+
+    def to_list(self) -> List:
+        return [self.successes, self.trials]
+
+# Welford's running mean and variance
+class Mean():
+
+    def __init__(self, n: int = 0, mean: float = 0.0, m2: float = 0.0):
+        self.n = n
+        self.mean = mean
+        self.m2 = m2
+
+    def add(self, value: float) -> None:
+        self.n += 1
+        delta = value - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (value - self.mean)
+
+    # Chan's parallel combination of the two running moments
+    def merge(self, other: "Mean") -> None:
+        n = self.n + other.n
+        if n == 0:
+            return
+        delta = other.mean - self.mean
+        self.m2 += other.m2 + delta**2 * self.n * other.n / n
+        self.mean += delta * other.n / n
+        self.n = n
+
+    def interval(self, z: float = Z_95) -> Dict:
+        if self.n < 2:
+            return {"n": self.n, "mean": self.mean, "low": -math.inf, "high": math.inf}
+        half_width = z * math.sqrt(self.m2 / (self.n - 1) / self.n)
+        return {"n": self.n, "mean": self.mean, "low": self.mean - half_width, "high": self.mean + half_width}
+
+    def to_list(self) -> List:
+        return [self.n, self.mean, self.m2]
+
+# Proportions of each player type:
+#   voted_by_all / voted_by_none / voted_by_someone: rounds as narrator whose card was found by all, none or some of the other players
+#   voted_when_not_narrator: rounds as non narrator whose card got at least one vote
+#   correct_votes: votes given to the narrator card
+#   wins: games won by a player of that type (among the games with at least one of them)
+PROPORTIONS = ["voted_by_all", "voted_by_none", "voted_by_someone", "voted_when_not_narrator", "correct_votes", "wins"]
+
+class OnlineStats():
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.proportions: Dict[str, Dict[str, Proportion]] = {}
+        self.points_per_round: Dict[str, Mean] = {}
+        self.games = 0
+
+    def type_stats(self, player: Player) -> Dict[str, Proportion]:
+        return self.kind_stats(player_type(str(player)))
+
+    def kind_stats(self, kind: str) -> Dict[str, Proportion]:
+        if kind not in self.proportions:
+            self.proportions[kind] = {stat: Proportion() for stat in PROPORTIONS}
+            self.points_per_round[kind] = Mean()
+        return self.proportions[kind]
+
+    # votes as built by Game.do_one_round (player -> players who voted for their card), points are the ones won in the round
+    def add_round(self, narrator: Player, other_players: List[Player], votes: Dict[Player, List[Player]], points: Dict[Player, int]) -> None:
+        with self.lock:
+            narrator_votes = len(votes[narrator])
+            stats = self.type_stats(narrator)
+            stats["voted_by_all"].add(narrator_votes == len(other_players))
+            stats["voted_by_none"].add(narrator_votes == 0)
+            stats["voted_by_someone"].add(0 < narrator_votes < len(other_players))
+
+            for player in other_players:
+                stats = self.type_stats(player)
+                stats["voted_when_not_narrator"].add(len(votes[player]) != 0)
+            for voter in votes[narrator]:
+                self.type_stats(voter)["correct_votes"].add(True)
+            for player in other_players:
+                for voter in votes[player]:
+                    self.type_stats(voter)["correct_votes"].add(False)
+
+            for player, won in points.items():
+                kind = player_type(str(player))
+                self.kind_stats(kind)
+                self.points_per_round[kind].add(won)
+
+    def add_game(self, players: List[Player], winners: List[Player]) -> None:
+        with self.lock:
+            self.games += 1
+            winner_types = {player_type(str(player)) for player in winners}
+            for kind in {player_type(str(player)) for player in players}:
+                self.kind_stats(kind)["wins"].add(kind in winner_types)
+
+    # Plain data, to be sent between processes and merged (e.g. by the tournament)
+    def to_dict(self) -> Dict:
+        with self.lock:
+            return {
+                "games": self.games,
+                "proportions": {kind: {stat: proportion.to_list() for stat, proportion in stats.items()} for kind, stats in self.proportions.items()},
+                "points_per_round": {kind: mean.to_list() for kind, mean in self.points_per_round.items()}
+            }
+
+    def merge(self, data: Dict) -> None:
+        with self.lock:
+            self.games += data["games"]
+            for kind, stats in data["proportions"].items():
+                merged = self.kind_stats(kind)
+                for stat, counts in stats.items():
+                    merged[stat].merge(Proportion(*counts))
+            for kind, moments in data["points_per_round"].items():
+                self.points_per_round[kind].merge(Mean(*moments))
+
+    def summary(self) -> Dict:
+        with self.lock:
+            return {kind: {**{stat: proportion.interval() for stat, proportion in stats.items()}, "points_per_round": self.points_per_round[kind].interval()}
+                    for kind, stats in sorted(self.proportions.items())}
+
+    # Largest half width (in percentage points) of the intervals of the given statistics, over the player types.
+    # Statistics without any trial yet (e.g. narrator rounds of a type that never narrated) are undefined and left out
+    def max_half_width(self, stats: List[str]) -> float:
+        half_widths = [(interval["high"] - interval["low"]) / 2 for kind in self.summary().values() for stat, interval in kind.items() if stat in stats and interval["n"] != 0]
+        return max(half_widths) if len(half_widths) != 0 else math.inf
+
+    def report(self) -> str:
+        lines = []
+        for kind, stats in self.summary().items():
+            rates = ", ".join(f"{stat} {interval['percent']:.1f}% [{interval['low']:.1f}, {interval['high']:.1f}]" for stat, interval in stats.items() if stat in PROPORTIONS and interval["n"] != 0)
+            points = stats["points_per_round"]
+            lines.append(f"{kind}: {rates}, points/round {points['mean']:.2f} [{points['low']:.2f}, {points['high']:.2f}]")
+        return "\n".join(lines)
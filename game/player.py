@@ -1,32 +1,33 @@
 from abc import ABC, abstractmethod
 from typing import List, Tuple
 from typing_extensions import Self
-import random
 
 from card import Card
+from deck import Deck, Hand
+
+# Hand and points of a seat at the table. The decisions are made by the subclasses of Player
+# (or asked through the table, for the remote seats of game_server.py)
+class Seat():
+    # True for the players running the BLIP/CLIP models (see Bot)
+    model_backed = False
 
-class Player(ABC):
     def __init__(self, player_name: str, points_to_win: int):
         self.player_name = player_name
         self.points_to_win = points_to_win
         self.points = 0
-        self.cards_in_hand = []
+        self.cards_in_hand = Hand()
+        self.verbose = True
+
+    def log(self, message: str) -> None:
+        if self.verbose:
+            print(message)
    
     # The initial deck should have enough cards for all the players, so no check is needed
-    def draw_initial_hand(self, images: List[Card]) -> List[Card]:
-        self.cards_in_hand = random.sample(images, 6)
-
-        for img in self.cards_in_hand:
-            images.remove(img)
+    def draw_initial_hand(self, deck: Deck) -> None:
+        self.cards_in_hand = Hand([deck.draw() for _ in range(6)])
 
-        return images
-
-    def draw_card(self, images: List[Card]) -> List[Card]:
-        drawn_card = random.choice(images)
-        images.remove(drawn_card)
-
-        self.cards_in_hand.append(drawn_card)
-        return images
+    def draw_card(self, deck: Deck) -> None:
+        self.cards_in_hand.append(deck.draw())
 
     def add_points(self, to_add: int) -> None:
         self.points += to_add
@@ -34,6 +35,11 @@ class Player(ABC):
     def check_winning_condition(self) -> bool:
         return self.points >= self.points_to_win
 
+    def __repr__(self) -> str:
+        return self.player_name
+
+class Player(Seat, ABC):
+
     @abstractmethod
     def get_card_and_caption(self) -> Tuple[Card, str]:
         pass
@@ -45,6 +51,3 @@ class Player(ABC):
     @abstractmethod
     def get_most_likely_card(self, cards_on_table: List[Tuple[Self, Card]], caption: str) -> Self:
         pass
-    
-    def __repr__(self) -> str:
-        return self.player_name
@@ -0,0 +1,131 @@
+import io
+import os
+import json
+import time
+import random
+import argparse
+from argparse import Namespace
+from typing import Dict
+import torch
+
+from card_index import CardIndex
+from card_store import load_deck
+from captioning import caption_images
+from clip_features import caption_logits, encode_images, encode_text
+from models import Models, copy_models, load_models, quantize_models
+
+# Agreement between the fp32 and the int8 quantized bots on the card decks: the same captions (generated by the fp32 BLIP)
+# are encoded by both CLIP text towers and scored against the same fp32 card index, as the quantized bots do in a game,
+# and every selection and vote of the int8 bots is compared with the fp32 one
+
+def argument_parsing() -> Namespace:
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-d", "--decks", type=str, nargs="+", default=None, help="Specify the directories of the decks (default: every deck inside ../cards)")
+    parser.add_argument("-r", "--rounds", type=int, default=200, help="Specify the number of rounds simulated on each deck")
+    parser.add_argument("-np", "--n_players", type=int, default=5, help="Specify the number of players")
+    parser.add_argument("--blip_weights", type=str, default="../weights/rephrased_blip(2nd)/epoch50.pt", help="Specify the fine tuned BLIP weights")
+    parser.add_argument("--clip_weights", type=str, default="../weights/rephrased_coco_clip(2nd)/epoch13.pt", help="Specify the fine tuned CLIP weights")
+    parser.add_argument("--seed", type=int, default=0, help="Specify the seed of the check")
+    parser.add_argument("-o", "--output", type=str, default=None, help="Specify the JSON file where the results are saved")
+
+    return parser.parse_args()
+
+# Size of the saved weights (the int8 ones are packed inside the quantized linear layers, so they do not show in parameters())
+def model_bytes(model: torch.nn.Module) -> int:
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+def timed(function, *args) -> float:
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+def check_deck(path_to_images: str, fp32: Models, int8: Models, card_index: CardIndex, rounds: int, n_players: int, rng: random.Random) -> Dict:
+    cards = load_deck(path_to_images)
+    pixels = [card.pixels for card in cards]
+    image_embeds = card_index.embeddings_for(cards)
+
+    # Narrator card and hands of the other players of each round
+    deals = []
+    for _ in range(rounds):
+        dealt = rng.sample(range(len(cards)), 1 + 6 * (n_players - 1))
+        deals.append((dealt[0], [dealt[1 + 6 * k:1 + 6 * (k + 1)] for k in range(n_players - 1)]))
+
+    captions = []
+    for start in range(0, rounds, 16):
+        captions += caption_images(fp32.blip_model, fp32.blip_processor, [pixels[narrator] for narrator, _ in deals[start:start + 16]], "cpu")
+
+    # (cards, captions) scores of each model, the cards always come from the fp32 card index
+    scores = {}
+    for name, models in [("fp32", fp32), ("int8", int8)]:
+        text_embeds = torch.cat([encode_text(models.clip_model, models.clip_processor, captions[k:k + 64], "cpu") for k in range(0, len(captions), 64)])
+        scores[name] = caption_logits(models.clip_model, text_embeds, image_embeds)
+
+    selections, votes = [], []
+    for r, (narrator, hands) in enumerate(deals):
+        # Selection: the best card of each hand
+        chosen = {}
+        for name in scores:
+            chosen[name] = [hand[scores[name][hand, r].argmax().item()] for hand in hands]
+        selections += [a == b for a, b in zip(chosen["fp32"], chosen["int8"])]
+
+        # Voting on the same table (the fp32 selections plus the narrator card), each voter without its own card
+        table = chosen["fp32"] + [narrator]
+        for voter in range(n_players - 1):
+            others = [card for k, card in enumerate(table) if k != voter]
+            vote = {name: others[scores[name][others, r].argmax().item()] for name in scores}
+            votes.append(vote["fp32"] == vote["int8"])
+
+    return {
+        "cards": len(cards),
+        "rounds": rounds,
+        "selection_agreement": sum(selections) / len(selections),
+        "vote_agreement": sum(votes) / len(votes),
+        "max_score_difference": (scores["fp32"] - scores["int8"]).abs().max().item()
+    }
+
+def check_latency(fp32: Models, int8: Models, path_to_images: str) -> Dict:
+    pixels = [card.pixels for card in load_deck(path_to_images)[:6]]
+    captions = ["a man walking in the middle of a strange landscape"] * 6
+
+    latency = {}
+    for name, models in [("fp32", fp32), ("int8", int8)]:
+        encode_images(models.clip_model, models.clip_processor, pixels, "cpu") # Warm up
+        latency[name] = {
+            "image_encode_seconds": timed(encode_images, models.clip_model, models.clip_processor, pixels, "cpu"),
+            "text_encode_seconds": timed(encode_text, models.clip_model, models.clip_processor, captions, "cpu"),
+            "caption_seconds": timed(caption_images, models.blip_model, models.blip_processor, pixels[:1], "cpu")
+        }
+    return latency
+
+if __name__ == "__main__":
+
+    args = argument_parsing()
+    decks = args.decks if args.decks is not None else [os.path.join("../cards", deck) for deck in sorted(os.listdir("../cards")) if os.path.isdir(os.path.join("../cards", deck))]
+    rng = random.Random(args.seed)
+
+    print("Loading models...")
+    fp32 = load_models(args.blip_weights, args.clip_weights, "cpu")
+    int8 = quantize_models(copy_models(fp32))
+
+    results = {
+        "model_bytes": {name: {"blip": model_bytes(models.blip_model), "clip": model_bytes(models.clip_model)} for name, models in [("fp32", fp32), ("int8", int8)]},
+        "latency": check_latency(fp32, int8, decks[0]),
+        "decks": {}
+    }
+
+    for deck in decks:
+        torch.manual_seed(args.seed)
+        card_index = CardIndex.load_or_build(deck, fp32.clip_weights, fp32.clip_model, fp32.clip_processor, "cpu")
+        results["decks"][deck] = check_deck(deck, fp32, int8, card_index, args.rounds, args.n_players, rng)
+        print(f"{deck}: selection agreement {results['decks'][deck]['selection_agreement'] * 100:.1f}%, vote agreement {results['decks'][deck]['vote_agreement'] * 100:.1f}%")
+
+    for name, sizes in results["model_bytes"].items():
+        print(f"{name}: BLIP {sizes['blip'] / 2**20:.0f} MiB, CLIP {sizes['clip'] / 2**20:.0f} MiB, "
+              f"caption {results['latency'][name]['caption_seconds']:.2f}s, 6 images {results['latency'][name]['image_encode_seconds']:.3f}s, 6 captions {results['latency'][name]['text_encode_seconds']:.3f}s")
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1)
@@ -0,0 +1,272 @@
+import os
+import sys
+import json
+import time
+import argparse
+from argparse import Namespace
+from typing import TYPE_CHECKING, Dict, List, NamedTuple
+import numpy as np
+
+from card_store import load_deck
+
+if TYPE_CHECKING:
+    from card_index import CardIndex
+    from models import Models
+
+# Model-free games between bots: every decision of a bot is an argmax over CLIP scores, so once the scores of every
+# (card, caption) pair are known the games can be played with NumPy only, thousands at a time
+
+NARRATOR_STRATEGIES = ["random", "best"]
+
+class ScoreMatrix(NamedTuple):
+    image_numbers: np.ndarray # (N,) number of the card of each row
+    captions: np.ndarray # (C,) candidate captions, generated by BLIP from the deck cards
+    caption_cards: np.ndarray # (C,) row of the card each caption was generated from
+    scores: np.ndarray # (N, C) CLIP logits, the same values the bots compare
+
+# Same points given by Game.compute_scores
+class ScoringRule(NamedTuple):
+    all_or_none: int = 2 # To every other player when everyone or no one voted for the narrator
+    narrator: int = 3
+    correct_vote: int = 3 # To every player who voted for the narrator
+    per_vote: int = 1 # To the player of a card that is not the narrator one, for each vote it received
+
+class SimulationResult(NamedTuple):
+    points: np.ndarray # (games, players) final points
+    winners: np.ndarray # (games, players) True for every player with the maximum score
+    rounds: np.ndarray # (games,)
+
+def argument_parsing() -> Namespace:
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--deck", type=str, default="../cards/odissey_cards", help="Specify the directory of the deck")
+    parser.add_argument("--scores", type=str, default=None, help="Specify the score matrix file (by default next to the deck)")
+    parser.add_argument("--build", action="store_true", help="Specify to build the score matrix again with the models (done anyway when the file does not exist)")
+    parser.add_argument("--captions_per_card", type=int, default=5, help="Specify the number of candidate captions generated for each card")
+    parser.add_argument("--blip_weights", type=str, default="../weights/rephrased_blip(2nd)/epoch50.pt", help="Specify the fine tuned BLIP weights")
+    parser.add_argument("--clip_weights", type=str, default="../weights/rephrased_coco_clip(2nd)/epoch13.pt", help="Specify the fine tuned CLIP weights")
+    parser.add_argument("-g", "--games", type=int, default=10000, help="Specify the number of games to simulate")
+    parser.add_argument("-n", "--n_players", type=int, default=5, help="Specify the number of players")
+    parser.add_argument("--points_to_win", type=int, default=30, help="Specify the number of points to win")
+    parser.add_argument("--narrator", type=str, nargs="+", choices=NARRATOR_STRATEGIES, default=["random"], help="Specify the narrator strategy of each player (a single one is used by everyone). random: random card and caption, as the bots; best: the card and caption with the highest score")
+    parser.add_argument("--all_or_none_points", type=int, default=2, help="Specify the points given to the other players when everyone or no one votes for the narrator")
+    parser.add_argument("--narrator_points", type=int, default=3, help="Specify the points given to the narrator when someone, but not everyone, votes for the narrator")
+    parser.add_argument("--correct_vote_points", type=int, default=3, help="Specify the points given to the players who vote for the narrator")
+    parser.add_argument("--vote_points", type=int, default=1, help="Specify the points given for each vote received by a card that is not the narrator one")
+    parser.add_argument("--seed", type=int, default=0, help="Specify the seed of the simulation")
+    parser.add_argument("--batch_size", type=int, default=4096, help="Specify the number of games played at the same time")
+    parser.add_argument("-o", "--output", type=str, default=None, help="Specify the JSON file where the statistics are saved")
+
+    return parser.parse_args()
+
+def score_matrix_path(path_to_images: str) -> str:
+    return f"{os.path.normpath(path_to_images)}.scores.npz"
+
+def save_score_matrix(path: str, matrix: ScoreMatrix) -> None:
+    np.savez(path, **matrix._asdict())
+
+def load_score_matrix(path: str) -> ScoreMatrix:
+    with np.load(path) as data:
+        return ScoreMatrix(**{field: data[field] for field in ScoreMatrix._fields})
+
+# Captions are generated the same way the bots do when narrating, and scored against every card of the deck
+def build_score_matrix(path_to_images: str, models: "Models", card_index: "CardIndex", device: str, captions_per_card: int, batch_size: int = 16) -> ScoreMatrix:
+    import torch
+    from captioning import caption_images
+    from clip_features import caption_logits, encode_text
+
+    cards = load_deck(path_to_images)
+    captions = []
+    for start in range(0, len(cards), batch_size):
+        pixels = [card.pixels for card in cards[start:start + batch_size]]
+        captions += caption_images(models.blip_model, models.blip_processor, pixels, device, captions_per_card)
+
+    text_embeds = torch.cat([encode_text(models.clip_model, models.clip_processor, captions[k:k + 256], device) for k in range(0, len(captions), 256)])
+    scores = caption_logits(models.clip_model, text_embeds, card_index.embeddings_for(cards))
+
+    return ScoreMatrix(np.array([card.image_number for card in cards]), np.array(captions),
+                       np.repeat(np.arange(len(cards)), captions_per_card), scores.float().cpu().numpy())
+
+# (N, K): the captions of each card
+def captions_by_card(matrix: ScoreMatrix) -> np.ndarray:
+    n_cards = len(matrix.image_numbers)
+    counts = np.bincount(matrix.caption_cards, minlength=n_cards)
+    if counts.min() == 0 or counts.min() != counts.max():
+        raise ValueError("Every card needs the same number of captions")
+    return np.argsort(matrix.caption_cards, kind="stable").reshape(n_cards, counts[0])
+
+# One round of the games in idx, following Game.do_one_round: the narrator plays a card of its hand with one of its captions,
+# the others play their best card for the caption and vote for the best card on the table that is not their own
+def play_round(state: Dict[str, np.ndarray], idx: np.ndarray, scores: np.ndarray, card_captions: np.ndarray, best_narrator: np.ndarray, rule: ScoringRule, rng: np.random.Generator) -> None:
+    n_games = len(idx)
+    n_players = state["hands"].shape[1]
+    b = np.arange(n_games)
+    seats = np.arange(n_players)
+
+    hands = state["hands"][idx]
+    narrator = (state["first"][idx] + state["rounds"][idx]) % n_players
+    narrator_hand = hands[b, narrator]
+
+    # Narration: random card and caption (as Bot.get_card_and_caption), or the pair with the highest score
+    random_pos = rng.integers(narrator_hand.shape[1], size=n_games)
+    random_caption = card_captions[narrator_hand[b, random_pos], rng.integers(card_captions.shape[1], size=n_games)]
+    candidates = card_captions[narrator_hand]
+    best = scores[narrator_hand[:, :, None], candidates].reshape(n_games, -1).argmax(axis=1)
+    best_pos, best_caption = np.divmod(best, card_captions.shape[1])
+    best_caption = candidates[b, best_pos, best_caption]
+
+    use_best = best_narrator[narrator]
+    narrator_pos = np.where(use_best, best_pos, random_pos)
+    caption = np.where(use_best, best_caption, random_caption)
+
+    # Selection: the card of the hand with the highest score
+    selected = scores[hands, caption[:, None, None]].argmax(axis=2)
+    selected[b, narrator] = narrator_pos
+    table = hands[b[:, None], seats, selected]
+
+    # Voting: the table is in the order of Game.do_one_round (the other players, then the narrator), so ties are broken the same way
+    owner = np.argsort(np.where(seats == narrator[:, None], n_players, seats), axis=1)
+    table_scores = scores[table[b[:, None], owner], caption[:, None]]
+    vote_scores = np.where(owner[:, None, :] == seats[None, :, None], -np.inf, table_scores[:, None, :])
+    voted = owner[b[:, None], vote_scores.argmax(axis=2)]
+
+    is_voter = seats != narrator[:, None]
+    received = ((voted[:, :, None] == seats) & is_voter[:, :, None]).sum(axis=1)
+    found_narrator = is_voter & (voted == narrator[:, None])
+
+    # Game.compute_scores
+    narrator_votes = received[b, narrator]
+    all_or_none = (narrator_votes == 0) | (narrator_votes == n_players - 1)
+    points = np.where(all_or_none[:, None], rule.all_or_none * is_voter,
+                      rule.per_vote * received * is_voter + rule.correct_vote * found_narrator + rule.narrator * ~is_voter)
+
+    # Played cards go to the discard pile
+    n_discard = state["n_discard"][idx]
+    state["discard"][idx[:, None], n_discard[:, None] + seats] = table
+    state["n_discard"][idx] = n_discard + n_players
+
+    # Deck with less cards than players: what is left is shuffled together with the discard pile
+    reshuffle = idx[state["n_draw"][idx] < n_players]
+    if len(reshuffle) != 0:
+        n_cards = state["draw"].shape[1]
+        pool = np.concatenate([state["draw"][reshuffle], state["discard"][reshuffle]], axis=1)
+        valid = np.concatenate([np.arange(n_cards) < state["n_draw"][reshuffle, None], np.arange(n_cards) < state["n_discard"][reshuffle, None]], axis=1)
+        keys = np.where(valid, rng.random(pool.shape), 2.0)
+        state["draw"][reshuffle] = np.take_along_axis(pool, np.argsort(keys, axis=1), axis=1)[:, :n_cards]
+        state["n_draw"][reshuffle] += state["n_discard"][reshuffle]
+        state["n_discard"][reshuffle] = 0
+
+    # Every player takes a card from the top of the deck, in the slot of the card played
+    n_draw = state["n_draw"][idx]
+    hands[b[:, None], seats, selected] = state["draw"][idx[:, None], n_draw[:, None] - 1 - seats]
+    state["n_draw"][idx] = n_draw - n_players
+
+    state["hands"][idx] = hands
+    state["points"][idx] += points
+    state["rounds"][idx] += 1
+
+def simulate_batch(scores: np.ndarray, card_captions: np.ndarray, n_games: int, n_players: int, points_to_win: int, best_narrator: np.ndarray, rule: ScoringRule, rng: np.random.Generator) -> SimulationResult:
+    n_cards = scores.shape[0]
+
+    # Shuffled deck, the first 6 cards of each player are its hand
+    deck = rng.permuted(np.tile(np.arange(n_cards), (n_games, 1)), axis=1)
+    draw = np.full((n_games, n_cards), -1)
+    draw[:, :n_cards - 6 * n_players] = deck[:, 6 * n_players:]
+
+    state = {
+        "hands": deck[:, :6 * n_players].reshape(n_games, n_players, 6),
+        "draw": draw,
+        "n_draw": np.full(n_games, n_cards - 6 * n_players),
+        "discard": np.full((n_games, n_cards), -1),
+        "n_discard": np.zeros(n_games, dtype=int),
+        "points": np.zeros((n_games, n_players), dtype=int),
+        "rounds": np.zeros(n_games, dtype=int),
+        "first": rng.integers(n_players, size=n_games)
+    }
+
+    # Finished games are left out of the next rounds
+    active = np.ones(n_games, dtype=bool)
+    while active.any():
+        idx = np.flatnonzero(active)
+        play_round(state, idx, scores, card_captions, best_narrator, rule, rng)
+        active[idx] = ~(state["points"][idx] >= points_to_win).any(axis=1)
+
+    points = state["points"]
+    return SimulationResult(points, points == points.max(axis=1, keepdims=True), state["rounds"])
+
+def simulate_games(matrix: ScoreMatrix, n_games: int, n_players: int, points_to_win: int, narrator_strategies: List[str], rule: ScoringRule = ScoringRule(), seed: int = 0, batch_size: int = 4096) -> SimulationResult:
+    if len(matrix.image_numbers) < 7 * n_players:
+        raise ValueError(f"{len(matrix.image_numbers)} cards are not enough for {n_players} players")
+    # Otherwise a round could give no points and the game would never end
+    if rule.all_or_none <= 0 or rule.narrator <= 0:
+        raise ValueError("The all-or-none and narrator points must be positive")
+    if len(narrator_strategies) == 1:
+        narrator_strategies = narrator_strategies * n_players
+    if len(narrator_strategies) != n_players:
+        raise ValueError("Specify one narrator strategy, or one for each player")
+
+    card_captions = captions_by_card(matrix)
+    best_narrator = np.array([strategy == "best" for strategy in narrator_strategies])
+    rng = np.random.default_rng(seed)
+
+    results = [simulate_batch(matrix.scores, card_captions, min(batch_size, n_games - start), n_players, points_to_win, best_narrator, rule, rng)
+               for start in range(0, n_games, batch_size)]
+    return SimulationResult(*[np.concatenate(arrays) for arrays in zip(*results)])
+
+# Win rate of each player (ties count as a win for every player with the maximum score) with a 95% normal interval
+def simulation_stats(result: SimulationResult, narrator_strategies: List[str]) -> Dict:
+    n_games, n_players = result.points.shape
+    if len(narrator_strategies) == 1:
+        narrator_strategies = narrator_strategies * n_players
+
+    players = {}
+    for k in range(n_players):
+        win_rate = result.winners[:, k].mean()
+        players[f"Bot {k+1}"] = {
+            "narrator": narrator_strategies[k],
+            "win_rate": float(win_rate),
+            "win_rate_ci95": float(1.96 * np.sqrt(win_rate * (1 - win_rate) / n_games)),
+            "mean_points": float(result.points[:, k].mean())
+        }
+
+    return {
+        "games": n_games,
+        "mean_rounds": float(result.rounds.mean()),
+        "ties": float((result.winners.sum(axis=1) > 1).mean()),
+        "players": players
+    }
+
+if __name__ == "__main__":
+
+    args = argument_parsing()
+    path_to_scores = args.scores if args.scores is not None else score_matrix_path(args.deck)
+
+    if args.build or not os.path.exists(path_to_scores):
+        from card_index import CardIndex
+        from models import device_name, load_models
+
+        device = device_name()
+        print("Loading models...")
+        models = load_models(args.blip_weights, args.clip_weights, device)
+        card_index = CardIndex.load_or_build(args.deck, models.clip_weights, models.clip_model, models.clip_processor, device)
+        print("Building the score matrix...")
+        save_score_matrix(path_to_scores, build_score_matrix(args.deck, models, card_index, device, args.captions_per_card))
+        print(f"Score matrix saved in {path_to_scores}")
+
+    matrix = load_score_matrix(path_to_scores)
+    rule = ScoringRule(args.all_or_none_points, args.narrator_points, args.correct_vote_points, args.vote_points)
+
+    start = time.perf_counter()
+    result = simulate_games(matrix, args.games, args.n_players, args.points_to_win, args.narrator, rule, args.seed, args.batch_size)
+    elapsed = time.perf_counter() - start
+    print(f"Simulated {args.games} games in {elapsed:.1f}s ({args.games / elapsed:.0f} games/s)", file=sys.stderr)
+
+    stats = simulation_stats(result, args.narrator)
+    print(f"Mean rounds: {stats['mean_rounds']:.1f}, ties: {stats['ties'] * 100:.1f}%")
+    for player, player_stats in stats["players"].items():
+        print(f"{player} ({player_stats['narrator']} narrator): wins {player_stats['win_rate'] * 100:.1f}% ± {player_stats['win_rate_ci95'] * 100:.1f}, "
+              f"mean points {player_stats['mean_points']:.1f}")
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(stats, f, indent=1)
@@ -0,0 +1,264 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+from argparse import Namespace
+from typing import Dict, List, Optional, Tuple
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from game import Game
+from card_index import CardIndex
+from caption_bank import CaptionBank
+from card_store import load_deck
+from models import Models, load_models, quantize_models
+from inference_server import InferenceServer
+from events import open_sink
+from captioning import NarratorOptions
+from clip_runtime import BACKENDS, load_clip_runtime
+from clip_features import text_cache_stats
+from instrumentation import Profiler, active_profiler, enable_profiling
+from online_stats import PROPORTIONS, OnlineStats
+
+# Set in the parent before the pool is created, so that with "fork" every worker shares the same pages (copy-on-write).
+# With "spawn" they are received once per worker through the pool initializer (the tensors travel through torch shared memory).
+_models: Optional[Models] = None
+_card_index: Optional[CardIndex] = None
+_caption_bank: Optional[CaptionBank] = None
+_inference: Optional[InferenceServer] = None
+
+# Running statistics of the games played by the worker, sent back with every group of results
+_stats = OnlineStats()
+
+def argument_parsing() -> Namespace:
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-g", "--games", type=int, default=100, help="Specify the number of games to play")
+    parser.add_argument("-m", "--mixes", type=str, nargs="+", default=["5:0"], help="Specify the player mixes as N_PLAYERS:GPT_PLAYERS, games are split evenly between them")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count(), help="Specify the number of worker processes")
+    parser.add_argument("--threads_per_worker", type=int, default=1, help="Specify the number of torch threads used by each worker")
+    parser.add_argument("-t", "--tables_per_worker", type=int, default=1, help="Specify the number of games played at the same time by each worker, their bots share a batching inference server")
+    parser.add_argument("--max_batch_size", type=int, default=32, help="Specify the maximum batch size of the inference server")
+    parser.add_argument("--max_latency", type=float, default=0.005, help="Specify how long (in seconds) the inference server waits to fill a batch")
+    parser.add_argument("--start_method", type=str, choices=["fork", "spawn"], default="fork", help="Specify how the workers are started")
+    parser.add_argument("--seed", type=int, default=0, help="Specify the seed of the first game, game k uses seed + k")
+    parser.add_argument("--points_to_win", type=int, default = 30, help="Specify the number of points to win")
+    parser.add_argument("--deck", type=str, default="../cards/odissey_cards", help="Specify the directory of the deck")
+    parser.add_argument("--blip_weights", type=str, default="../weights/rephrased_blip(2nd)/epoch50.pt", help="Specify the fine tuned BLIP weights")
+    parser.add_argument("--clip_weights", type=str, default="../weights/rephrased_coco_clip(2nd)/epoch13.pt", help="Specify the fine tuned CLIP weights")
+    parser.add_argument("--narrator_candidates", type=int, default=1, help="Specify the number of captions generated for each card in hand when a bot narrates (with 1 a random card gets a single caption)")
+    parser.add_argument("--narrator_target", type=float, default=0.5, help="Specify the probability of being found (against the rest of the hand) the caption chosen by a bot narrator should have")
+    parser.add_argument("--narrator_max_time", type=float, default=None, help="Specify the time budget (in seconds) of the bot captions generation")
+    parser.add_argument("--quantize", action="store_true", help="Run the bots with int8 dynamic quantized models (CPU only)")
+    parser.add_argument("--clip_backend", type=str, choices=BACKENDS, default="eager", help="Specify how the bots run CLIP: the eager model or the graphs exported by clip_runtime.py")
+    parser.add_argument("--caption_bank", action="store_true", help="Let the bots take their captions from the precomputed caption bank of the deck (see caption_bank.py)")
+    parser.add_argument("--events_dir", type=str, default=None, help="Specify the directory where the events of each game are saved")
+    parser.add_argument("--events_format", type=str, choices=["jsonl", "parquet"], default="jsonl", help="Specify the format of the event files")
+    parser.add_argument("--profile", type=str, default=None, help="Specify a path prefix to enable the instrumentation of the workers, saved as <prefix>.prom (Prometheus) and <prefix>.json")
+    parser.add_argument("--stats_every", type=int, default=100, help="Specify every how many games the running statistics (with their 95%% intervals) are printed")
+    parser.add_argument("--stop_half_width", type=float, default=None, help="Specify the half width (in percentage points) under which all the 95%% intervals must be to stop the tournament early")
+    parser.add_argument("--min_games", type=int, default=50, help="Specify the number of games played before stopping early")
+    parser.add_argument("--stats_output", type=str, default=None, help="Specify the JSON file where the final running statistics are saved")
+    parser.add_argument("-o", "--output", type=str, default="tournament.jsonl", help="Specify the file where the result of each game is saved")
+
+    args = parser.parse_args()
+    # The exported graphs are traced from the fp32 model and would replace the quantized one
+    if args.quantize and args.clip_backend != "eager":
+        parser.error("--quantize runs the eager CLIP model, it cannot be combined with --clip_backend " + args.clip_backend)
+
+    return args
+
+def parse_mix(mix: str) -> Tuple[int, int]:
+    n_players, gpt_players = mix.split(":")
+    return int(n_players), int(gpt_players)
+
+def init_worker(threads: int, models: Optional[Models], card_index: Optional[CardIndex], caption_bank: Optional[CaptionBank], tables: int, max_batch_size: int, max_latency: float, clip_backend: str, profile: bool) -> None:
+    global _models, _card_index, _caption_bank, _inference
+    torch.set_num_threads(threads)
+    if profile:
+        enable_profiling()
+
+    if models is not None:
+        _models = models
+        _card_index = card_index
+        _caption_bank = caption_bank
+
+    # Each worker opens its own runtime sessions, after the fork
+    _models = _models._replace(clip_model=load_clip_runtime(_models.clip_model, _models.clip_weights, clip_backend, threads=threads))
+
+    # Threads do not survive the fork, so each worker starts its own server
+    if tables > 1:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        _inference = InferenceServer(_models, _card_index, device, max_batch_size, max_latency).start()
+
+def events_path(task: Dict) -> str:
+    return os.path.join(task["events_dir"], f"game{task['game']}.{task['events_format']}")
+
+def play_game(task: Dict) -> Dict:
+    random.seed(task["seed"])
+    torch.manual_seed(task["seed"])
+
+    sinks = []
+    if task["events_dir"] is not None:
+        sinks.append(open_sink(events_path(task)))
+
+    # The sinks are closed also when the game raises, so the buffered records (e.g. of the Parquet sink) are not lost
+    start = time.perf_counter()
+    try:
+        game = Game(task["n_players"], task["gpt_players"], task["deck"], False, task["points_to_win"], False,
+                    path_to_clip_weights=task["clip_weights"], models=_models, card_index=_card_index, inference=_inference,
+                    sinks=sinks, verbose=False, game_id=str(task["game"]), narrator=NarratorOptions(*task["narrator"]), caption_bank=_caption_bank, stats=_stats)
+        winners = game.simulate()
+    finally:
+        for sink in sinks:
+            sink.close()
+
+    return {
+        **{key: task[key] for key in ["game", "seed", "n_players", "gpt_players"]},
+        "rounds": game.rounds_played,
+        "points": {str(p): p.points for p in game.players},
+        "winners": [str(p) for p in winners],
+        "seconds": time.perf_counter() - start
+    }
+
+# The games of a group are played at the same time, one thread each, so that their forward passes can be batched.
+# They share the global random state, so with more than one table per worker the games are not reproducible from their seed.
+def play_games(tasks: List[Dict]) -> Tuple[List[Dict], Dict]:
+    if len(tasks) == 1:
+        results = [play_game(tasks[0])]
+    else:
+        with ThreadPoolExecutor(len(tasks)) as executor:
+            results = list(executor.map(play_game, tasks))
+
+    metrics = {"pid": os.getpid(), "text_cache": text_cache_stats(), "stats": _stats.to_dict()}
+    if _inference is not None:
+        metrics["inference"] = _inference.metrics()
+    if active_profiler() is not None:
+        metrics["profile"] = active_profiler().snapshot()
+    return results, metrics
+
+# The statistics are cumulative per worker, so the last report of each worker is merged
+def merge_stats(worker_stats: Dict[int, Dict]) -> OnlineStats:
+    stats = OnlineStats()
+    for data in worker_stats.values():
+        stats.merge(data)
+    return stats
+
+def create_tasks(args: Namespace) -> List[Dict]:
+    mixes = [parse_mix(mix) for mix in args.mixes]
+    tasks = []
+    for k in range(args.games):
+        n_players, gpt_players = mixes[k % len(mixes)]
+        tasks.append({"game": k, "seed": args.seed + k, "n_players": n_players, "gpt_players": gpt_players,
+                      "points_to_win": args.points_to_win, "deck": args.deck, "clip_weights": args.clip_weights,
+                      "events_dir": args.events_dir, "events_format": args.events_format,
+                      "narrator": [args.narrator_candidates, args.narrator_target, args.narrator_max_time, args.caption_bank]})
+    return tasks
+
+if __name__ == "__main__":
+
+    args = argument_parsing()
+
+    # Must be set before the first forward pass: forking after OpenMP spun up its thread pool can hang the workers
+    torch.set_num_threads(args.threads_per_worker)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    print("Loading models...")
+    _models = load_models(args.blip_weights, args.clip_weights, device)
+    _card_index = CardIndex.load_or_build(args.deck, _models.clip_weights, _models.clip_model, _models.clip_processor, device)
+    if args.caption_bank:
+        _caption_bank = CaptionBank.find(args.deck, _models.blip_weights, _models.clip_weights, device)
+        if _caption_bank is None:
+            print("No caption bank for this deck and these models, the captions are generated live (run caption_bank.py once to build it)")
+    if args.quantize and device == "cpu":
+        _models = quantize_models(_models)
+    print("Models loaded successfully!")
+
+    # Packs the deck (if needed) once, before the workers start reading it
+    load_deck(args.deck)
+
+    initargs = (args.threads_per_worker, None, None, None, args.tables_per_worker, args.max_batch_size, args.max_latency, args.clip_backend, args.profile is not None)
+    if args.start_method == "spawn":
+        for model in [_models.blip_model, _models.clip_model]:
+            model.share_memory()
+        _card_index.embeddings.share_memory_()
+        initargs = (args.threads_per_worker, _models, _card_index, _caption_bank, args.tables_per_worker, args.max_batch_size, args.max_latency, args.clip_backend, args.profile is not None)
+
+    tasks = create_tasks(args)
+
+    # The event files are named after the game number, so a new run needs a new (or empty) directory
+    if args.events_dir is not None:
+        os.makedirs(args.events_dir, exist_ok=True)
+        existing = [path for path in map(events_path, tasks) if os.path.exists(path)]
+        if len(existing) != 0:
+            sys.exit(f"{len(existing)} event files of these games already exist in {args.events_dir} (e.g. {existing[0]}), specify another --events_dir")
+    groups = [tasks[k:k + args.tables_per_worker] for k in range(0, len(tasks), args.tables_per_worker)]
+    context = multiprocessing.get_context(args.start_method)
+
+    start = time.perf_counter()
+    wins: Dict[str, int] = {}
+    finished = 0
+    worker_metrics = []
+    worker_profiles = {}
+    worker_stats = {}
+    next_report = args.stats_every
+    stopped_early = False
+    with context.Pool(args.workers, initializer=init_worker, initargs=initargs) as pool, open(args.output, "w") as f:
+        for results, metrics in pool.imap_unordered(play_games, groups):
+            worker_metrics.append(metrics)
+            worker_stats[metrics["pid"]] = metrics["stats"]
+            if "profile" in metrics:
+                worker_profiles[metrics["pid"]] = metrics["profile"]
+
+            for result in results:
+                finished += 1
+                f.write(json.dumps(result) + "\n")
+                f.flush()
+
+                for winner in result["winners"]:
+                    wins[winner] = wins.get(winner, 0) + 1
+
+                elapsed = time.perf_counter() - start
+                print(f"[{finished}/{len(tasks)}] game {result['game']} ({result['n_players']}:{result['gpt_players']}) won by {', '.join(result['winners'])} "
+                      f"in {result['rounds']} rounds, {result['seconds']:.1f}s - {finished / elapsed * 3600:.1f} games/hour", file=sys.stderr)
+
+            stats = merge_stats(worker_stats)
+            if args.stats_every > 0 and finished >= next_report:
+                print(f"Statistics after {finished} games:\n{stats.report()}", file=sys.stderr)
+                next_report += args.stats_every
+
+            # Leaving the pool terminates the workers, the games not finished yet are dropped
+            if args.stop_half_width is not None and finished >= args.min_games and stats.max_half_width(PROPORTIONS) <= args.stop_half_width:
+                stopped_early = True
+                break
+
+    elapsed = time.perf_counter() - start
+    if stopped_early:
+        print(f"\nAll the 95% intervals are within {args.stop_half_width} points, stopping early")
+    print(f"\nPlayed {finished} games in {elapsed:.1f}s ({finished / elapsed * 3600:.1f} games/hour) with {args.workers} workers")
+    for player, n_wins in sorted(wins.items()):
+        print(f"{player}: {n_wins} wins")
+
+    stats = merge_stats(worker_stats)
+    print(f"\n{stats.report()}")
+    if args.stats_output is not None:
+        with open(args.stats_output, "w") as f:
+            json.dump({"games": stats.games, "statistics": stats.summary()}, f, indent=1)
+
+    # Metrics are cumulative per worker, the last report is the most complete one
+    if len(worker_metrics) != 0:
+        print(f"Caption text cache (last worker report): {json.dumps(worker_metrics[-1]['text_cache'])}")
+        if "inference" in worker_metrics[-1]:
+            print(f"Inference server (last worker report): {json.dumps(worker_metrics[-1]['inference'])}")
+
+    # The profiles are cumulative per worker as well, the last one of each worker is merged
+    if args.profile is not None:
+        profiler = Profiler()
+        for snapshot in worker_profiles.values():
+            profiler.merge(snapshot)
+        profiler.save(args.profile)
+        print(f"Instrumentation saved in {args.profile}.prom and {args.profile}.json")